@@ -45,6 +45,7 @@ import openquake.engine
 
 from openquake.engine import __version__
 from openquake.engine import engine
+from openquake.engine.calculators.hazard import general as haz_general
 from openquake.engine.db import models
 from openquake.engine.export import hazard as hazard_export
 from openquake.engine.export import risk as risk_export
@@ -94,6 +95,11 @@ def set_up_arg_parser():
         '--yes', '-y', action='store_true',
         help='Automatically answer "yes" when asked to confirm an action'
     )
+    general_grp.add_argument(
+        '--resume',
+        help=('Resume a job interrupted during the execute phase, by '
+              'skipping the tasks completed before the last checkpoint'),
+        metavar='JOB_ID', type=int)
     general_grp.add_argument(
         '--config-file',
         help='Custom openquake.cfg file, to override default configurations',
@@ -137,6 +143,11 @@ def set_up_arg_parser():
         '--duc',
         action='store_true',
         help='Delete all the uncompleted calculations')
+    hazard_grp.add_argument(
+        '--show-source-weights',
+        '--ssw',
+        action='store_true',
+        help='Show the source cost model fitted on the stored timings')
 
     risk_grp = parser.add_argument_group('Risk')
     risk_grp.add_argument(
@@ -296,6 +307,25 @@ def list_calculations(calc_manager):
             )
 
 
+def show_source_weights():
+    """
+    Print the parameters of the source cost models fitted on the timings
+    stored by the classical and event based tasks.
+    """
+    for task_name in ('compute_hazard_curves', 'compute_ses_and_gmfs'):
+        cost_model = haz_general.fit_cost_model(task_name)
+        print task_name
+        if not cost_model.fitted:
+            print '  not enough timings, using the default weights'
+            continue
+        print '  source_class | num_timings | coeff | exponent | rms'
+        for src_cls, (num_timings, rms) in sorted(
+                cost_model.fitted.iteritems()):
+            coeff, exponent = cost_model.get_params(src_cls)
+            print '  %s | %d | %s | %.3f | %.3f' % (
+                src_cls, num_timings, coeff, exponent, rms)
+
+
 # TODO: the command-line switches are not tested, included this one
 def list_imported_outputs():
     """
@@ -448,6 +478,10 @@ def main():
         hc_id, target_dir = args.export_hazard_outputs
         export_hazard_outputs(int(hc_id), expanduser(target_dir),
                               args.export_type)
+    elif args.resume is not None:
+        log_file = expanduser(args.log_file) \
+            if args.log_file is not None else None
+        engine.resume_job(args.resume, args.log_level, log_file, args.exports)
     elif args.run_hazard is not None:
         log_file = expanduser(args.log_file) \
             if args.log_file is not None else None
@@ -493,6 +527,8 @@ def main():
         list_imported_outputs()
     elif args.delete_uncompleted_calculations:
         delete_uncompleted_calculations()
+    elif args.show_source_weights:
+        show_source_weights()
     elif args.save_hazard_calculation:
         save_hazards.main(*args.save_hazard_calculation)
     elif args.load_hazard_calculation:
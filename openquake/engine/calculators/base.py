@@ -15,9 +15,14 @@
 
 """Base code for calculator classes."""
 
+import os
+import glob
+import time
+import cPickle
+
 from openquake.engine import logs
 from openquake.engine.performance import EnginePerformanceMonitor
-from openquake.engine.utils import tasks
+from openquake.engine.utils import config, tasks
 
 # Routing key format string for communication between tasks and the control
 # node.
@@ -48,6 +53,27 @@ def log_percent_gen(taskname, todo):
     yield done
 
 
+def log_done_gen(taskname, every):
+    """
+    Generator factory used when the total number of tasks is not known
+    in advance, as in the streaming submission mode. Each time the
+    generator object is called increment the number of completed tasks
+    and log it every `every` calls. Yield the number of calls done at
+    the current iteration.
+
+    :param str taskname:
+        the name of the task
+    :param int every:
+        the logging frequency
+    """
+    done = 1
+    while True:
+        if done % every == 0:
+            logs.LOG.progress('%s: %d task(s) done', taskname, done)
+        yield done
+        done += 1
+
+
 class Calculator(object):
     """
     Base class for all calculators.
@@ -59,9 +85,16 @@ class Calculator(object):
     #: generated by :func:`task_arg_gen`.
     core_calc_task = None
 
+    #: The names of the attributes saved in the checkpoints of the execute
+    #: phase; calculators with no checkpoint attributes cannot be resumed.
+    checkpoint_attrs = ()
+
     def __init__(self, job):
         self.job = job
         self.num_tasks = None
+        self.completed_tasks = set()  # task numbers
+        self.last_checkpoint = time.time()
+        self.num_checkpoints = 0  # saved by this process
 
     def monitor(self, operation):
         """
@@ -90,6 +123,16 @@ class Calculator(object):
         """
         raise NotImplementedError
 
+    def max_in_flight(self):
+        """
+        If the flag `streaming_submission` is set in the section [celery]
+        of openquake.cfg, return the number of concurrent tasks, i.e. the
+        maximum number of tasks in flight; otherwise return None and all
+        the tasks are sent at once.
+        """
+        if config.flag_set('celery', 'streaming_submission'):
+            return self.concurrent_tasks()
+
     def parallelize(self, task_func, task_arg_gen, task_completed):
         """
         Given a callable and a task arg generator, build an argument list and
@@ -106,11 +149,26 @@ class Calculator(object):
         tasks are run sequentially in the current process.
         """
         arglist = self.initialize_percent(task_func, task_arg_gen)
-        tasks.parallelize(task_func, arglist, task_completed)
+        tasks.parallelize(task_func, arglist, task_completed,
+                          self.max_in_flight())
 
     def initialize_percent(self, task_func, task_arg_gen):
-        arglist = list(task_arg_gen)
+        """
+        Initialize the progress logger and return the task arguments.
+        In streaming submission mode the arguments are not materialized
+        and the progress is logged as a number of completed tasks.
+
+        :param task_func: a `celery` task callable
+        :param task_arg_gen: an iterable over positional arguments
+        """
         taskname = task_func.__name__
+        max_in_flight = self.max_in_flight()
+        if max_in_flight:
+            self._log_percent = log_done_gen(taskname, max_in_flight)
+            logs.LOG.progress('spawning tasks of kind %s, at most %d '
+                              'in flight', taskname, max_in_flight)
+            return task_arg_gen
+        arglist = list(task_arg_gen)
         num_tasks = len(arglist)
         self._log_percent = log_percent_gen(taskname, num_tasks)
         logs.LOG.progress('spawning %d tasks of kind %s', num_tasks, taskname)
@@ -135,6 +193,119 @@ class Calculator(object):
         """
         self._log_percent.next()
 
+    def checkpoint_path(self):
+        """
+        Return the path of the checkpoint file of the job, or None if the
+        `dir` in the section [checkpoint] of openquake.cfg is empty or the
+        calculator does not support checkpoints.
+        """
+        dirname = config.get('checkpoint', 'dir')
+        if dirname and self.checkpoint_attrs:
+            return os.path.join(dirname, 'job-%d.pik' % self.job.id)
+
+    def save_checkpoint(self, force=False):
+        """
+        Save the checkpoint attributes and the set of completed tasks,
+        if more than `interval` seconds passed since the last checkpoint
+        (see the section [checkpoint] of openquake.cfg). The file is
+        written atomically, so that a crash in the middle of the saving
+        does not spoil the previous checkpoint.
+
+        :param bool force: save even if the interval is not elapsed
+        """
+        path = self.checkpoint_path()
+        interval = float(config.get('checkpoint', 'interval') or 0)
+        if path is None or (
+                not force and time.time() - self.last_checkpoint < interval):
+            return
+        state = dict((name, getattr(self, name))
+                     for name in self.checkpoint_attrs if hasattr(self, name))
+        state['completed_tasks'] = self.completed_tasks
+        with self.monitor('saving checkpoint'):
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # the data files of each checkpoint have distinct names, so
+            # that the previous ones stay valid until the rename below
+            self.num_checkpoints += 1
+            prefix = '%s.%d-%d.' % (path, os.getpid(), self.num_checkpoints)
+            state['checkpoint_data'] = self.save_checkpoint_data(prefix)
+            tmp = '%s.%d' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+            for fname in glob.glob(path + '.*'):
+                if not fname.startswith(prefix):  # previous data files
+                    os.remove(fname)
+        self.last_checkpoint = time.time()
+        logs.LOG.info('Saved checkpoint %s, %d task(s) completed',
+                      path, len(self.completed_tasks))
+
+    def load_checkpoint(self):
+        """
+        Restore the state of the calculator from the checkpoint file.
+
+        :returns: True if a checkpoint was found, False otherwise
+        """
+        path = self.checkpoint_path()
+        if path is None or not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            state = cPickle.load(f)
+        data = state.pop('checkpoint_data', None)
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+        self.load_checkpoint_data(data)
+        return True
+
+    def save_checkpoint_data(self, prefix):
+        """
+        Save the data which are too big to be pickled with the checkpoint
+        attributes in files whose names start with `prefix`, and return a
+        picklable reference to them. By default there are no such data.
+
+        :param str prefix: the prefix of the names of the data files
+        """
+        return None
+
+    def load_checkpoint_data(self, data):
+        """
+        Restore the data saved by :meth:`save_checkpoint_data`; it is
+        called after the checkpoint attributes have been restored.
+
+        :param data: the reference returned by :meth:`save_checkpoint_data`
+        """
+
+    def remove_checkpoint(self):
+        """
+        Remove the checkpoint file and its data files, if any; called
+        when the job completes.
+        """
+        path = self.checkpoint_path()
+        if path is not None:
+            for fname in glob.glob(path) + glob.glob(path + '.*'):
+                os.remove(fname)
+
+    def task_done(self, task_no):
+        """
+        Register a task as completed and save a checkpoint if needed.
+        Must be called after the result of the task has been aggregated.
+
+        :param int task_no: the ordinal of the task
+        """
+        self.completed_tasks.add(task_no)
+        self.save_checkpoint()
+
+    def tasks_todo(self, task_args):
+        """
+        Filter out the arguments of the completed tasks; the task number
+        is assumed to be the last argument.
+
+        :param task_args: an iterable over positional arguments
+        """
+        for args in task_args:
+            if args[-1] not in self.completed_tasks:
+                yield args
+
     def pre_execute(self):
         """
         Override this method in subclasses to record pre-execution stats,
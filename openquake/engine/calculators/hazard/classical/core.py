@@ -16,14 +16,21 @@
 """
 Core functionality for the classical PSHA hazard calculator.
 """
+import os
 import time
+import cPickle
+import hashlib
+import tempfile
 import operator
 import itertools
 import collections
 
 import numpy
 
+import openquake.engine
+from openquake import hazardlib
 from openquake.hazardlib.imt import from_string
+from openquake.hazardlib.site import SiteCollection
 from openquake.hazardlib.geo.utils import get_spherical_bounding_box
 from openquake.hazardlib.geo.utils import get_longitudinal_extent
 from openquake.hazardlib.geo.geodetic import npoints_between
@@ -33,7 +40,10 @@ from openquake.engine.calculators.hazard import general
 from openquake.engine.calculators.hazard.classical import (
     post_processing as post_proc)
 from openquake.engine.db import models
-from openquake.engine.utils import tasks
+from openquake.engine.input import source
+from openquake.engine.utils import config, tasks
+from openquake.engine.utils.general import SequenceSplitter
+from openquake.engine.utils.spatial import SiteIndex
 from openquake.engine.performance import EnginePerformanceMonitor, LightMonitor
 
 
@@ -129,13 +139,431 @@ class BoundingBox(object):
                 and self.south is not None)
 
 
+class BoundingBoxArray(object):
+    """
+    The bounding boxes of a source model for all the sites of a site
+    collection, stored as numpy arrays and updated in a vectorized way,
+    without creating a :class:`BoundingBox` object per site. To take in
+    account the international date line, the minimum of the positive
+    longitudes and the maximum of the negative longitudes are also stored.
+
+    :param lt_model_id: the ID of the source model
+    :param site_ids: the IDs of the sites
+    """
+    # the arrays updated by taking the minimum and the maximum respectively
+    MIN_ATTRS = ('min_dist', 'west', 'west_pos', 'south')
+    MAX_ATTRS = ('max_dist', 'east', 'east_neg', 'north')
+
+    def __init__(self, lt_model_id, site_ids):
+        self.lt_model_id = lt_model_id
+        self.site_ids = numpy.array(site_ids)
+        for name in self.MIN_ATTRS:
+            setattr(self, name, numpy.zeros(len(self.site_ids)) + numpy.inf)
+        for name in self.MAX_ATTRS:
+            setattr(self, name, numpy.zeros(len(self.site_ids)) - numpy.inf)
+
+    def update(self, mask, dists, lons, lats):
+        """
+        Enlarge the bounding boxes of the sites selected by the mask.
+
+        :param mask: a boolean array of length equal to the number of sites
+        :param dists: an array of distances, one per site
+        :param lons: an array of longitudes, one per site
+        :param lats: an array of latitudes, one per site
+        """
+        dists, lons, lats = dists[mask], lons[mask], lats[mask]
+        self._update(mask, 'min_dist', numpy.minimum, dists)
+        self._update(mask, 'max_dist', numpy.maximum, dists)
+        self._update(mask, 'west', numpy.minimum, lons)
+        self._update(mask, 'east', numpy.maximum, lons)
+        self._update(mask, 'west_pos', numpy.minimum,
+                     numpy.where(lons > 0, lons, numpy.inf))
+        self._update(mask, 'east_neg', numpy.maximum,
+                     numpy.where(lons < 0, lons, -numpy.inf))
+        self._update(mask, 'south', numpy.minimum, lats)
+        self._update(mask, 'north', numpy.maximum, lats)
+
+    def _update(self, mask, name, func, values):
+        array = getattr(self, name)
+        array[mask] = func(array[mask], values)
+
+    def update_bba(self, bba):
+        """
+        Enlarge the bounding boxes with the ones of another BoundingBoxArray
+        for the same sites.
+
+        :param bba: a :class:`BoundingBoxArray` instance
+        """
+        for name in self.MIN_ATTRS:
+            setattr(self, name, numpy.minimum(getattr(self, name),
+                                              getattr(bba, name)))
+        for name in self.MAX_ATTRS:
+            setattr(self, name, numpy.maximum(getattr(self, name),
+                                              getattr(bba, name)))
+
+    def __getitem__(self, i):
+        """
+        Return the :class:`BoundingBox` of the site of index `i`
+        (which is empty if no rupture was close to the site).
+        """
+        bb = BoundingBox(self.lt_model_id, self.site_ids[i])
+        if self.min_dist[i] == numpy.inf:  # empty bounding box
+            return bb
+        bb.min_dist, bb.max_dist = self.min_dist[i], self.max_dist[i]
+        bb.west, bb.east = self.west[i], self.east[i]
+        if get_longitudinal_extent(bb.west, bb.east) < 0:
+            # the international date line is crossed, as in
+            # hazardlib.geo.utils.get_spherical_bounding_box
+            bb.west, bb.east = self.west_pos[i], self.east_neg[i]
+        bb.south, bb.north = self.south[i], self.north[i]
+        return bb
+
+    def __len__(self):
+        return len(self.site_ids)
+
+
+def task_time_budget():
+    """
+    The number of seconds after which a classical task stops computing
+    new sources, as specified in the configuration file. 0 means no limit.
+    """
+    return float(config.get('hazard', 'task_time_budget') or 0)
+
+
+class CurveAccumulator(collections.OrderedDict):
+    """
+    An ordered dictionary rlz -> list of arrays of shape (n_sites, n_levels),
+    one per IMT in sorted order. The arrays are views over the arrays of
+    shape (n_rlz, n_sites, n_levels) stored in the attribute `arrays`.
+    """
+    arrays = ()
+
+
+def make_curve_accumulator(realizations, imtls, n_sites):
+    """
+    Build the accumulator of the hazard curves, i.e. a
+    :class:`CurveAccumulator` filled with zeros. If the parameter
+    `accumulator_dir`
+    in the section `[hazard]` of the configuration file is set, the arrays
+    are views over a memory-mapped file in that directory (one per IMT,
+    since the number of levels depends on the IMT) and the memory
+    occupation of the master does not depend on the size of the model.
+    The parameter `accumulator_dtype` sets the precision (float64 or
+    float32).
+
+    :param realizations: a sequence of realizations
+    :param imtls: a dictionary IMT -> intensity measure levels
+    :param int n_sites: the number of sites
+    """
+    dtype = config.get('hazard', 'accumulator_dtype') or 'float64'
+    acc_dir = config.get('hazard', 'accumulator_dir')
+    n_rlz = len(realizations)
+    arrays = []
+    for imt in sorted(imtls):
+        shape = (n_rlz, n_sites, len(imtls[imt]))
+        if acc_dir:
+            fh, fname = tempfile.mkstemp(
+                dir=acc_dir, prefix='curves-%s-' % imt, suffix='.mmap')
+            try:
+                arrays.append(numpy.memmap(fname, dtype, 'w+', shape=shape))
+            finally:
+                os.close(fh)
+                # the data stay available until the array is unmapped
+                os.remove(fname)
+        else:
+            arrays.append(numpy.zeros(shape, dtype))
+    acc = CurveAccumulator(
+        (rlz, [array[i] for array in arrays])
+        for i, rlz in enumerate(realizations))
+    acc.arrays = arrays
+    return acc
+
+
+def split_in_tiles(sitecol, tile_size):
+    """
+    Split the site collection in geographic tiles of `tile_size` x
+    `tile_size` degrees, ordered by latitude and longitude.
+
+    :param sitecol:
+        a :class:`openquake.hazardlib.site.SiteCollection` instance
+    :param float tile_size:
+        the size of the tiles in degrees
+    :returns:
+        a list of arrays with the indices of the sites in each tile
+    """
+    mesh = sitecol.mesh
+    lon_bins = numpy.floor(mesh.lons / tile_size).astype(numpy.int64)
+    lat_bins = numpy.floor(mesh.lats / tile_size).astype(numpy.int64)
+    # the longitude bins are in the range [-180 / tile_size - 1,
+    # 180 / tile_size], so each pair of bins has a distinct code
+    codes = lat_bins * (int(360 / tile_size) + 4) + lon_bins
+    _uniq, inverse = numpy.unique(codes, return_inverse=True)
+    order = numpy.argsort(inverse, kind='mergesort')
+    return numpy.split(order, numpy.cumsum(numpy.bincount(inverse))[:-1])
+
+
+def sources_within_budget(sources, time_budget, leftovers):
+    """
+    Yield the given sources until the time budget is exhausted; the
+    sources not yielded are appended to the list `leftovers`. At least
+    one source is always yielded, so that every task makes progress.
+
+    :param sources:
+        a block of source objects
+    :param float time_budget:
+        a number of seconds; if 0, all sources are yielded
+    :param list leftovers:
+        a list to be populated with the sources not yielded
+    """
+    t0 = time.time()
+    for i, src in enumerate(sources):
+        if time_budget and i and time.time() - t0 > time_budget:
+            leftovers.extend(sources[i:])
+            return
+        yield src
+
+
+#: maximum number of hazard curves saved in a single COPY FROM
+CURVE_BLOCK_SIZE = 100000
+
+#: the columns of hzrdr.hazard_curve_data populated by the binary COPY FROM
+HAZARD_CURVE_DATA_COLUMNS = ['hazard_curve_id', 'poes', 'location', 'weight']
+
+#: the OID of the float8 type in PostgreSQL
+FLOAT8_OID = 701
+
+
+def hazard_curve_data_to_pgcopy(haz_curve_id, lons, lats, curves, weight):
+    """
+    Convert a block of hazard curves into tuples in the PostgreSQL binary
+    COPY format for the columns HAZARD_CURVE_DATA_COLUMNS. The conversion
+    is performed with a numpy structured array, without looping on the
+    sites: the poes are stored as a float8[] and the locations as EWKB
+    points with SRID 4326.
+
+    :param int haz_curve_id: the ID of the HazardCurve container
+    :param lons: the longitudes of the sites
+    :param lats: the latitudes of the sites
+    :param curves: an array of shape (sites, levels)
+    :param weight: the weight of the realization (a Decimal or None)
+    :returns: a binary string
+    """
+    weight = writer.pg_numeric(weight)
+    n_sites, n_levels = curves.shape
+    rec = numpy.zeros(n_sites, numpy.dtype([
+        ('nfields', '>i2'),
+        ('id_len', '>i4'), ('id', '>i4'),
+        ('poes_len', '>i4'), ('ndim', '>i4'), ('hasnull', '>i4'),
+        ('oid', '>i4'), ('dim', '>i4'), ('lbound', '>i4'),
+        ('poes', [('len', '>i4'), ('val', '>f8')], (n_levels,)),
+        ('loc_len', '>i4'), ('byteorder', 'u1'), ('wkbtype', '<u4'),
+        ('srid', '<u4'), ('lon', '<f8'), ('lat', '<f8'),
+        ('weight', 'S%d' % len(weight))]))
+    rec['nfields'] = len(HAZARD_CURVE_DATA_COLUMNS)
+    rec['id_len'] = 4
+    rec['id'] = haz_curve_id
+    rec['poes_len'] = 20 + 12 * n_levels
+    rec['ndim'] = 1
+    rec['oid'] = FLOAT8_OID
+    rec['dim'] = n_levels
+    rec['lbound'] = 1
+    rec['poes']['len'] = 8
+    rec['poes']['val'] = curves
+    rec['loc_len'] = 25
+    rec['byteorder'] = 1  # little endian
+    rec['wkbtype'] = 0x20000001  # point with SRID
+    rec['srid'] = 4326
+    rec['lon'] = lons
+    rec['lat'] = lats
+    rec['weight'] = weight
+    return rec.tostring()
+
+
+def _update_hash(h, obj):
+    """
+    Update the hash `h` with a canonical representation of `obj`, which
+    is independent from the pickle protocol and from the order of the
+    attributes. Objects are represented by their class and by their
+    public attributes, recursively; private attributes are skipped,
+    since hazardlib uses them for lazily computed caches.
+
+    :param h: a hashlib object
+    :param obj: a hazardlib source or one of its parameters
+    """
+    if isinstance(obj, numpy.ndarray):
+        h.update('%s%s' % (obj.dtype.str, obj.shape))
+        h.update(numpy.ascontiguousarray(obj).tostring())
+    elif isinstance(obj, (list, tuple)):
+        h.update('%s%d' % (type(obj).__name__, len(obj)))
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, dict):
+        h.update('dict%d' % len(obj))
+        for key in sorted(obj):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    elif obj is None or isinstance(obj, (basestring, bool, int, long, float,
+                                          numpy.generic)):
+        h.update(repr(obj))
+    else:
+        cls = obj.__class__
+        h.update('%s.%s' % (cls.__module__, cls.__name__))
+        names = set(getattr(obj, '__dict__', ()))
+        for klass in cls.__mro__:
+            names.update(getattr(klass, '__slots__', ()))
+        for name in sorted(names):
+            if not name.startswith('_') and hasattr(obj, name):
+                h.update(name)
+                _update_hash(h, getattr(obj, name))
+
+
+class SourceCache(object):
+    """
+    A persistent cache of the probabilities of no exceedance generated
+    by single sources, stored on the local disk of the worker. The key
+    is a hash of the parameters of the source (after the application of
+    the logic tree uncertainties), of the site collection, of the IMTs
+    and levels, of the GSIM, of the truncation level, of the maximum
+    distance and of the versions of the engine and of hazardlib, so
+    that an unchanged source is not recomputed when rerunning a model
+    with the same code.
+    The values are pairs (indices, pnos) where `indices` are the indices
+    of the affected sites and `pnos` is a list of arrays, one per IMT in
+    sorted order.
+
+    :param dirname: the directory where the cache is stored
+    :param sitecol: the SiteCollection of the task
+    :param imts: a dictionary hazardlib IMT -> intensity measure levels
+    :param truncation_level: the truncation level
+    :param maximum_distance: the maximum distance
+    """
+    def __init__(self, dirname, sitecol, imts, truncation_level,
+                 maximum_distance):
+        self.dirname = dirname
+        self.hash = hashlib.sha1()
+        mesh = sitecol.mesh
+        for array in (mesh.lons, mesh.lats, sitecol.vs30,
+                      sitecol.vs30measured, sitecol.z1pt0, sitecol.z2pt5):
+            self.hash.update(numpy.ascontiguousarray(array).tostring())
+        self.hash.update(repr(sorted(imts.items())))
+        self.hash.update(repr((truncation_level, maximum_distance)))
+        self.hash.update(repr((openquake.engine.__version__,
+                               hazardlib.__version__)))
+
+    def digest(self, src, gsim_key):
+        """
+        :param src: a hazardlib source
+        :param gsim_key: a key identifying the GSIM, see `group_by_gsim`
+        :returns: the key of the given source and GSIM in the cache
+        """
+        h = self.hash.copy()
+        _update_hash(h, src)
+        h.update(repr(gsim_key))
+        return h.hexdigest()
+
+    def get(self, digest):
+        """
+        :returns: the pair (indices, pnos) stored for the digest, or None
+        """
+        try:
+            with open(os.path.join(self.dirname, digest), 'rb') as f:
+                return cPickle.load(f)
+        except IOError:
+            return None
+
+    def set(self, digest, indices, pnos):
+        """
+        Store the pair (indices, pnos) for the digest. The file is written
+        atomically, since many workers can share the same directory.
+        """
+        fname = os.path.join(self.dirname, digest)
+        with tempfile.NamedTemporaryFile(
+                dir=self.dirname, delete=False) as f:
+            cPickle.dump((indices, pnos), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(f.name, fname)
+
+    def set_empty(self, digest, imts):
+        """
+        Store an empty entry for the digest of a source giving no
+        contribution, i.e. with no ruptures close to the sites, so that
+        it is not recomputed either.
+
+        :param imts: a dictionary hazardlib IMT -> intensity measure levels
+        """
+        self.set(digest, numpy.array([], int),
+                 [numpy.ones((0, len(imts[imt]))) for imt in sorted(imts)])
+
+
+def get_source_cache(hc, sitecol, imts):
+    """
+    Return a :class:`SourceCache` if the parameter `source_cache_dir` in
+    the section `[hazard]` of the configuration file is set, otherwise
+    None. The cache is not used in disaggregation calculations, which
+    need to look at the ruptures to build the bounding boxes.
+
+    :param hc: a HazardCalculation instance
+    :param sitecol: the SiteCollection of the task
+    :param imts: a dictionary hazardlib IMT -> intensity measure levels
+    """
+    dirname = config.get('hazard', 'source_cache_dir')
+    if not dirname or hc.poes_disagg:
+        return None
+    return SourceCache(dirname, sitecol, imts, hc.truncation_level,
+                       hc.maximum_distance)
+
+
+def group_by_gsim(gsim_by_rlz):
+    """
+    Group the realizations sharing the same GSIM, i.e. GSIMs of the same
+    class with the same attributes.
+
+    :param gsim_by_rlz:
+        a dictionary of gsims, one for each realization
+    :returns:
+        a pair (gsim_by_key, key_by_rlz) where the keys identify
+        the distinct GSIMs
+    """
+    gsim_by_key = {}
+    key_by_rlz = {}
+    for rlz, gsim in gsim_by_rlz.iteritems():
+        key = (gsim.__class__.__name__, repr(sorted(vars(gsim).items())))
+        gsim_by_key.setdefault(key, gsim)
+        key_by_rlz[rlz] = key
+    return gsim_by_key, key_by_rlz
+
+
+def _sources_not_cached(sources, cache, gsim_by_key, curves, imts, digests):
+    # yield the sources which are not in the cache; the contributions of
+    # the others are read from the cache and multiplied into the curves;
+    # the digests of the yielded sources are stored in `digests`
+    for src in sources:
+        keys = dict((key, cache.digest(src, key)) for key in gsim_by_key)
+        cached = dict((key, cache.get(digest))
+                      for key, digest in keys.iteritems())
+        if any(value is None for value in cached.itervalues()):
+            for key, digest in keys.iteritems():
+                digests[src, key] = digest
+            yield src
+            continue
+        for key, (indices, pnos) in cached.iteritems():
+            for imt, pno in zip(imts, pnos):
+                curves[key][imt][indices] *= pno
+
+
 @tasks.oqtask
 def compute_hazard_curves(
         job_id, sitecol, sources, lt_model, gsim_by_rlz, task_no):
     """
     This task computes R2 * I hazard curves (each one is a
     numpy array of S * L floats) from the given source_ruptures
-    pairs.
+    pairs. The realizations sharing the same GSIM have the same curves,
+    so the contexts and the PoEs are computed once per distinct GSIM.
+    If a `source_cache_dir` is set in the configuration file, the
+    contributions of the sources already computed in a previous run
+    are read from the cache instead of being recomputed.
+    If a `task_time_budget` is set in the configuration file
+    and it is exceeded, the task stops and returns the sources it
+    did not compute, so that they can be resubmitted.
 
     :param job_id:
         ID of the currently running job
@@ -149,19 +577,24 @@ def compute_hazard_curves(
         a dictionary of gsims, one for each realization
     :param int task_no:
         the ordinal number of the current task
+    :returns:
+        a tuple (curve_dict, indices, bbs, lt_model_id, leftovers, task_no)
+        where `indices` are the indices of the sites affected by the
+        sources and the curves in `curve_dict` refer only to them
     """
-    hc = models.HazardCalculation.objects.get(oqjob=job_id)
+    hc = tasks.get_calculation(job_id)
     total_sites = len(sitecol)
     sitemesh = sitecol.mesh
     imts = general.im_dict_to_hazardlib(
         hc.intensity_measure_types_and_levels)
-    curves = dict((rlz, dict((imt, numpy.ones([total_sites, len(imts[imt])]))
+    gsim_by_key, key_by_rlz = group_by_gsim(gsim_by_rlz)
+    curves = dict((key, dict((imt, numpy.ones([total_sites, len(imts[imt])]))
                              for imt in imts))
-                  for rlz in gsim_by_rlz)
+                  for key in gsim_by_key)
     if hc.poes_disagg:  # doing disaggregation
-        bbs = [BoundingBox(lt_model.id, site_id) for site_id in sitecol.sids]
+        bbs = BoundingBoxArray(lt_model.id, sitecol.sids)
     else:
-        bbs = []
+        bbs = None
     mon = LightMonitor(
         'getting ruptures', job_id, compute_hazard_curves)
     make_ctxt_mon = LightMonitor(
@@ -169,25 +602,42 @@ def compute_hazard_curves(
     calc_poes_mon = LightMonitor(
         'computing poes', job_id, compute_hazard_curves)
 
+    leftovers = []
+    sources = sources_within_budget(sources, task_time_budget(), leftovers)
+
+    cache = get_source_cache(hc, sitecol, imts)
+    if cache:
+        # the contributions of a single source are computed in src_curves
+        src_curves = dict(
+            (key, dict((imt, numpy.ones([total_sites, len(imts[imt])]))
+                       for imt in imts))
+            for key in gsim_by_key)
+        digests = {}
+        sources = _sources_not_cached(sources, cache, gsim_by_key, curves,
+                                      sorted(imts), digests)
+    else:
+        src_curves = curves
+
     # NB: rows are a namedtuples with fields (source, rupture, rupture_sites)
-    for source, rows in itertools.groupby(
+    for src, rows in itertools.groupby(
             hc.gen_ruptures(sources, mon, sitecol),
             key=operator.attrgetter('source')):
         t0 = time.time()
         num_ruptures = 0
+        num_sites = 0
         for _source, rupture, r_sites in rows:
             num_ruptures += 1
+            num_sites = max(num_sites, len(r_sites))
             if hc.poes_disagg:  # doing disaggregation
                 jb_dists = rupture.surface.get_joyner_boore_distance(sitemesh)
                 closest_points = rupture.surface.get_closest_points(sitemesh)
-                for bb, dist, point in zip(bbs, jb_dists, closest_points):
-                    if dist < hc.maximum_distance:
-                        # ruptures too far away are ignored
-                        bb.update([dist], [point.longitude], [point.latitude])
-
-            # compute probabilities for all realizations
-            for rlz, curv in curves.iteritems():
-                gsim = gsim_by_rlz[rlz]
+                # ruptures too far away are ignored
+                bbs.update(jb_dists < hc.maximum_distance, jb_dists,
+                           closest_points.lons, closest_points.lats)
+
+            # compute probabilities for all distinct GSIMs
+            for key, curv in src_curves.iteritems():
+                gsim = gsim_by_key[key]
                 with make_ctxt_mon:
                     sctx, rctx, dctx = gsim.make_contexts(r_sites, rupture)
                 with calc_poes_mon:
@@ -197,20 +647,62 @@ def compute_hazard_curves(
                         pno = rupture.get_probability_no_exceedance(poes)
                         curv[imt] *= r_sites.expand(pno, placeholder=1)
 
+        if cache:
+            for key, curv in src_curves.iteritems():
+                indices = numpy.zeros(total_sites, bool)
+                for imt in imts:
+                    indices |= (curv[imt] != 1.0).any(axis=1)
+                indices = indices.nonzero()[0]
+                pnos = [curv[imt][indices] for imt in sorted(imts)]
+                cache.set(digests.pop((src, key)), indices, pnos)
+                for imt, pno in zip(sorted(imts), pnos):
+                    curves[key][imt][indices] *= pno
+                    curv[imt][indices] = 1.
+
+        calc_time = time.time() - t0
         logs.LOG.info('job=%d, src=%s:%s, num_ruptures=%d, calc_time=%fs',
-                      job_id, source.source_id, source.__class__.__name__,
-                      num_ruptures, time.time() - t0)
+                      job_id, src.source_id, src.__class__.__name__,
+                      num_ruptures, calc_time)
+        # the probabilities are computed once per distinct GSIM
+        general.save_source_timing(
+            job_id, compute_hazard_curves, src, num_ruptures, num_sites,
+            len(gsim_by_key), calc_time)
+    if cache:
+        # the remaining digests are of sources without ruptures
+        # close to the sites, which did not produce any row
+        for digest in digests.itervalues():
+            cache.set_empty(digest, imts)
+        digests.clear()
+    if leftovers:
+        logs.LOG.info('job=%d, task #%d: time budget exceeded, giving back '
+                      '%d source(s)', job_id, task_no, len(leftovers))
 
     make_ctxt_mon.flush()
     calc_poes_mon.flush()
+    general.source_timings.flush()
+
+    # only the curves of the affected sites are returned, so that the
+    # transferred data and the work on the master scale with the footprint
+    # of the sources and not with the total number of sites
+    affected = numpy.zeros(total_sites, bool)
+    for curv in curves.itervalues():
+        for imt in imts:
+            affected |= (curv[imt] != 1.0).any(axis=1)
+    indices = affected.nonzero()[0]
 
     # the 0 here is a shortcut for filtered sources giving no contribution;
     # this is essential for performance, we want to avoid returning
-    # big arrays of zeros (MS)
-    curve_dict = dict((rlz, [0 if (curv[imt] == 1.0).all() else 1. - curv[imt]
-                             for imt in sorted(imts)])
-                      for rlz, curv in curves.iteritems())
-    return curve_dict, bbs
+    # big arrays of zeros (MS); the realizations sharing the same GSIM
+    # share the same list of arrays, which is pickled only once
+    curves_by_key = {}
+    for key, curv in curves.iteritems():
+        curves_by_key[key] = []
+        for imt in sorted(imts):
+            poes = 1. - curv[imt][indices]
+            curves_by_key[key].append(poes if poes.any() else 0)
+    curve_dict = dict((rlz, curves_by_key[key])
+                      for rlz, key in key_by_rlz.iteritems())
+    return curve_dict, indices, bbs, lt_model.id, leftovers, task_no
 
 
 class ClassicalHazardCalculator(general.BaseHazardCalculator):
@@ -224,6 +716,23 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
 
     core_calc_task = compute_hazard_curves
 
+    checkpoint_attrs = (
+        'source_blocks_per_ltpath', 'cost_model', 'imtls', 'bb_dict',
+        'leftovers', 'pending_leftovers', 'next_task_no', 'completed_tiles',
+        'curve_containers')
+
+    @property
+    def tile_size(self):
+        """
+        The size in degrees of the geographic tiles, as set by the parameter
+        `tile_size` in the section `[hazard]` of the configuration file,
+        or 0 if the tiling is disabled. The disaggregation calculator
+        needs all the sites at once, so it does not use the tiling.
+        """
+        if self.hc.poes_disagg:
+            return 0
+        return float(config.get('hazard', 'tile_size') or 0)
+
     def pre_execute(self):
         """
         Do pre-execution work. At the moment, this work entails:
@@ -244,46 +753,247 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
         logs.LOG.info('Considering %d realization(s), %d IMT(s), %d level(s) '
                       'and %d sites, total %d', n_rlz, len(self.imtls),
                       n_levels, n_sites, total)
-        self.curves_by_rlz = collections.OrderedDict(
-            (rlz, [numpy.zeros((n_sites, len(self.imtls[imt])))
-                   for imt in sorted(self.imtls)])
-            for rlz in realizations)
+        if self.tile_size:
+            # the accumulator is built tile by tile, see .execute_tiles
+            self.completed_tiles = set()
+        else:
+            self.curves_by_rlz = make_curve_accumulator(
+                realizations, self.imtls, n_sites)
         lt_models = models.LtSourceModel.objects.filter(
             hazard_calculation=self.hc)
 
-        # a dictionary with the bounding boxes for earch source
-        # model and each site, defined only for disaggregation
+        # a dictionary with the bounding boxes for each source
+        # model and all the sites, defined only for disaggregation
         # calculations:
         if self.hc.poes_disagg:
             self.bb_dict = dict(
-                ((lt_model.id, site.id), BoundingBox(lt_model.id, site.id))
-                for site in self.hc.site_collection
+                (lt_model.id, BoundingBoxArray(
+                    lt_model.id, self.hc.site_collection.sids))
                 for lt_model in lt_models)
 
+    def save_checkpoint_data(self, prefix):
+        """
+        Save the arrays of the curve accumulator in .npy files, one per
+        IMT, instead of pickling them: the memory-mapped arrays are written
+        from the mapped files, without copying them in memory. Nothing is
+        saved in tiling mode, since the curves of an interrupted tile are
+        discarded anyway.
+
+        :param str prefix: the prefix of the names of the .npy files
+        :returns: a pair (realizations, file names) or None
+        """
+        if self.tile_size or not hasattr(self, 'curves_by_rlz'):
+            return None
+        fnames = []
+        for j, array in enumerate(self.curves_by_rlz.arrays):
+            fname = '%scurves-%d.npy' % (prefix, j)
+            with open(fname, 'wb') as f:
+                numpy.save(f, array)
+            fnames.append(fname)
+        return self.curves_by_rlz.keys(), fnames
+
+    def load_checkpoint_data(self, data):
+        """
+        Rebuild the curve accumulator from the .npy files saved by
+        :meth:`save_checkpoint_data`, honouring the `accumulator_dir`
+        of the configuration file.
+
+        :param data: a pair (realizations, file names) or None
+        """
+        if data is None:
+            return
+        realizations, fnames = data
+        arrays = [numpy.load(fname, mmap_mode='r') for fname in fnames]
+        self.curves_by_rlz = make_curve_accumulator(
+            realizations, self.imtls, arrays[0].shape[1])
+        for acc_array, array in zip(self.curves_by_rlz.arrays, arrays):
+            acc_array[:] = array
+
     @EnginePerformanceMonitor.monitor
-    def task_completed(self, (result, bbs)):
+    def execute(self):
+        """
+        Run the core_calc_task in parallel, on the whole site collection
+        or tile by tile, if the tiling is enabled.
+        """
+        if self.tile_size:
+            self.execute_tiles()
+        else:
+            num_tasks = sum(len(blocks) for blocks in
+                            self.source_blocks_per_ltpath.values())
+            self.compute_curves(
+                self.hc.site_collection, self.task_arg_gen(), num_tasks)
+
+    def execute_tiles(self):
+        """
+        Split the sites in geographic tiles and compute the curves of
+        each tile with the sources close to it; the curves are saved as
+        soon as a tile is completed, so that the memory occupation depends
+        only on the size of the tiles. When resuming from a checkpoint
+        the completed tiles are skipped.
+        """
+        sitecol = self.hc.site_collection
+        sites = list(sitecol)
+        tiles = split_in_tiles(sitecol, self.tile_size)
+        # the polygons enclosing the ruptures are needed for each tile
+        self._polygons = dict(
+            (src, src.get_rupture_enclosing_polygon())
+            for blocks in self.source_blocks_per_ltpath.itervalues()
+            for block in blocks for src in block
+        ) if self.hc.maximum_distance else {}
+        if not hasattr(self, 'curve_containers'):
+            self.curve_containers = self.create_curve_containers()
+        realizations = list(self._get_realizations())
+        for i, indices in enumerate(tiles):
+            if i in self.completed_tiles:
+                continue
+            tile = SiteCollection([sites[idx] for idx in indices])
+            logs.LOG.progress('computing tile %d of %d (%d sites)',
+                              i + 1, len(tiles), len(tile))
+            # the partial results of an interrupted tile are discarded
+            self.completed_tasks = set()
+            self.curves_by_rlz = make_curve_accumulator(
+                realizations, self.imtls, len(tile))
+            task_args = list(self.tile_arg_gen(tile))
+            if task_args:
+                self.compute_curves(tile, task_args, len(task_args))
+            self.save_curve_data(tile.mesh, self.curves_by_rlz)
+            del self.curves_by_rlz
+            self.completed_tiles.add(i)
+            self.save_checkpoint(force=True)
+
+    def tile_arg_gen(self, tile):
+        """
+        Generate the task arguments for the given tile, considering only
+        the sources close to it, split in blocks of similar weight.
+
+        :param tile: a SiteCollection instance
+        """
+        sitecol = tasks.broadcast(self.job.id, tile)
+        index = SiteIndex(tile)
+        splitter = SequenceSplitter(self.concurrent_tasks())
+        task_no = 0
+        for lt_model, trt, gsim_by_rlz in self.gen_gsim_by_trt():
+            sources = [src for block in self.source_blocks_per_ltpath[
+                       tuple(lt_model.sm_lt_path), trt] for src in block]
+            if self.hc.maximum_distance:
+                sources = [src for src in sources if len(index.within(
+                    self._polygons[src].lons, self._polygons[src].lats,
+                    self.hc.maximum_distance))]
+            if not sources:
+                continue
+            gsim_by_rlz = tasks.broadcast(self.job.id, gsim_by_rlz)
+            blocks = splitter.split_on_max_weight(
+                [(src, source.get_num_ruptures_weight(
+                    src, self.cost_model)[1])
+                 for src in sources])
+            for block in blocks:
+                yield (self.job.id, sitecol, block, lt_model,
+                       gsim_by_rlz, task_no)
+                task_no += 1
+
+    def compute_curves(self, sitecol, task_args, num_tasks):
+        """
+        Run the core_calc_task in parallel. The sources given back by the
+        tasks exceeding the `task_time_budget` are split again and
+        resubmitted, until there are no leftovers. When resuming from a
+        checkpoint the completed tasks are skipped.
+
+        :param sitecol: the SiteCollection the curves refer to
+        :param task_args: an iterable over the task arguments
+        :param num_tasks: the number of tasks in task_args
+        """
+        if not self.completed_tasks:
+            # (lt_model_id, trt) -> sources not computed yet
+            self.leftovers = collections.defaultdict(list)
+            # task_no -> (lt_model_id, trt, sources) for the resubmitted tasks
+            self.pending_leftovers = {}
+            self.next_task_no = num_tasks
+        else:  # the leftovers resubmitted before the crash are sent again
+            for lt_model_id, trt, sources in \
+                    self.pending_leftovers.itervalues():
+                self.leftovers[lt_model_id, trt].extend(sources)
+            self.pending_leftovers.clear()
+            logs.LOG.progress('resuming, %d task(s) already completed',
+                              len(self.completed_tasks))
+        self.parallelize(
+            self.core_calc_task, self.tasks_todo(task_args),
+            self.task_completed)
+        while self.leftovers:
+            logs.LOG.progress(
+                'resubmitting %d source(s) left over by slow tasks',
+                sum(len(srcs) for srcs in self.leftovers.itervalues()))
+            self.parallelize(
+                self.core_calc_task, self.leftover_arg_gen(sitecol),
+                self.task_completed)
+        self.save_checkpoint(force=True)
+
+    def leftover_arg_gen(self, sitecol):
+        """
+        Generate the task arguments for the sources left over by the
+        previous tasks, split in blocks of similar weight.
+
+        :param sitecol: the SiteCollection the curves refer to
+        """
+        leftovers = self.leftovers
+        self.leftovers = collections.defaultdict(list)
+        splitter = SequenceSplitter(self.concurrent_tasks())
+        sitecol = tasks.broadcast(self.job.id, sitecol)
+        for lt_model, trt, gsim_by_rlz in self.gen_gsim_by_trt():
+            sources = leftovers.pop((lt_model.id, trt), None)
+            if not sources:
+                continue
+            gsim_by_rlz = tasks.broadcast(self.job.id, gsim_by_rlz)
+            blocks = splitter.split_on_max_weight(
+                [(src, source.get_num_ruptures_weight(
+                    src, self.cost_model)[1])
+                 for src in sources])
+            for block in blocks:
+                self.pending_leftovers[self.next_task_no] = (
+                    lt_model.id, trt, block[:])
+                yield (self.job.id, sitecol, block, lt_model,
+                       gsim_by_rlz, self.next_task_no)
+                self.next_task_no += 1
+
+    @EnginePerformanceMonitor.monitor
+    def task_completed(
+            self, (result, indices, bbs, lt_model_id, leftovers, task_no)):
         """
         This is used to incrementally update hazard curve results by combining
         an initial value with some new results. (Each set of new results is
         computed over only a subset of seismic sources defined in the
         calculation model.)
 
-        :param task_result:
+        :param result:
             A dictionary rlz -> curves_by_imt where curves_by_imt is a
             list of 2-D numpy arrays representing the new results which need
-            to be combined with the current value. These should be the same
-            shape as self.curves_by_rlz[rlz][j] where rlz is the realization
-            and j is the IMT ordinal.
+            to be combined with the current value, or 0 if there is
+            no contribution. The arrays contain only the rows of
+            the affected sites, so they have the shape of
+            self.curves_by_rlz[rlz][j][indices] where rlz is the
+            realization and j is the IMT ordinal.
+        :param indices:
+            the indices of the sites affected by the task; only the
+            corresponding rows of the curves are updated, in place
+
+        The sources not computed by the task, if any, are stored in
+        `.leftovers`, to be resubmitted. At the end the task is registered
+        as completed, for the checkpoints.
         """
         for rlz, curves_by_imt in result.iteritems():
             for j, curves in enumerate(curves_by_imt):
                 # j is the IMT index
-                self.curves_by_rlz[rlz][j] = 1. - (
-                    1. - self.curves_by_rlz[rlz][j]) * (1. - curves)
+                if isinstance(curves, int):  # no contribution
+                    continue
+                acc = self.curves_by_rlz[rlz][j]
+                acc[indices] = 1. - (1. - acc[indices]) * (1. - curves)
         if self.hc.poes_disagg:
-            for bb in bbs:
-                self.bb_dict[bb.lt_model_id, bb.site_id].update_bb(bb)
+            self.bb_dict[lt_model_id].update_bba(bbs)
+        if leftovers:
+            trt = leftovers[0].tectonic_region_type
+            self.leftovers[lt_model_id, trt].extend(leftovers)
+        self.pending_leftovers.pop(task_no, None)
         self.log_percent()
+        self.task_done(task_no)
 
     # this could be parallelized in the future, however in all the cases
     # I have seen until now, the serialized approach is fast enough (MS)
@@ -291,55 +1001,92 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
     def save_hazard_curves(self):
         """
         Post-execution actions. At the moment, all we do is finalize the hazard
-        curve results.
+        curve results. In tiling mode the curves have been already saved
+        tile by tile.
+        """
+        if self.tile_size:
+            return
+        self.curve_containers = self.create_curve_containers()
+        self.save_curve_data(self.hc.site_collection.mesh, self.curves_by_rlz)
+        del self.curves_by_rlz  # save memory for the post_processing phase
+
+    def create_curve_containers(self):
+        """
+        Create the `HazardCurve` 'container' records and the associated
+        outputs, in two bulk inserts.
+
+        :returns:
+            a dictionary (rlz_id, imt) -> `HazardCurve` id
         """
         imtls = self.hc.intensity_measure_types_and_levels
-        for rlz, curves_by_imt in self.curves_by_rlz.iteritems():
-            # create a new `HazardCurve` 'container' record for each
+        outputs = []
+        keys = []  # (rlz, imt) pairs, with imt None for the multi-imt curves
+        for rlz in self._get_realizations():
+            # a `HazardCurve` 'container' record for each
             # realization (virtual container for multiple imts)
-            models.HazardCurve.objects.create(
-                output=models.Output.objects.create_output(
-                    self.job, "hc-multi-imt-rlz-%s" % rlz.id,
-                    "hazard_curve_multi"),
-                lt_realization=rlz,
-                imt=None,
-                investigation_time=self.hc.investigation_time)
-
-            # create a new `HazardCurve` 'container' record for each
+            outputs.append(models.Output(
+                oq_job=self.job,
+                display_name="hc-multi-imt-rlz-%s" % rlz.id,
+                output_type="hazard_curve_multi"))
+            keys.append((rlz, None))
+            # a `HazardCurve` 'container' record for each
             # realization for each intensity measure type
-            for imt, curves in zip(sorted(imtls), curves_by_imt):
-                hc_im_type, sa_period, sa_damping = from_string(imt)
-
-                # save output
-                hco = models.Output.objects.create(
+            for imt in sorted(imtls):
+                outputs.append(models.Output(
                     oq_job=self.job,
                     display_name="Hazard Curve rlz-%s" % rlz.id,
-                    output_type='hazard_curve',
-                )
+                    output_type='hazard_curve'))
+                keys.append((rlz, imt))
+        output_ids = writer.CacheInserter.saveall(outputs)
 
-                # save hazard_curve
-                haz_curve = models.HazardCurve.objects.create(
-                    output=hco,
+        haz_curves = []
+        for output_id, (rlz, imt) in zip(output_ids, keys):
+            if imt is None:
+                haz_curves.append(models.HazardCurve(
+                    output_id=output_id,
                     lt_realization=rlz,
-                    investigation_time=self.hc.investigation_time,
-                    imt=hc_im_type,
-                    imls=imtls[imt],
-                    sa_period=sa_period,
-                    sa_damping=sa_damping,
-                )
-
-                # save hazard_curve_data
-                points = self.hc.points_to_compute()
-                logs.LOG.info('saving %d hazard curves for %s, imt=%s',
-                              len(points), hco, imt)
-                writer.CacheInserter.saveall([
-                    models.HazardCurveData(
-                        hazard_curve=haz_curve,
-                        poes=list(poes),
-                        location='POINT(%s %s)' % (p.longitude, p.latitude),
-                        weight=rlz.weight)
-                    for p, poes in zip(points, curves)])
-        del self.curves_by_rlz  # save memory for the post_processing phase
+                    imt=None,
+                    investigation_time=self.hc.investigation_time))
+                continue
+            hc_im_type, sa_period, sa_damping = from_string(imt)
+            haz_curves.append(models.HazardCurve(
+                output_id=output_id,
+                lt_realization=rlz,
+                investigation_time=self.hc.investigation_time,
+                imt=hc_im_type,
+                imls=imtls[imt],
+                sa_period=sa_period,
+                sa_damping=sa_damping))
+        haz_curve_ids = writer.CacheInserter.saveall(haz_curves)
+        return dict(((rlz.id, imt), haz_curve_id)
+                    for haz_curve_id, (rlz, imt) in zip(haz_curve_ids, keys)
+                    if imt is not None)
+
+    def save_curve_data(self, mesh, curves_by_rlz):
+        """
+        Save the hazard curves in the containers created by
+        `.create_curve_containers`, with a binary COPY FROM directly from
+        the arrays of the accumulator, in blocks of CURVE_BLOCK_SIZE sites.
+
+        :param mesh: the mesh of the sites the curves refer to
+        :param curves_by_rlz: the curves accumulator
+        """
+        for rlz, curves_by_imt in curves_by_rlz.iteritems():
+            for imt, curves in zip(sorted(self.imtls), curves_by_imt):
+                haz_curve_id = self.curve_containers[rlz.id, imt]
+                t0 = time.time()
+                for i in xrange(0, len(curves), CURVE_BLOCK_SIZE):
+                    block = slice(i, i + CURVE_BLOCK_SIZE)
+                    writer.copy_binary(
+                        models.HazardCurveData, HAZARD_CURVE_DATA_COLUMNS,
+                        [hazard_curve_data_to_pgcopy(
+                            haz_curve_id, mesh.lons[block], mesh.lats[block],
+                            curves[block], rlz.weight)])
+                dt = time.time() - t0
+                logs.LOG.info(
+                    'saved %d hazard curves for rlz=%d, imt=%s in %.1fs '
+                    '(%d rows/s)', len(curves), rlz.id, imt, dt,
+                    len(curves) / dt if dt else 0)
 
     post_execute = save_hazard_curves
 
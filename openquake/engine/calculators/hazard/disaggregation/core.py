@@ -205,7 +205,7 @@ def compute_disagg(job_id, sitecol, sources, lt_model, gsim_by_rlz,
         (site.id, rlz.id, poe, imt, iml, trt_names).
     """
     mon = LightMonitor('disagg', job_id, compute_disagg)
-    hc = models.OqJob.objects.get(id=job_id).hazard_calculation
+    hc = tasks.get_calculation(job_id)
     trt_names = tuple(lt_model.get_tectonic_region_types())
     result = {}  # site.id, rlz.id, poe, imt, iml, trt_names -> array
 
@@ -329,11 +329,11 @@ class DisaggHazardCalculator(ClassicalHazardCalculator):
             logs.LOG.info('%d mag bins from %s to %s', len(mag_edges) - 1,
                           min_mag, max_mag)
 
-            for site in self.hc.site_collection:
+            for i, site in enumerate(self.hc.site_collection):
                 curves = curves_dict[site.id]
                 if not curves:
                     continue  # skip zero-valued hazard curves
-                bb = self.bb_dict[lt_model.id, site.id]
+                bb = self.bb_dict[lt_model.id][i]
                 if not bb:
                     logs.LOG.info(
                         'location %s was too far, skipping disaggregation',
@@ -354,10 +354,15 @@ class DisaggHazardCalculator(ClassicalHazardCalculator):
                     mag_edges, dist_edges, lon_edges, lat_edges, eps_edges)
 
             arglist.append((self.job.id, sitecol, srcs, lt_model, gsim_by_rlz,
-                            trt_num, curves_dict, self.bin_edges))
+                            trt_num))
 
+        # the curves and the bin edges are shared by all tasks
+        curves_dict = tasks.broadcast(self.job.id, curves_dict)
+        bin_edges = tasks.broadcast(self.job.id, self.bin_edges)
+        arglist = [args + (curves_dict, bin_edges) for args in arglist]
         self.initialize_percent(compute_disagg, arglist)
-        res = tasks.map_reduce(compute_disagg, arglist, self.agg_result, {})
+        res = tasks.map_reduce(compute_disagg, arglist, self.agg_result, {},
+                               self.max_in_flight())
         self.save_disagg_results(res)  # dictionary key -> probability array
 
     post_execute = full_disaggregation
@@ -31,6 +31,7 @@ For more information on computing ground motion fields, see
 :mod:`openquake.hazardlib.calc.gmf`.
 """
 
+import sys
 import time
 import random
 import collections
@@ -47,7 +48,8 @@ from openquake.engine.calculators.hazard.classical import (
     post_processing as cls_post_proc)
 from openquake.engine.calculators.hazard.event_based import post_processing
 from openquake.engine.db import models
-from openquake.engine.utils import tasks
+from openquake.engine.utils import config, tasks
+from openquake.engine.utils.spatial import SiteIndex
 from openquake.engine.performance import EnginePerformanceMonitor, LightMonitor
 
 #: Always 1 for the computation of ground motion fields in the event-based
@@ -57,6 +59,39 @@ DEFAULT_GMF_REALIZATIONS = 1
 # NB: beware of large caches
 inserter = writer.CacheInserter(models.GmfData, 1000)
 
+#: number of SES ruptures saved in a single COPY FROM
+RUPTURE_BLOCK_SIZE = 1000
+
+
+def sample_occurrences(rup, all_ses, rnd, rstate=None):
+    """
+    Sample the number of occurrences of the given rupture in each
+    stochastic event set. If `rstate` is None, numpy is reseeded from
+    `rnd` for each SES and the rupture is sampled SES by SES (the
+    historical scheme); otherwise all the occurrences are drawn
+    with a single vectorized Poisson draw from `rstate`.
+
+    :param rup: a hazardlib rupture
+    :param all_ses: the list of SES of the SES collection
+    :param rnd: a seeded `random.Random` instance
+    :param rstate: a seeded `numpy.random.RandomState` instance or None
+    :returns: a list of pairs (ses, num_occurrences) for the
+              SES where the rupture occurs
+    """
+    if rstate is None:
+        ses_num_occ = []
+        for ses in all_ses:
+            numpy.random.seed(rnd.randint(0, models.MAX_SINT_32))
+            num_occurrences = rup.sample_number_of_occurrences()
+            if num_occurrences:
+                ses_num_occ.append((ses, num_occurrences))
+        return ses_num_occ
+    occurrences = rstate.poisson(
+        rup.occurrence_rate * rup.temporal_occurrence_model.time_span,
+        len(all_ses))
+    return [(all_ses[i], int(occurrences[i]))
+            for i in occurrences.nonzero()[0]]
+
 
 @tasks.oqtask
 def compute_ses_and_gmfs(
@@ -72,6 +107,9 @@ def compute_ses_and_gmfs(
     Optionally (specified in the job configuration using the
     `ground_motion_fields` parameter), GMFs can be computed from each rupture
     in each stochastic event set. GMFs are also saved to the database.
+    If `hazard_curves_from_gmfs` is set and `ground_motion_fields` is not,
+    the GMFs are computed but not saved: instead, the number of exceedances
+    of each intensity measure level is counted and returned.
 
     :param int job_id:
         ID of the currently running job.
@@ -83,11 +121,14 @@ def compute_ses_and_gmfs(
         dictionary of GSIM
     :param task_no:
         an ordinal so that GMV can be collected in a reproducible order
+    :returns:
+        a dictionary (rlz_id, imt) -> array of counts, empty unless the
+        hazard curves are computed on the fly
     """
     # NB: all realizations in gsim_by_rlz correspond to the same source model
     ses_coll = models.SESCollection.objects.get(lt_model=lt_model)
 
-    hc = models.HazardCalculation.objects.get(oqjob=job_id)
+    hc = tasks.get_calculation(job_id)
     all_ses = list(ses_coll)
     imts = map(from_string, hc.intensity_measure_types)
     params = dict(
@@ -95,7 +136,14 @@ def compute_ses_and_gmfs(
         truncation_level=hc.truncation_level,
         maximum_distance=hc.maximum_distance)
 
-    gmfcollector = GmfCollector(params, imts, gsim_by_rlz)
+    if hc.hazard_curves_from_gmfs and not hc.ground_motion_fields:
+        counter = CurveCounter(
+            sitecol.sids, hc.intensity_measure_types_and_levels)
+    else:
+        counter = None
+    compute_gmfs = hc.ground_motion_fields or counter is not None
+    gmfcollector = GmfCollector(
+        params, imts, gsim_by_rlz, hc.ground_motion_fields, counter)
 
     filter_sites_mon = LightMonitor(
         'filtering sites', job_id, compute_ses_and_gmfs)
@@ -108,18 +156,35 @@ def compute_ses_and_gmfs(
     compute_gmfs_mon = LightMonitor(
         'computing gmfs', job_id, compute_ses_and_gmfs)
 
+    prob_rup_ids = writer.gen_ids(models.ProbabilisticRupture)
+    ses_rup_ids = writer.gen_ids(models.SESRupture)
+    prob_rup_inserter = writer.CacheInserter(
+        models.ProbabilisticRupture, RUPTURE_BLOCK_SIZE, keep_ids=True)
+    # the SES ruptures are flushed explicitly, after their parents; in case
+    # of errors CacheInserter.flushall flushes them in the same order
+    ses_rup_inserter = writer.CacheInserter(
+        models.SESRupture, sys.maxint, keep_ids=True)
+
     # Compute and save stochastic event sets
     rnd = random.Random()
     num_distinct_ruptures = 0
     total_ruptures = 0
 
+    if hc.maximum_distance:
+        with filter_sites_mon:
+            index = SiteIndex(sitecol)
+
+    vectorized = config.flag_set('hazard', 'vectorized_sampling')
     for src, seed in src_seeds:
         t0 = time.time()
         rnd.seed(seed)
+        # in vectorized mode the occurrences are drawn from a
+        # generator seeded per source
+        rstate = numpy.random.RandomState(seed) if vectorized else None
 
         with filter_sites_mon:  # filtering sources
-            s_sites = src.filter_sites_by_distance_to_source(
-                hc.maximum_distance, sitecol
+            s_sites = index.filter_sites_by_distance_to_source(
+                src, hc.maximum_distance
             ) if hc.maximum_distance else sitecol
             if s_sites is None:
                 continue
@@ -127,46 +192,52 @@ def compute_ses_and_gmfs(
         # the dictionary `ses_num_occ` contains [(ses, num_occurrences)]
         # for each occurring rupture for each ses in the ses collection
         ses_num_occ = collections.defaultdict(list)
+        rup_no = 0
+        num_sites = 0  # the largest number of sites affected by a rupture
         with generate_ruptures_mon:  # generating ruptures for the given source
             for rup_no, rup in enumerate(src.iter_ruptures(), 1):
                 rup.rup_no = rup_no
-                for ses in all_ses:
-                    numpy.random.seed(rnd.randint(0, models.MAX_SINT_32))
-                    num_occurrences = rup.sample_number_of_occurrences()
-                    if num_occurrences:
-                        ses_num_occ[rup].append((ses, num_occurrences))
-                        total_ruptures += num_occurrences
+                for ses, num_occurrences in sample_occurrences(
+                        rup, all_ses, rnd, rstate):
+                    ses_num_occ[rup].append((ses, num_occurrences))
+                    total_ruptures += num_occurrences
 
         # NB: the number of occurrences is very low, << 1, so it is
         # more efficient to filter only the ruptures that occur, i.e.
         # to call sample_number_of_occurrences() *before* the filtering
         for rup in ses_num_occ.keys():
             with filter_ruptures_mon:  # filtering ruptures
-                r_sites = rup.source_typology.\
-                    filter_sites_by_distance_to_rupture(
-                        rup, hc.maximum_distance, s_sites
-                    ) if hc.maximum_distance else s_sites
+                r_sites = index.filter_sites_by_distance_to_rupture(
+                    rup, hc.maximum_distance, s_sites
+                ) if hc.maximum_distance else s_sites
                 if r_sites is None:
                     # ignore ruptures which are far away
                     del ses_num_occ[rup]  # save memory
                     continue
+                num_sites = max(num_sites, len(r_sites))
 
             ses_ruptures = []
             with save_ruptures_mon:  # saving ses_ruptures
-                # using a django transaction make the saving faster
-                with transaction.commit_on_success(using='job_init'):
-                    prob_rup = models.ProbabilisticRupture.create(
-                        rup, ses_coll)
-                    for ses, num_occurrences in ses_num_occ[rup]:
-                        for occ_no in range(1, num_occurrences + 1):
-                            rup_seed = rnd.randint(0, models.MAX_SINT_32)
-                            ses_rup = models.SESRupture.create(
-                                prob_rup, ses, src.source_id,
-                                rup.rup_no, occ_no, rup_seed)
-                            ses_ruptures.append(ses_rup)
+                # the ids are reserved in advance, so that the ruptures
+                # can be saved in bulk and referred by the GMFs
+                prob_rup = models.ProbabilisticRupture.build(
+                    rup, ses_coll, src.source_id, next(prob_rup_ids))
+                prob_rup_inserter.add(prob_rup)
+                for ses, num_occurrences in ses_num_occ[rup]:
+                    for occ_no in range(1, num_occurrences + 1):
+                        rup_seed = rnd.randint(0, models.MAX_SINT_32)
+                        ses_rup = models.SESRupture.build(
+                            prob_rup, ses, rup.rup_no, occ_no, rup_seed,
+                            next(ses_rup_ids))
+                        ses_rup_inserter.add(ses_rup)
+                        ses_ruptures.append(ses_rup)
+                if ses_rup_inserter.nlines >= RUPTURE_BLOCK_SIZE:
+                    # the parent ruptures must be saved first
+                    prob_rup_inserter.flush()
+                    ses_rup_inserter.flush()
 
             with compute_gmfs_mon:  # computing GMFs
-                if hc.ground_motion_fields:
+                if compute_gmfs:
                     for ses_rup in ses_ruptures:
                         gmfcollector.calc_gmf(
                             r_sites, rup, ses_rup.id, ses_rup.seed)
@@ -180,12 +251,24 @@ def compute_ses_and_gmfs(
                 'job=%d, src=%s:%s, num_ruptures=%d, tot_ruptures=%d, '
                 'num_sites=%d, calc_time=%fs', job_id, src.source_id,
                 src.__class__.__name__, num_ruptures, tot_ruptures,
-                len(s_sites), time.time() - t0)
+                num_sites, time.time() - t0)
             num_distinct_ruptures += num_ruptures
+        # the timings are stored with the number of generated ruptures,
+        # the quantity the source weights are based on, and as in the
+        # classical calculator with the largest number of rupture sites;
+        # a GMF is computed for each realization, even if the GSIM repeats
+        general.save_source_timing(
+            job_id, compute_ses_and_gmfs, src, rup_no, num_sites,
+            len(gsim_by_rlz), time.time() - t0)
+
+    with save_ruptures_mon:
+        prob_rup_inserter.flush()
+        ses_rup_inserter.flush()
 
     if num_distinct_ruptures:
         logs.LOG.info('job=%d, task %d generated %d/%d ruptures',
                       job_id, task_no, num_distinct_ruptures, total_ruptures)
+    general.source_timings.flush()
     filter_sites_mon.flush()
     generate_ruptures_mon.flush()
     filter_ruptures_mon.flush()
@@ -196,13 +279,141 @@ def compute_ses_and_gmfs(
         with EnginePerformanceMonitor(
                 'saving gmfs', job_id, compute_ses_and_gmfs):
             gmfcollector.save_gmfs(task_no)
+    return counter.get_counts() if counter is not None else {}
+
+
+class GmfBuffer(object):
+    """
+    Growable typed arrays storing the nonzero ground motion values
+    generated by a task for a given realization and IMT, together with
+    the ids of the generating ruptures and the ids of the sites. The
+    arrays double their size when full, so that the cost of appending
+    is amortized. Compared to lists of Python floats, the memory
+    occupation is reduced by an order of magnitude.
+
+    :param size: the initial size of the arrays
+    """
+    def __init__(self, size=1024):
+        self.gmvs = numpy.zeros(size, numpy.float32)
+        self.rupture_ids = numpy.zeros(size, numpy.int64)
+        self.site_ids = numpy.zeros(size, numpy.int32)
+        self.n = 0  # number of stored values
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self, n):
+        # make sure there is room for n more values
+        size = len(self.gmvs)
+        if self.n + n <= size:
+            return
+        while self.n + n > size:
+            size *= 2
+        for name in ('gmvs', 'rupture_ids', 'site_ids'):
+            old = getattr(self, name)
+            new = numpy.zeros(size, old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def extend(self, site_ids, gmvs, rupture_id):
+        """
+        Store the nonzero ground motion values generated by a rupture.
+
+        :param site_ids: an array of site ids
+        :param gmvs: an array of ground motion values, one per site
+        :param rupture_id: the id of the generating rupture
+        """
+        gmvs = numpy.asarray(gmvs, numpy.float32).reshape(-1)
+        nonzero = gmvs != 0
+        n = nonzero.sum()
+        if not n:
+            return
+        self._grow(n)
+        stop = self.n + n
+        self.gmvs[self.n:stop] = gmvs[nonzero]
+        self.site_ids[self.n:stop] = numpy.asarray(site_ids)[nonzero]
+        self.rupture_ids[self.n:stop] = rupture_id
+        self.n = stop
+
+    def group_by_site(self):
+        """
+        Yield triples (site_id, gmvs, rupture_ids) ordered by site id;
+        for each site the values are in insertion order.
+        """
+        site_ids = self.site_ids[:self.n]
+        order = numpy.argsort(site_ids, kind='mergesort')  # stable sort
+        sorted_ids = site_ids[order]
+        bounds = numpy.concatenate(
+            [[0], (numpy.diff(sorted_ids) != 0).nonzero()[0] + 1, [self.n]])
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            idx = order[start:stop]
+            yield (int(sorted_ids[start]), self.gmvs[idx],
+                   self.rupture_ids[idx])
+
+
+class CurveCounter(object):
+    """
+    Count, for each realization, IMT, site and intensity measure level,
+    the number of ground motion values exceeding the level, with the same
+    semantics of :func:`openquake.engine.calculators.hazard.event_based.\
+post_processing.gmvs_to_haz_curve`. This is enough to compute the hazard
+    curves without storing the ground motion fields. The ground motion
+    values are compared in single precision, exactly as the ones read
+    from the stored GMFs.
+
+    :param sids:
+        the sorted array of the site ids of the calculation
+    :param imtls:
+        a dictionary IMT string -> intensity measure levels
+    """
+    def __init__(self, sids, imtls):
+        self.sids = sids
+        self.imls = dict((from_string(imt), numpy.array(imls))
+                         for imt, imls in imtls.iteritems())
+        # a dictionary (rlz_id, imt) -> array of shape (sites, levels)
+        self.counts = {}
+
+    def update(self, rlz, imt, sids, gmvs):
+        """
+        Update the counts with the ground motion values generated by
+        a rupture.
+
+        :param rlz: a :class:`openquake.engine.db.models.LtRealization`
+        :param imt: a hazardlib intensity measure type
+        :param sids: the ids of the sites affected by the rupture
+        :param gmvs: the ground motion values, one per site
+        """
+        imls = self.imls.get(imt)
+        if imls is None:  # no hazard curves for this IMT
+            return
+        try:
+            counts = self.counts[rlz.id, imt]
+        except KeyError:
+            counts = self.counts[rlz.id, imt] = numpy.zeros(
+                (len(self.sids), len(imls)), numpy.uint32)
+        idx = numpy.searchsorted(self.sids, sids)
+        gmvs = numpy.asarray(gmvs, numpy.float32).reshape(-1, 1)
+        counts[idx] += gmvs >= imls
+
+    def get_counts(self):
+        """
+        :returns:
+            a dictionary (rlz_id, imt) -> (indices, counts), where
+            `indices` are the positions in `sids` of the sites with
+            nonzero counts and `counts` the corresponding rows
+        """
+        sparse = {}
+        for key, counts in self.counts.iteritems():
+            indices, = counts.any(axis=1).nonzero()
+            sparse[key] = (indices, counts[indices])
+        return sparse
 
 
 class GmfCollector(object):
     """
     A class to compute and save ground motion fields.
     """
-    def __init__(self, params, imts, gsim_by_rlz):
+    def __init__(self, params, imts, gsim_by_rlz, store=True, counter=None):
         """
         :param params:
             a dictionary of parameters with keys
@@ -211,20 +422,24 @@ class GmfCollector(object):
             a list of hazardlib intensity measure types
         :param gsim_by_rlz:
             a dictionary rlz -> GSIM instance
+        :param store:
+            if False, the ground motion values are not collected
+        :param counter:
+            a :class:`CurveCounter` instance or None
         """
         self.params = params
         self.imts = imts
         self.gsim_by_rlz = gsim_by_rlz
-        # NB: I tried to use a single dictionary
-        # {site_id: [(gmv, rupt_id),...]} but it took a lot more memory (MS)
-        self.gmvs_per_site = collections.defaultdict(list)
-        self.ruptures_per_site = collections.defaultdict(list)
+        self.store = store
+        self.counter = counter
+        # a dictionary (rlz, imt) -> GmfBuffer
+        self.buffers = {}
 
     def calc_gmf(self, r_sites, rupture, rupture_id, rupture_seed):
         """
         Compute the GMF generated by the given rupture on the given
-        sites and collect the values in the dictionaries
-        .gmvs_per_site and .ruptures_per_site.
+        sites and collect the values in the dictionary .buffers and/or
+        update the exceedance counts of the .counter.
 
         :param r_sites:
             the collection of sites affected by the rupture
@@ -251,13 +466,15 @@ class GmfCollector(object):
             for imt, gmf_1_realiz in gmf_dict.iteritems():
                 # since DEFAULT_GMF_REALIZATIONS is 1, gmf_1_realiz is a matrix
                 # with n_sites rows and 1 column
-                for site_id, gmv in zip(r_sites.sids, gmf_1_realiz):
-                    # convert a 1x1 matrix into a float
-                    gmv = float(gmv)
-                    if gmv:
-                        self.gmvs_per_site[rlz, imt, site_id].append(gmv)
-                        self.ruptures_per_site[rlz, imt, site_id].append(
-                            rupture_id)
+                if self.counter is not None:
+                    self.counter.update(rlz, imt, r_sites.sids, gmf_1_realiz)
+                if not self.store:
+                    continue
+                try:
+                    buf = self.buffers[rlz, imt]
+                except KeyError:
+                    buf = self.buffers[rlz, imt] = GmfBuffer()
+                buf.extend(r_sites.sids, gmf_1_realiz, rupture_id)
 
     @transaction.commit_on_success(using='job_init')
     def save_gmfs(self, task_no):
@@ -267,20 +484,23 @@ class GmfCollector(object):
         :param task_no:
             The ordinal of the task which generated the current GMFs to save
         """
-        for rlz, imt, site_id in self.gmvs_per_site:
+        gmf_by_rlz = {}
+        for (rlz, imt), buf in self.buffers.iteritems():
+            if rlz not in gmf_by_rlz:
+                gmf_by_rlz[rlz] = models.Gmf.objects.get(lt_realization=rlz)
             imt_name, sa_period, sa_damping = imt
-            inserter.add(models.GmfData(
-                gmf=models.Gmf.objects.get(lt_realization=rlz),
-                task_no=task_no,
-                imt=imt_name,
-                sa_period=sa_period,
-                sa_damping=sa_damping,
-                site_id=site_id,
-                gmvs=self.gmvs_per_site[rlz, imt, site_id],
-                rupture_ids=self.ruptures_per_site[rlz, imt, site_id]))
+            for site_id, gmvs, rupture_ids in buf.group_by_site():
+                inserter.add(models.GmfData(
+                    gmf=gmf_by_rlz[rlz],
+                    task_no=task_no,
+                    imt=imt_name,
+                    sa_period=sa_period,
+                    sa_damping=sa_damping,
+                    site_id=site_id,
+                    gmvs=gmvs.tolist(),
+                    rupture_ids=rupture_ids.tolist()))
         inserter.flush()
-        self.gmvs_per_site.clear()
-        self.ruptures_per_site.clear()
+        self.buffers.clear()
 
 
 class EventBasedHazardCalculator(general.BaseHazardCalculator):
@@ -349,10 +569,40 @@ class EventBasedHazardCalculator(general.BaseHazardCalculator):
         `execute` phase.)
         """
         super(EventBasedHazardCalculator, self).pre_execute()
-        for lt_model in models.LtSourceModel.objects.filter(
-                hazard_calculation=self.hc):
+        # (rlz_id, imt) -> exceedance counts, used only if the
+        # hazard curves are computed without storing the GMFs
+        self.curve_counts = {}
+        lt_models = models.LtSourceModel.objects.filter(
+            hazard_calculation=self.hc)
+        # the ordinals of the source models are packed in the event keys
+        # of the ruptures, so they are checked before doing any work
+        max_models = 2 ** models.EVENT_KEY_BITS[0]
+        if len(lt_models) > max_models:
+            raise ValueError(
+                'The source model logic tree has %d paths, but the event '
+                'based calculator supports at most %d of them' %
+                (len(lt_models), max_models))
+        for lt_model in lt_models:
             self.initialize_ses_db_records(lt_model)
 
+    def task_completed(self, curve_counts):
+        """
+        Sum the exceedance counts returned by the task, if any.
+
+        :param curve_counts:
+            a dictionary (rlz_id, imt) -> (site indices, counts), as
+            returned by :meth:`CurveCounter.get_counts`
+        """
+        for (rlz_id, imt), (indices, counts) in curve_counts.iteritems():
+            try:
+                acc = self.curve_counts[rlz_id, imt]
+            except KeyError:
+                acc = self.curve_counts[rlz_id, imt] = numpy.zeros(
+                    (len(self.hc.site_collection), counts.shape[1]),
+                    numpy.uint32)
+            acc[indices] += counts
+        self.log_percent()
+
     def post_process(self):
         """
         If requested, perform additional processing of GMFs to produce hazard
@@ -361,10 +611,15 @@ class EventBasedHazardCalculator(general.BaseHazardCalculator):
         if self.hc.hazard_curves_from_gmfs:
             with EnginePerformanceMonitor('generating hazard curves',
                                           self.job.id):
-                self.parallelize(
-                    post_processing.gmf_to_hazard_curve_task,
-                    post_processing.gmf_to_hazard_curve_arg_gen(self.job),
-                    self.log_percent)
+                if self.hc.ground_motion_fields:
+                    self.parallelize(
+                        post_processing.gmf_to_hazard_curve_task,
+                        post_processing.gmf_to_hazard_curve_arg_gen(self.job),
+                        self.log_percent)
+                else:  # the curves were accumulated in the execute phase
+                    post_processing.save_hazard_curves_from_counts(
+                        self.job, self.curve_counts)
+                    self.curve_counts.clear()
 
             # If `mean_hazard_curves` is True and/or `quantile_hazard_curves`
             # has some value (not an empty list), do this additional
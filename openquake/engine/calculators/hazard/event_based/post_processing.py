@@ -21,36 +21,70 @@ will be equal to the `ses_per_logic_tree_path`. The data contained in these
 records can include ground motion values from many ruptures, stored in
 variable length arrays; the quantity is random.
 
-For post-processing, we will need to perform P * R * M queries to the database,
-where P is the number of points in a given calculation, R is the total number
-of tree paths, and M is the number of intensity measure levels defined for the
-hazard curve processing. Each of these queries will give us all of the data we
-need to compute a single hazard curve.
-
-Typical values for P can go from 1 to a few 100,000s. *
-Typical values for R can from 1 few 1,000s. *
-Typical values for M are about 10.
-
-* Considering maximum for both P and R is an extreme case.
-
-P * R * M = 100,000 * 1,000 * 10 = 1 Billion queries, in the extreme case
-
-This could be the target for future optimizations.
+Querying the database for each point, realization and IMT would require
+P * R * M queries, where P is the number of points in a given calculation,
+R is the total number of tree paths, and M is the number of intensity
+measure types. Typical values for P can go from 1 to a few 100,000s,
+typical values for R can go from 1 to a few 1,000s and then in the extreme
+case one could reach 1 billion queries.
+
+Instead, the sites are split in blocks of SITE_BLOCK_SIZE contiguous ids and
+there is a task per block, realization and IMT. Each task reads all the
+relevant GMF records with a single query, streaming them through a
+server-side cursor, computes the number of exceedances of all the sites of
+the block at once and saves the hazard curves with a binary COPY FROM.
+
+If the GMFs are not stored (i.e. `ground_motion_fields` is false) the
+number of exceedances is instead accumulated while computing the GMFs and
+the hazard curves are saved by :func:`save_hazard_curves_from_counts`.
 """
 
-import itertools
 import numpy
 
+from django.db import connections, router
+
 from openquake.hazardlib.imt import from_string
 
+from openquake.engine import writer
+from openquake.engine.calculators.hazard.classical.core import (
+    hazard_curve_data_to_pgcopy, HAZARD_CURVE_DATA_COLUMNS, CURVE_BLOCK_SIZE)
 from openquake.engine.db import models
 from openquake.engine.utils import tasks
 
 
 HAZ_CURVE_DISP_NAME_FMT = 'hazard-curve-rlz-%(rlz)s-%(imt)s'
 
+#: number of sites processed by a single post-processing task
+SITE_BLOCK_SIZE = 1000
+
+#: number of gmf_data rows fetched at once from the server-side cursor
+GMF_ROWS_BLOCK_SIZE = 10000
+
+
+def _create_hazard_curve(job, lt_rlz, raw_imt, imls):
+    """
+    Create and return a :class:`openquake.engine.db.models.HazardCurve`
+    container for the given realization and IMT, with its output.
+    """
+    hc = job.hazard_calculation
+    imt, sa_period, sa_damping = from_string(raw_imt)
+    hc_output = models.Output.objects.create_output(
+        job,
+        HAZ_CURVE_DISP_NAME_FMT % dict(imt=raw_imt, rlz=lt_rlz.id),
+        'hazard_curve')
+
+    # Create the hazard curve "collection":
+    return models.HazardCurve.objects.create(
+        output=hc_output,
+        lt_realization=lt_rlz,
+        investigation_time=hc.investigation_time,
+        imt=imt,
+        imls=imls,
+        sa_period=sa_period,
+        sa_damping=sa_damping)
+
 
-def gmf_to_hazard_curve_arg_gen(job):
+def gmf_to_hazard_curve_arg_gen(job, site_block_size=SITE_BLOCK_SIZE):
     """
     Generate a sequence of args for the GMF to hazard curve post-processing job
     for a given ``job``. These are task args.
@@ -58,7 +92,7 @@ def gmf_to_hazard_curve_arg_gen(job):
     Yielded arguments are as follows:
 
     * job ID
-    * point geometry
+    * site ids range, i.e. a pair (min_id, max_id)
     * logic tree realization ID
     * IMT
     * IMLs
@@ -77,9 +111,15 @@ def gmf_to_hazard_curve_arg_gen(job):
 
     :param job:
         :class:`openquake.engine.db.models.OqJob` instance.
+    :param site_block_size:
+        the maximum number of sites per task
     """
     hc = job.hazard_calculation
-    sites = models.HazardSite.objects.filter(hazard_calculation=hc)
+    site_ids = list(models.HazardSite.objects.filter(
+        hazard_calculation=hc).order_by('id').values_list('id', flat=True))
+    site_ranges = [
+        (site_ids[i], site_ids[min(i + site_block_size, len(site_ids)) - 1])
+        for i in xrange(0, len(site_ids), site_block_size)]
 
     lt_realizations = models.LtRealization.objects.filter(
         lt_model__hazard_calculation=hc.id)
@@ -91,41 +131,82 @@ def gmf_to_hazard_curve_arg_gen(job):
         imt, sa_period, sa_damping = from_string(raw_imt)
 
         for lt_rlz in lt_realizations:
-            hc_output = models.Output.objects.create_output(
-                job,
-                HAZ_CURVE_DISP_NAME_FMT % dict(imt=raw_imt, rlz=lt_rlz.id),
-                'hazard_curve')
-
-            # Create the hazard curve "collection":
-            hc_coll = models.HazardCurve.objects.create(
-                output=hc_output,
-                lt_realization=lt_rlz,
-                investigation_time=invest_time,
-                imt=imt,
-                imls=imls,
-                sa_period=sa_period,
-                sa_damping=sa_damping)
-
-            for site in sites:
-                yield (job.id, site, lt_rlz.id, imt, imls, hc_coll.id,
+            hc_coll = _create_hazard_curve(job, lt_rlz, raw_imt, imls)
+            for site_range in site_ranges:
+                yield (job.id, site_range, lt_rlz.id, imt, imls, hc_coll.id,
                        invest_time, duration, sa_period, sa_damping)
 
 
+def _gmf_data_blocks(lt_rlz_id, imt, sa_period, sa_damping, site_range):
+    """
+    Yield blocks of rows (site_id, gmvs) from the gmf_data table, ordered
+    by site, by using a server-side cursor, so that the GMF records
+    are never read entirely in memory.
+    """
+    alias = router.db_for_read(models.GmfData)
+    connections[alias].cursor()  # make sure the connection is open
+    curs = connections[alias].connection.cursor('gmf_data_cursor')
+    try:
+        curs.execute("""\
+SELECT a.site_id, a.gmvs FROM hzrdr.gmf_data AS a, hzrdr.gmf AS b
+WHERE a.gmf_id = b.id AND b.lt_realization_id = %s AND a.imt = %s
+AND a.sa_period IS NOT DISTINCT FROM %s
+AND a.sa_damping IS NOT DISTINCT FROM %s
+AND a.site_id BETWEEN %s AND %s ORDER BY a.site_id""",
+                     (lt_rlz_id, imt, sa_period, sa_damping) +
+                     tuple(site_range))
+        while True:
+            rows = curs.fetchmany(GMF_ROWS_BLOCK_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        curs.close()
+
+
+def count_exceedances(site_idx, gmvs, imls, n_sites):
+    """
+    Count, for each site and intensity measure level, the number of ground
+    motion values greater or equal than the level, with the same semantics
+    of :func:`gmvs_to_haz_curve`.
+
+    :param site_idx:
+        an array of site indices in the range 0 .. n_sites - 1,
+        one per ground motion value
+    :param gmvs:
+        an array of ground motion values
+    :param imls:
+        a list of intensity measure levels
+    :param n_sites:
+        the total number of sites
+    :returns:
+        an integer array of shape (n_sites, len(imls))
+    """
+    counts = numpy.zeros((n_sites, len(imls)), int)
+    for j, iml in enumerate(imls):
+        counts[:, j] = numpy.bincount(
+            site_idx[gmvs >= iml], minlength=n_sites)
+    return counts
+
+
 # Disabling "Unused argument 'job_id'" (this parameter is required by @oqtask):
 # pylint: disable=W0613
 @tasks.oqtask
-def gmf_to_hazard_curve_task(job_id, site, lt_rlz_id, imt, imls, hc_coll_id,
-                             invest_time, duration, sa_period=None,
-                             sa_damping=None):
+def gmf_to_hazard_curve_task(job_id, site_range, lt_rlz_id, imt, imls,
+                             hc_coll_id, invest_time, duration,
+                             sa_period=None, sa_damping=None):
     """
-    For a given job, site, realization, and IMT, compute a hazard curve and
-    save it to the database. The hazard curve will be computed from all
-    available ground motion data for the specified site and realization.
+    For a given job, block of sites, realization, and IMT, compute the hazard
+    curves and save them to the database. The hazard curves will be computed
+    from all available ground motion data for the specified sites and
+    realization.
 
     :param int job_id:
         ID of a currently running :class:`openquake.engine.db.models.OqJob`.
-    :param site:
-        A :class:`openquake.engine.db.models.HazardSite` instance.
+    :param site_range:
+        A pair (min_id, max_id) of
+        :class:`openquake.engine.db.models.HazardSite` IDs; the extremes
+        are included.
     :param int lt_rlz_id:
         ID of a :class:`openquake.engine.db.models.LtRealization` for the
         current calculation.
@@ -157,20 +238,63 @@ def gmf_to_hazard_curve_task(job_id, site, lt_rlz_id, imt, imls, hc_coll_id,
         Spectral Acceleration damping. Used only with ``imt`` of 'SA'.
     """
     lt_rlz = models.LtRealization.objects.get(id=lt_rlz_id)
-    gmfs = models.GmfData.objects.filter(
-        gmf__lt_realization=lt_rlz_id,
-        imt=imt,
-        sa_period=sa_period,
-        sa_damping=sa_damping,
-        site=site)
-    gmvs = list(itertools.chain(*(g.gmvs for g in gmfs)))
+    min_id, max_id = site_range
+    sites = models.HazardSite.objects.filter(
+        hazard_calculation=lt_rlz.lt_model.hazard_calculation_id,
+        id__gte=min_id, id__lte=max_id).order_by('id')
+    site_ids = numpy.array([site.id for site in sites])
+    lons = numpy.array([site.location.x for site in sites])
+    lats = numpy.array([site.location.y for site in sites])
+
+    counts = numpy.zeros((len(site_ids), len(imls)), int)
+    for rows in _gmf_data_blocks(
+            lt_rlz_id, imt, sa_period, sa_damping, site_range):
+        idx = numpy.searchsorted(site_ids, [sid for sid, _ in rows])
+        site_idx = numpy.repeat(idx, [len(gmvs) for _, gmvs in rows])
+        gmvs = numpy.concatenate([gmvs for _, gmvs in rows])
+        counts += count_exceedances(site_idx, gmvs, imls, len(site_ids))
 
     # Compute the hazard curve PoEs:
-    hc_poes = gmvs_to_haz_curve(gmvs, imls, invest_time, duration)
+    poes = 1 - numpy.exp(- (invest_time / duration) * counts)
     # Save:
-    models.HazardCurveData.objects.create(
-        hazard_curve_id=hc_coll_id, poes=hc_poes, location=site.location,
-        weight=lt_rlz.weight)
+    writer.copy_binary(
+        models.HazardCurveData, HAZARD_CURVE_DATA_COLUMNS,
+        [hazard_curve_data_to_pgcopy(
+            hc_coll_id, lons, lats, poes, lt_rlz.weight)])
+
+
+def save_hazard_curves_from_counts(job, curve_counts):
+    """
+    Save the hazard curves computed from the exceedance counts accumulated
+    while computing the GMFs, for all the realizations and IMTs, with
+    a binary COPY FROM in blocks of sites.
+
+    :param job:
+        :class:`openquake.engine.db.models.OqJob` instance.
+    :param curve_counts:
+        a dictionary (rlz_id, imt) -> array of shape (sites, levels);
+        missing keys correspond to curves with all zero PoEs
+    """
+    hc = job.hazard_calculation
+    mesh = hc.site_collection.mesh
+    invest_time = hc.investigation_time
+    duration = hc.ses_per_logic_tree_path * invest_time
+    lt_realizations = models.LtRealization.objects.filter(
+        lt_model__hazard_calculation=hc.id)
+    for raw_imt, imls in hc.intensity_measure_types_and_levels.iteritems():
+        for lt_rlz in lt_realizations:
+            hc_coll = _create_hazard_curve(job, lt_rlz, raw_imt, imls)
+            counts = curve_counts.get((lt_rlz.id, from_string(raw_imt)))
+            if counts is None:
+                counts = numpy.zeros((len(mesh), len(imls)))
+            poes = 1 - numpy.exp(- (invest_time / duration) * counts)
+            for i in xrange(0, len(poes), CURVE_BLOCK_SIZE):
+                block = slice(i, i + CURVE_BLOCK_SIZE)
+                writer.copy_binary(
+                    models.HazardCurveData, HAZARD_CURVE_DATA_COLUMNS,
+                    [hazard_curve_data_to_pgcopy(
+                        hc_coll.id, mesh.lons[block], mesh.lats[block],
+                        poes[block], lt_rlz.weight)])
 
 
 def gmvs_to_haz_curve(gmvs, imls, invest_time, duration):
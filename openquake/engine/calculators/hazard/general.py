@@ -60,6 +60,11 @@ POES_PARAM_NAME = "POES"
 # 1e-5 represents the approximate distance of one meter at the equator.
 DILATION_ONE_METER = 1e-5
 
+#: Maximum number of source timings used to fit the cost model
+MAX_TIMINGS = 100000
+
+source_timings = writer.CacheInserter(models.SourceTiming, 1000)
+
 
 def store_site_model(job, site_model_source):
     """Invoke site model parser and save the site-specified parameter data to
@@ -83,6 +88,45 @@ def store_site_model(job, site_model_source):
     return writer.CacheInserter.saveall(data)
 
 
+def save_source_timing(job_id, task, src, num_ruptures, num_sites,
+                       num_gsims, calc_time):
+    """
+    Store the time spent by a task on a source, to be used later
+    to calibrate the cost model of the sources. All the calculators
+    must use the same definitions, since the time per site and per GSIM
+    is what is fitted; the timings of different tasks are fitted
+    separately anyway (see :func:`fit_cost_model`).
+
+    :param int job_id: the ID of the current job
+    :param task: the task function computing the source
+    :param src: a hazardlib source
+    :param int num_ruptures: the number of ruptures generated by the source
+    :param int num_sites:
+        the largest number of sites affected by a rupture of the source
+    :param int num_gsims:
+        the number of GSIM evaluations per rupture and site
+    :param float calc_time: the time spent on the source, in seconds
+    """
+    source_timings.add(models.SourceTiming(
+        oq_job_id=job_id, task=task.__name__,
+        source_class=src.__class__.__name__, num_ruptures=num_ruptures,
+        num_sites=num_sites, num_gsims=num_gsims, calc_time=calc_time))
+
+
+def fit_cost_model(task_name):
+    """
+    Fit a cost model for the sources on the most recent timings
+    stored by the given task.
+
+    :param str task_name: the name of a task, like 'compute_hazard_curves'
+    :returns: a :class:`openquake.engine.input.source.CostModel` instance
+    """
+    timings = models.SourceTiming.objects.filter(task=task_name).order_by(
+        '-id').values_list('source_class', 'num_ruptures', 'num_sites',
+                           'num_gsims', 'calc_time')[:MAX_TIMINGS]
+    return source.CostModel.fit(timings)
+
+
 def im_dict_to_hazardlib(im_dict):
     """
     Given the dict of intensity measure types and levels, convert them to a
@@ -167,6 +211,23 @@ class BaseHazardCalculator(base.Calculator):
         """
         return int(config.get('hazard', 'concurrent_tasks'))
 
+    def get_cost_model(self):
+        """
+        Return the cost model used to weight the sources: if the flag
+        `calibrate_source_weights` is set in the configuration file, the
+        model is fitted on the timings of the previous computations,
+        otherwise the default heuristic is used.
+        """
+        if not config.flag_set('hazard', 'calibrate_source_weights'):
+            return source.CostModel()
+        cost_model = fit_cost_model(self.core_calc_task.__name__)
+        for src_cls, (num_timings, rms) in cost_model.fitted.iteritems():
+            coeff, exponent = cost_model.get_params(src_cls)
+            logs.LOG.info('Fitted %s on %d timings: weight = %s * '
+                          'num_ruptures ** %.3f, rms=%.3f', src_cls,
+                          num_timings, coeff, exponent, rms)
+        return cost_model
+
     def task_arg_gen(self):
         """
         Loop through realizations and sources to generate a sequence of
@@ -178,8 +239,10 @@ class BaseHazardCalculator(base.Calculator):
         Override this in subclasses as necessary.
         """
         task_no = 0
-        sitecol = self.hc.site_collection
+        # the site collection and the gsims are shared by many tasks
+        sitecol = tasks.broadcast(self.job.id, self.hc.site_collection)
         for lt_model, trt, gsim_by_rlz in self.gen_gsim_by_trt():
+            gsim_by_rlz = tasks.broadcast(self.job.id, gsim_by_rlz)
             ltpath = tuple(lt_model.sm_lt_path)
             for block in self.source_blocks_per_ltpath[ltpath, trt]:
                 yield (self.job.id, sitecol, block, lt_model,
@@ -236,6 +299,7 @@ class BaseHazardCalculator(base.Calculator):
         self.smlt = logictree.SourceModelLogicTree(
             file(smlt_file).read(), self.hc.base_path, smlt_file)
         sm_paths = list(self.smlt.get_sm_paths())
+        self.cost_model = self.get_cost_model()
         nblocks = ceil(config.get('hazard', 'concurrent_tasks'), len(sm_paths))
 
         # here we are doing a full enumeration of the source model logic tree;
@@ -250,7 +314,7 @@ class BaseHazardCalculator(base.Calculator):
                 fname,
                 self.hc.sites_affected_by,
                 self.smlt.make_apply_uncertainties(path),
-                self.hc)
+                self.hc, self.cost_model)
             if not source_collector.source_weights:
                 raise RuntimeError(
                     'Could not find sources close to the sites in %s '
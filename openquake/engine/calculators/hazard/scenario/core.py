@@ -30,7 +30,7 @@ from openquake.hazardlib.imt import from_string
 import openquake.hazardlib.gsim
 
 from openquake.engine.calculators.hazard import general as haz_general
-from openquake.engine.utils import tasks
+from openquake.engine.utils import config, tasks
 from openquake.engine.db import models
 from openquake.engine.input import source
 from openquake.engine import writer
@@ -68,7 +68,7 @@ def compute_gmfs(job_id, sites, rupture, gmf_id, realizations):
     :param realizations:
         Number of realizations to create.
     """
-    hc = models.HazardCalculation.objects.get(oqjob=job_id)
+    hc = tasks.get_calculation(job_id)
     imts = [from_string(x) for x in hc.intensity_measure_types]
     gsim = AVAILABLE_GSIMS[hc.gsim]()  # instantiate the GSIM class
     correlation_model = haz_general.get_correl_model(hc)
@@ -92,6 +92,23 @@ def save_gmf(gmf_id, gmf_dict, sites, task_no):
     :param sites:
         An :class:`openquake.hazardlib.site.SiteCollection` object
     """
+    if config.flag_set('hazard', 'scenario_gmf_matrix'):
+        # a single compressed blob per IMT with all the sites of the task
+        inserter = writer.CacheInserter(models.GmfMatrix, 10)
+        site_ids = list(sites.sids)
+        for imt, gmfs_ in gmf_dict.iteritems():
+            imt_name, sa_period, sa_damping = imt
+            inserter.add(models.GmfMatrix(
+                gmf_id=gmf_id,
+                task_no=task_no,
+                imt=imt_name,
+                sa_period=sa_period,
+                sa_damping=sa_damping,
+                site_ids=site_ids,
+                gmvs=numpy.array(gmfs_)))
+        inserter.flush()
+        return
+
     inserter = writer.CacheInserter(models.GmfData, 100)
     # NB: GmfData may contain large arrays and the cache may become large
 
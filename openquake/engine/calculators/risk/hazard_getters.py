@@ -230,17 +230,14 @@ class ScenarioGetter(HazardGetter):
     """
     def get_gmvs(self, site_id):
         """
-        :returns: gmvs and ruptures for the given site and IMT
+        :returns: gmvs for the given site and IMT
         """
-        gmvs = []
-        for gmf in models.GmfData.objects.filter(
-                gmf=self.hazard_output.output_container,
-                site=site_id, imt=self.imt_type, sa_period=self.sa_period,
-                sa_damping=self.sa_damping):
-            gmvs.extend(gmf.gmvs)
-            if not gmvs:
-                logs.LOG.warn('No gmvs for site %s, IMT=%s', site_id, self.imt)
-        return gmvs
+        site_ids, gmvs = models.get_gmvs_scenario(
+            self.hazard_output.output_container, self.imt, [site_id])
+        if not len(site_ids):
+            logs.LOG.warn('No gmvs for site %s, IMT=%s', site_id, self.imt)
+            return []
+        return gmvs[0].tolist()
 
     def get_data(self, monitor):
         """
@@ -254,12 +251,19 @@ class ScenarioGetter(HazardGetter):
             site_assets = list(self.assets_gen())
 
         with monitor.copy('getting gmvs and ruptures'):
+            # the gmvs of all the sites are read with a single query
+            site_ids, gmvs = models.get_gmvs_scenario(
+                self.hazard_output.output_container, self.imt,
+                [site_id for site_id, _assets in site_assets])
+            gmvs_by_site = dict(zip(site_ids, gmvs))
             for site_id, assets in site_assets:
                 n_assets = len(assets)
                 all_assets.extend(assets)
-                gmvs = self.get_gmvs(site_id)
-                if gmvs:
-                    array = numpy.array(gmvs)
+                array = gmvs_by_site.get(site_id)
+                if array is None:
+                    logs.LOG.warn(
+                        'No gmvs for site %s, IMT=%s', site_id, self.imt)
+                else:
                     all_gmvs.extend([array] * n_assets)
 
         return all_assets, all_gmvs
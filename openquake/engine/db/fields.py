@@ -18,6 +18,7 @@
 import numpy
 import re
 import zlib
+import struct
 import json
 import cPickle as pickle
 
@@ -25,6 +26,9 @@ from django.utils.encoding import smart_unicode
 from django.contrib.gis import forms
 from django.contrib.gis.db import models as djm
 
+from openquake.hazardlib import geo
+from openquake.hazardlib.geo.mesh import RectangularMesh
+
 #: regex for splitting string lists on whitespace and/or commas
 ARRAY_RE = re.compile(r'[\s,]+')
 
@@ -257,6 +261,183 @@ class GzippedField(djm.Field):
         return zlib.decompress(value)
 
 
+# tags of the surface encodings; a pickle (protocol 2) starts with '\x80'
+PLANAR_SURFACE = '\x01'
+MULTI_SURFACE = '\x02'
+SIMPLE_FAULT_SURFACE = '\x03'
+COMPLEX_FAULT_SURFACE = '\x04'
+FAULT_SURFACE_CLASS = {SIMPLE_FAULT_SURFACE: geo.SimpleFaultSurface,
+                       COMPLEX_FAULT_SURFACE: geo.ComplexFaultSurface}
+
+# mesh_spacing, strike, dip and the corners top left, top right,
+# bottom left, bottom right, each one with lon, lat, depth
+PLANAR_PARAMS = 15
+
+
+def _planar_params(surface):
+    # the parameters of a planar surface as a list of PLANAR_PARAMS floats
+    params = [surface.mesh_spacing, surface.strike, surface.dip]
+    for corner in (surface.top_left, surface.top_right,
+                   surface.bottom_left, surface.bottom_right):
+        params.extend([corner.longitude, corner.latitude, corner.depth])
+    return params
+
+
+def _planar_surface(params):
+    # build a planar surface from an array of PLANAR_PARAMS floats
+    tl, tr, bl, br = [geo.Point(*xyz) for xyz in params[3:].reshape(4, 3)]
+    return geo.PlanarSurface(params[0], params[1], params[2], tl, tr, br, bl)
+
+
+def encode_surface(surface):
+    """
+    Encode a hazardlib surface in a compact binary string: planar surfaces
+    and multi surfaces are stored by their parameters and corners (as
+    float64), simple and complex fault surfaces by their mesh (as float32).
+    Other surfaces are pickled.
+
+    :param surface: a hazardlib surface object
+    :returns: a binary string
+    """
+    if isinstance(surface, geo.PlanarSurface):
+        return PLANAR_SURFACE + numpy.array(
+            _planar_params(surface), numpy.float64).tostring()
+    elif isinstance(surface, geo.MultiSurface) and all(
+            isinstance(s, geo.PlanarSurface) for s in surface.surfaces):
+        params = [_planar_params(s) for s in surface.surfaces]
+        return MULTI_SURFACE + struct.pack('<I', len(params)) + numpy.array(
+            params, numpy.float64).tostring()
+    elif isinstance(surface, geo.SimpleFaultSurface):
+        tag = SIMPLE_FAULT_SURFACE
+    elif isinstance(surface, geo.ComplexFaultSurface):
+        tag = COMPLEX_FAULT_SURFACE
+    else:
+        return pickle.dumps(surface, pickle.HIGHEST_PROTOCOL)
+    mesh = surface.get_mesh()
+    rows, cols = mesh.lons.shape
+    return tag + struct.pack('<II', rows, cols) + numpy.array(
+        [mesh.lons, mesh.lats, mesh.depths], numpy.float32).tostring()
+
+
+class LazySurface(object):
+    """
+    A wrapper over a surface encoded with :func:`encode_surface`. The
+    hazardlib surface is rebuilt only when one of its attributes is
+    accessed, whereas the geometry can be read without rebuilding it.
+
+    :param data: a binary string
+    """
+    def __init__(self, data):
+        self.data = data
+        self._surface = None
+
+    @property
+    def surface(self):
+        """The decoded hazardlib surface (cached)"""
+        if self._surface is None:
+            self._surface = self._decode()
+        return self._surface
+
+    def _decode(self):
+        tag, data = self.data[0], self.data[1:]
+        if tag == PLANAR_SURFACE:
+            return _planar_surface(numpy.fromstring(data, numpy.float64))
+        elif tag == MULTI_SURFACE:
+            params = numpy.fromstring(data[4:], numpy.float64).reshape(
+                -1, PLANAR_PARAMS)
+            return geo.MultiSurface(map(_planar_surface, params))
+        elif tag in FAULT_SURFACE_CLASS:
+            return FAULT_SURFACE_CLASS[tag](RectangularMesh(*self.get_geom()))
+        return pickle.loads(self.data)
+
+    def get_geom(self):
+        """
+        :returns:
+            the triple (lons, lats, depths) with the same conventions of
+            :func:`openquake.engine.db.models.get_geom`, or None if the
+            surface is pickled
+        """
+        tag, data = self.data[0], self.data[1:]
+        if tag == PLANAR_SURFACE:
+            params = numpy.fromstring(data, numpy.float64)
+            return tuple(params[3:].reshape(4, 3).T)
+        elif tag == MULTI_SURFACE:
+            params = numpy.fromstring(data[4:], numpy.float64).reshape(
+                -1, PLANAR_PARAMS)
+            return tuple(params[:, 3:].reshape(-1, 3).T)
+        elif tag in FAULT_SURFACE_CLASS:
+            rows, cols = struct.unpack('<II', data[:8])
+            lons, lats, depths = numpy.fromstring(
+                data[8:], numpy.float32).astype(numpy.float64).reshape(
+                3, rows, cols)
+            return lons, lats, depths
+
+    def __getattr__(self, name):
+        # called only for the attributes not found in the wrapper; the
+        # private and special names are not forwarded, otherwise an
+        # instance built without __init__ (i.e. by pickle or copy)
+        # would recurse on self._surface
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.surface, name)
+
+    def __getstate__(self):
+        # only the encoded surface is pickled, not the decoded one
+        return self.data
+
+    def __setstate__(self, data):
+        self.__init__(data)
+
+
+class SurfaceField(djm.Field):
+    """
+    Field storing a hazardlib surface with :func:`encode_surface`. The
+    value read from the database is a :class:`LazySurface`.
+    """
+
+    __metaclass__ = djm.SubfieldBase
+
+    def db_type(self, _connection):
+        return 'bytea'
+
+    def to_python(self, value):
+        """Wrap the binary string"""
+        if isinstance(value, (buffer, str, bytearray)) and value:
+            return LazySurface(str(value))
+        return value
+
+    def get_prep_value(self, value):
+        """Encode the surface, unless it is already encoded"""
+        if isinstance(value, LazySurface):
+            return bytearray(value.data)
+        return bytearray(encode_surface(value))
+
+
+class CompressedArrayField(djm.Field):
+    """
+    Field storing a numpy array of float32 as a zlib-compressed bytea.
+    The shape is not stored: the values are read back as a flat array.
+    """
+
+    __metaclass__ = djm.SubfieldBase
+
+    def db_type(self, _connection):
+        return 'bytea'
+
+    def to_python(self, value):
+        """Decompress the value, unless it is already an array"""
+        if value is None or isinstance(value, numpy.ndarray):
+            return value
+        return numpy.fromstring(zlib.decompress(str(value)), numpy.float32)
+
+    def get_prep_value(self, value):
+        """Convert the value into float32 and compress it"""
+        if value is None:
+            return
+        return bytearray(zlib.compress(
+            numpy.asarray(value, numpy.float32).tostring()))
+
+
 class DictField(PickleField):
     """Field for storing Python `dict` objects (or a JSON text representation.
     """
@@ -46,6 +46,7 @@ from openquake.hazardlib.site import Site, SiteCollection
 
 from openquake.engine.db import fields
 from openquake.engine import writer
+from openquake.engine.utils.spatial import SiteIndex
 
 # source prefiltering is enabled for #sites <= FILTERING_THRESHOLD
 FILTERING_THRESHOLD = 10000
@@ -331,11 +332,31 @@ class Performance(djm.Model):
     duration = djm.FloatField(null=True)
     pymemory = djm.IntegerField(null=True)
     pgmemory = djm.IntegerField(null=True)
+    # bytes transferred, before and after the compression
+    uncompressed_size = djm.IntegerField(null=True)
+    compressed_size = djm.IntegerField(null=True)
 
     class Meta:
         db_table = 'uiapi\".\"performance'
 
 
+class SourceTiming(djm.Model):
+    '''
+    Contains the time spent by a task on a source, together with the
+    source typology and the numbers of ruptures, sites and GSIMs.
+    '''
+    oq_job = djm.ForeignKey('OqJob')
+    task = djm.TextField(null=False)
+    source_class = djm.TextField(null=False)
+    num_ruptures = djm.IntegerField(null=False)
+    num_sites = djm.IntegerField(null=False)
+    num_gsims = djm.IntegerField(null=False)
+    calc_time = djm.FloatField(null=False)
+
+    class Meta:
+        db_table = 'uiapi\".\"source_timing'
+
+
 class JobStats(djm.Model):
     '''
     Capture various statistics about a job.
@@ -848,14 +869,18 @@ class HazardCalculation(djm.Model):
 
         :param sources: a sequence of sources
         :param monitor: a Monitor object
+        :param site_coll: a SiteCollection instance
         """
         filtsources_mon = monitor.copy('filtering sources')
         genruptures_mon = monitor.copy('generating ruptures')
         filtruptures_mon = monitor.copy('filtering ruptures')
+        if self.maximum_distance:
+            with filtsources_mon:
+                index = SiteIndex(site_coll)
         for src in sources:
             with filtsources_mon:
-                s_sites = src.filter_sites_by_distance_to_source(
-                    self.maximum_distance, site_coll
+                s_sites = index.filter_sites_by_distance_to_source(
+                    src, self.maximum_distance
                 ) if self.maximum_distance else site_coll
                 if s_sites is None:
                     continue
@@ -867,10 +892,9 @@ class HazardCalculation(djm.Model):
 
             for rupture in ruptures:
                 with filtruptures_mon:
-                    r_sites = rupture.source_typology.\
-                        filter_sites_by_distance_to_rupture(
-                            rupture, self.maximum_distance, s_sites
-                        ) if self.maximum_distance else s_sites
+                    r_sites = index.filter_sites_by_distance_to_rupture(
+                        rupture, self.maximum_distance, s_sites
+                    ) if self.maximum_distance else s_sites
                     if r_sites is None:
                         continue
                 yield SourceRuptureSites(src, rupture, r_sites)
@@ -1584,8 +1608,11 @@ class SES(object):
         """
         Iterator for walking through all child :class:`SESRupture` objects.
         """
+        # same ordering of the tags, without formatting them
         return SESRupture.objects.filter(
-            ses_id=self.ordinal).order_by('tag').iterator()
+            ses_id=self.ordinal).select_related('rupture').order_by(
+            'rupture__ses_collection__ordinal', 'rupture__source_id',
+            'event_key').iterator()
 
 
 def is_from_fault_source(rupture):
@@ -1700,13 +1727,14 @@ class ProbabilisticRupture(djm.Model):
     tectonic_region_type = djm.TextField(null=False)
     is_from_fault_source = djm.NullBooleanField(null=False)
     is_multi_surface = djm.NullBooleanField(null=False)
-    surface = fields.PickleField(null=False)
+    surface = fields.SurfaceField(null=False)
+    source_id = djm.TextField(null=False)
 
     class Meta:
         db_table = 'hzrdr\".\"probabilistic_rupture'
 
     @classmethod
-    def create(cls, rupture, ses_collection):
+    def create(cls, rupture, ses_collection, source_id):
         """
         Create a ProbabilisticRupture row on the database.
 
@@ -1714,17 +1742,37 @@ class ProbabilisticRupture(djm.Model):
             a hazardlib rupture
         :param ses_collection:
             a Stochastic Event Set Collection object
+        :param str source_id:
+            id of the source that generated the rupture
+        """
+        prob_rupture = cls.build(rupture, ses_collection, source_id)
+        prob_rupture.save(force_insert=True)
+        return prob_rupture
+
+    @classmethod
+    def build(cls, rupture, ses_collection, source_id, id=None):
+        """
+        Build a ProbabilisticRupture object without saving it, so that
+        it can be saved later in bulk.
+
+        :param rupture:
+            a hazardlib rupture
+        :param ses_collection:
+            a Stochastic Event Set Collection object
+        :param str source_id:
+            id of the source that generated the rupture
+        :param id:
+            a reserved id or None
         """
-        iffs = is_from_fault_source(rupture)
-        ims = is_multi_surface(rupture)
-        lons, lats, depths = get_geom(rupture.surface, iffs, ims)
-        return cls.objects.create(
+        return cls(
+            id=id,
             ses_collection=ses_collection,
+            source_id=source_id,
             magnitude=rupture.mag,
             rake=rupture.rake,
             tectonic_region_type=rupture.tectonic_region_type,
-            is_from_fault_source=iffs,
-            is_multi_surface=ims,
+            is_from_fault_source=is_from_fault_source(rupture),
+            is_multi_surface=is_multi_surface(rupture),
             surface=rupture.surface,
             hypocenter=rupture.hypocenter.wkt2d)
 
@@ -1734,12 +1782,16 @@ class ProbabilisticRupture(djm.Model):
     def geom(self):
         """
         Extract the triple (lons, lats, depths) from the surface geometry
-        (cached).
+        (cached). If the surface comes from the database, the geometry is
+        read directly from its encoding, without rebuilding the surface.
         """
         if self._geom is not None:
             return self._geom
-        self._geom = get_geom(self.surface, self.is_from_fault_source,
-                              self.is_multi_surface)
+        if isinstance(self.surface, fields.LazySurface):
+            self._geom = self.surface.get_geom()
+        if self._geom is None:
+            self._geom = get_geom(self.surface, self.is_from_fault_source,
+                                  self.is_multi_surface)
         return self._geom
 
     @property
@@ -1805,42 +1857,136 @@ class ProbabilisticRupture(djm.Model):
         return None
 
 
+# the fields packed in an event key, from the most significant, and their
+# number of bits; the limits are checked before the event based calculation
+# starts for the source model and SES ordinals
+EVENT_KEY_BITS = (12, 16, 24, 11)
+EVENT_KEY_FIELDS = ('source model ordinal', 'SES ordinal', 'rupture number',
+                    'occurrence number')
+
+
+def get_event_key(smlt_ordinal, ses_ordinal, rupt_no, rupt_occ):
+    """
+    Pack the given ordinals in a 63 bit integer, with the bit sizes in
+    EVENT_KEY_BITS. The ordering of the keys is the ordering of the
+    tuples (smlt_ordinal, ses_ordinal, rupt_no, rupt_occ).
+
+    :returns: a non negative integer
+    """
+    key = 0
+    for name, value, nbits in zip(
+            EVENT_KEY_FIELDS, (smlt_ordinal, ses_ordinal, rupt_no, rupt_occ),
+            EVENT_KEY_BITS):
+        if not 0 <= value < 2 ** nbits:
+            raise ValueError(
+                'Cannot store the %s %d in the event key: the maximum is %d'
+                % (name, value, 2 ** nbits - 1))
+        key = (key << nbits) | value
+    return key
+
+
+def split_event_key(key):
+    """
+    Inverse of :func:`get_event_key`.
+
+    :returns: a tuple (smlt_ordinal, ses_ordinal, rupt_no, rupt_occ)
+    """
+    values = []
+    for nbits in reversed(EVENT_KEY_BITS):
+        values.append(key & (2 ** nbits - 1))
+        key >>= nbits
+    return tuple(reversed(values))
+
+
+def get_tag(key, source_id):
+    """
+    Build the tag identifying a rupture occurrence in the exported files
+    from its event key and source ID.
+    """
+    smlt_ordinal, ses_ordinal, rupt_no, rupt_occ = split_event_key(key)
+    return 'smlt=%02d|ses=%04d|src=%s|rup=%03d-%02d' % (
+        smlt_ordinal, ses_ordinal, source_id, rupt_no, rupt_occ)
+
+
+def get_tag_sql(key, source_id):
+    """
+    SQL version of :func:`get_tag`, for the queries which cannot post-process
+    the rows in Python, like the COPY TO exporting the SES to the platform.
+
+    :param key: the SQL expression of the event key
+    :param source_id: the SQL expression of the source ID
+    :returns: a SQL expression building the tag
+    """
+    fields = []
+    shift = sum(EVENT_KEY_BITS)
+    for nbits in EVENT_KEY_BITS:
+        shift -= nbits
+        fields.append('(((%s) >> %d) & %d)' % (key, shift, 2 ** nbits - 1))
+
+    def zero_pad(expr, width):
+        # like '%0<width>d', longer numbers are not truncated
+        return "repeat('0', %d - length((%s)::text)) || (%s)::text" % (
+            width, expr, expr)
+    return ("'smlt=' || %s || '|ses=' || %s || '|src=' || (%s) || "
+            "'|rup=' || %s || '-' || %s" % (
+                zero_pad(fields[0], 2), zero_pad(fields[1], 4), source_id,
+                zero_pad(fields[2], 3), zero_pad(fields[3], 2)))
+
+
 class SESRupture(djm.Model):
     """
     A rupture as part of a Stochastic Event Set.
     """
     rupture = djm.ForeignKey('ProbabilisticRupture')
     ses_id = djm.IntegerField(null=False)
-    tag = djm.TextField(null=False)
+    event_key = djm.BigIntegerField(null=False)
     seed = djm.IntegerField(null=False)
 
     class Meta:
         db_table = 'hzrdr\".\"ses_rupture'
-        ordering = ['tag']
+        ordering = ['event_key']
+
+    @classmethod
+    def create(cls, prob_rupture, ses, rupt_no, rupt_occ, seed):
+        """
+        Create a SESRupture row in the database; the parameters are
+        the same of :meth:`SESRupture.build`.
+        """
+        ses_rupture = cls.build(prob_rupture, ses, rupt_no, rupt_occ, seed)
+        ses_rupture.save(force_insert=True)
+        return ses_rupture
 
     @classmethod
-    def create(cls, prob_rupture, ses, source_id, rupt_no, rupt_occ, seed):
+    def build(cls, prob_rupture, ses, rupt_no, rupt_occ, seed, id=None):
         """
-        Create a SESRupture row in the database.
+        Build a SESRupture object without saving it, so that it can
+        be saved later in bulk.
 
         :param prob_rupture:
             :class:`openquake.engine.db.models.ProbabilisticRupture` instance
         :param ses:
             :class:`openquake.engine.db.models.SES` instance
-        :param str source_id:
-            id of the source that generated the rupture
         :param rupt_no:
             the rupture number (an ordinal from source.iter_ruptures())
         :param rupt_occ:
             the occurrence number of the rupture in the given ses
         :param int seed:
             a seed that will be used when computing the GMF from the rupture
+        :param id:
+            a reserved id or None
         """
-        tag = 'smlt=%02d|ses=%04d|src=%s|rup=%03d-%02d' % (
-            ses.ses_collection.ordinal, ses.ordinal, source_id, rupt_no,
-            rupt_occ)
-        return cls.objects.create(
-            rupture=prob_rupture, ses_id=ses.ordinal, tag=tag, seed=seed)
+        event_key = get_event_key(
+            ses.ses_collection.ordinal, ses.ordinal, rupt_no, rupt_occ)
+        return cls(id=id, rupture=prob_rupture, ses_id=ses.ordinal,
+                   event_key=event_key, seed=seed)
+
+    @property
+    def tag(self):
+        """
+        The tag of the rupture occurrence, built from the event key and
+        the source ID; it is used only in the exported files.
+        """
+        return get_tag(self.event_key, self.rupture.source_id)
 
 
 class _Point(object):
@@ -1891,8 +2037,10 @@ class Gmf(djm.Model):
         for ses_coll in SESCollection.objects.filter(
                 output__oq_job=self.output.oq_job):
             for ses in ses_coll:
+                # the ordering by source_id and event_key is the
+                # ordering by tag within a SES
                 query = """
-        SELECT imt, sa_period, sa_damping, tag,
+        SELECT imt, sa_period, sa_damping, event_key, source_id,
                array_agg(gmv) AS gmvs,
                array_agg(ST_X(location::geometry)) AS xs,
                array_agg(ST_Y(location::geometry)) AS ys
@@ -1900,18 +2048,22 @@ class Gmf(djm.Model):
              unnest(rupture_ids) as rupture_id, location, unnest(gmvs) AS gmv
            FROM hzrdr.gmf_data, hzrdi.hazard_site
             WHERE site_id = hzrdi.hazard_site.id AND hazard_calculation_id=%s
-           AND gmf_id=%d) AS x, hzrdr.ses_rupture AS y
-        WHERE x.rupture_id = y.id AND y.ses_id=%d
-        GROUP BY imt, sa_period, sa_damping, tag
-        ORDER BY imt, sa_period, sa_damping, tag;
+           AND gmf_id=%d) AS x, hzrdr.ses_rupture AS y,
+           hzrdr.probabilistic_rupture AS z
+        WHERE x.rupture_id = y.id AND y.rupture_id = z.id AND y.ses_id=%d
+        GROUP BY imt, sa_period, sa_damping, z.ses_collection_id,
+                 source_id, event_key
+        ORDER BY imt, sa_period, sa_damping, z.ses_collection_id,
+                 source_id, event_key;
         """ % (hc.id, self.id, ses.ordinal)
                 with transaction.commit_on_success(using='job_init'):
                     curs = getcursor('job_init')
                     curs.execute(query)
                 # a set of GMFs generate by the same SES, one per rupture
                 gmfset = []
-                for (imt, sa_period, sa_damping, rupture_tag, gmvs,
+                for (imt, sa_period, sa_damping, event_key, source_id, gmvs,
                      xs, ys) in curs:
+                    rupture_tag = get_tag(event_key, source_id)
                     # using a generator here saves a lot of memory
                     nodes = (_GroundMotionFieldNode(gmv, _Point(x, y))
                              for gmv, x, y in zip(gmvs, xs, ys))
@@ -2008,6 +2160,81 @@ class GmfData(djm.Model):
         ordering = ['gmf', 'task_no']
 
 
+class GmfMatrix(djm.Model):
+    """
+    The scenario ground motion fields generated by a task for a given IMT,
+    stored as a single compressed matrix of float32 values with a row for
+    each site and a column for each realization.
+    """
+    gmf = djm.ForeignKey('Gmf')
+    task_no = djm.IntegerField(null=False)
+    imt = djm.TextField(choices=IMT_CHOICES)
+    sa_period = djm.FloatField(null=True)
+    sa_damping = djm.FloatField(null=True)
+    site_ids = fields.IntArrayField()
+    gmvs = fields.CompressedArrayField()
+
+    class Meta:
+        db_table = 'hzrdr\".\"gmf_matrix'
+        ordering = ['gmf', 'task_no']
+
+    @property
+    def matrix(self):
+        """
+        The ground motion values as an array of shape (sites, realizations)
+        """
+        return self.gmvs.reshape(len(self.site_ids), -1)
+
+
+def get_gmvs_scenario(gmf, imt, site_ids=None):
+    """
+    Extract the scenario ground motion values for the given IMT, either
+    from the :class:`GmfMatrix` records or, if there are none, from the
+    :class:`GmfData` records (one per site).
+
+    :param gmf: a :class:`Gmf` instance
+    :param str imt: a string with the IMT to extract
+    :param site_ids: a sequence of site IDs, or None for all the sites
+    :returns:
+        a pair (site_ids, gmvs) where site_ids is a sorted array of the
+        site IDs with data and gmvs an array of shape (sites, realizations)
+    """
+    imt_type, sa_period, sa_damping = from_string(imt)
+    if site_ids is not None:
+        site_ids = numpy.unique(numpy.array(site_ids, int))
+    sids = []
+    rows = []
+    matrices = GmfMatrix.objects.filter(
+        gmf=gmf, imt=imt_type, sa_period=sa_period, sa_damping=sa_damping)
+    if site_ids is not None:  # read only the matrices with some sites
+        matrices = matrices.extra(
+            where=['site_ids && %s::int[]'], params=[site_ids.tolist()])
+    for gmf_matrix in matrices:
+        ids = numpy.array(gmf_matrix.site_ids)
+        matrix = gmf_matrix.matrix
+        if site_ids is not None:
+            ok = numpy.in1d(ids, site_ids)
+            ids, matrix = ids[ok], matrix[ok]
+        sids.append(ids)
+        rows.append(matrix)
+    if not sids:  # row-wise storage
+        data = GmfData.objects.filter(
+            gmf=gmf, imt=imt_type, sa_period=sa_period, sa_damping=sa_damping)
+        if site_ids is not None:
+            data = data.filter(site__in=site_ids.tolist())
+        gmvs_by_site = collections.defaultdict(list)
+        for gmf_data in data:
+            gmvs_by_site[gmf_data.site_id].extend(gmf_data.gmvs)
+        if not gmvs_by_site:
+            return numpy.zeros(0, int), numpy.zeros((0, 0), numpy.float32)
+        sids.append(numpy.array(gmvs_by_site.keys()))
+        rows.append(numpy.array(gmvs_by_site.values()))
+    sids = numpy.concatenate(sids)
+    gmvs = numpy.concatenate(rows)
+    order = numpy.argsort(sids)
+    return sids[order], gmvs[order]
+
+
 def get_gmvs_per_site(output, imt=None, sort=sorted):
     """
     Iterator for walking through all :class:`GmfData` objects associated
@@ -2041,9 +2268,10 @@ def get_gmvs_per_site(output, imt=None, sort=sorted):
 
 def get_gmfs_scenario(output, imt=None):
     """
-    Iterator for walking through all :class:`GmfData` objects associated
-    to a given output. Notice that the fields are ordered according to the
-    location, so it is possible to get reproducible outputs in the test cases.
+    Iterator for walking through the scenario ground motion fields associated
+    to a given output (read with :func:`get_gmvs_scenario`). Notice that the
+    nodes are ordered by ground motion value, so it is possible to get
+    reproducible outputs in the test cases.
 
     :param output: instance of :class:`openquake.engine.db.models.Output`
 
@@ -2056,18 +2284,16 @@ def get_gmfs_scenario(output, imt=None):
     job = output.oq_job
     hc = job.hazard_calculation
     coll = output.gmf
-    if imt is None:
-        imts = [from_string(x) for x in hc.intensity_measure_types]
-    else:
-        imts = [from_string(imt)]
-    for imt, sa_period, sa_damping in imts:
-        nodes = collections.defaultdict(list)  # realization -> gmf_nodes
-        for gmf in GmfData.objects.filter(
-                gmf=coll, imt=imt,
-                sa_period=sa_period, sa_damping=sa_damping):
-            for i, gmv in enumerate(gmf.gmvs):  # i is the realization index
-                nodes[i].append(_GroundMotionFieldNode(gmv, gmf.site.location))
-        for gmf_nodes in nodes.itervalues():
+    imts = hc.intensity_measure_types if imt is None else [imt]
+    for imt_str in imts:
+        imt, sa_period, sa_damping = from_string(imt_str)
+        site_ids, gmvs = get_gmvs_scenario(coll, imt_str)
+        location = dict(HazardSite.objects.filter(
+            id__in=site_ids.tolist()).values_list('id', 'location'))
+        locations = [location[site_id] for site_id in site_ids]
+        for gmvs_rlz in gmvs.T:  # a column for each realization
+            gmf_nodes = [_GroundMotionFieldNode(float(gmv), loc)
+                         for gmv, loc in zip(gmvs_rlz, locations)]
             yield _GroundMotionField(
                 imt=imt,
                 sa_period=sa_period,
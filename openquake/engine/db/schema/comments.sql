@@ -52,6 +52,10 @@ COMMENT ON TABLE hzrdr.hazard_curve_data IS 'Holds location/POE data for hazard
 COMMENT ON COLUMN hzrdr.hazard_curve_data.hazard_curve_id IS 'The foreign key to the hazard curve record for this node.';
 COMMENT ON COLUMN hzrdr.hazard_curve_data.poes IS 'Probabilities of exceedence.';
 
+COMMENT ON TABLE hzrdr.gmf_matrix IS 'Scenario ground motion fields generated by a task for an IMT, stored as a single matrix';
+COMMENT ON COLUMN hzrdr.gmf_matrix.site_ids IS 'The IDs of the hazard sites, one per row of the matrix';
+COMMENT ON COLUMN hzrdr.gmf_matrix.gmvs IS 'zlib-compressed float32 matrix of ground motion values with shape (sites, realizations)';
+
 COMMENT ON TABLE hzrdr.hazard_map IS 'A complete hazard map, for a given IMT and PoE';
 COMMENT ON COLUMN hzrdr.hazard_map.poe IS 'Probability of exceedence';
 COMMENT ON COLUMN hzrdr.hazard_map.statistics IS 'Statistic type, one of:
@@ -142,6 +146,12 @@ COMMENT ON TABLE uiapi.performance IS 'Tracks task performance';
 COMMENT ON COLUMN uiapi.performance.duration IS 'Duration of the operation in seconds';
 COMMENT ON COLUMN uiapi.performance.pymemory IS 'Memory occupation in Python (Mbytes)';
 COMMENT ON COLUMN uiapi.performance.pgmemory IS 'Memory occupation in Postgres (Mbytes)';
+COMMENT ON COLUMN uiapi.performance.uncompressed_size IS 'Bytes transferred before the compression';
+COMMENT ON COLUMN uiapi.performance.compressed_size IS 'Bytes transferred after the compression';
+
+COMMENT ON TABLE uiapi.source_timing IS 'Computation time of each source, per typology, number of ruptures, sites and GSIMs';
+COMMENT ON COLUMN uiapi.source_timing.task IS 'Name of the task computing the source';
+COMMENT ON COLUMN uiapi.source_timing.calc_time IS 'Computation time in seconds';
 
 
 COMMENT ON TABLE uiapi.job_stats IS 'Tracks various job statistics';
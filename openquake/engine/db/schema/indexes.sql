@@ -33,6 +33,7 @@ CREATE INDEX hzrdi_site_model_job_id_idx ON hzrdi.site_model(job_id);
 CREATE INDEX uiapi_performance_oq_job_id_idx ON uiapi.performance(oq_job_id);
 CREATE INDEX uiapi_oq_job_user_name_idx ON uiapi.oq_job(user_name);
 CREATE INDEX uiapi_performance_operation_idx ON uiapi.performance(operation);
+CREATE INDEX uiapi_source_timing_task_idx ON uiapi.source_timing(task);
 
 CREATE INDEX uiapi_oq_job_status_running on uiapi.oq_job(status) WHERE status = 'running';
 
@@ -56,9 +57,8 @@ CREATE INDEX hzrdr_ses_collection_ouput_id_idx on hzrdr.ses_collection(output_id
 CREATE INDEX hzrdr_ses_ses_collection_id_idx on hzrdr.ses(ses_collection_id);
 
 -- ses_rupture
-CREATE UNIQUE INDEX hzrdr_ses_rupture_tag_uniq_idx ON hzrdr.ses_rupture(rupture_id, tag);
+CREATE UNIQUE INDEX hzrdr_ses_rupture_event_key_uniq_idx ON hzrdr.ses_rupture(rupture_id, event_key);
 CREATE INDEX hzrdr_ses_rupture_ses_id_idx on hzrdr.ses_rupture(ses_id);
-CREATE INDEX hzrdr_ses_rupture_tag_idx ON hzrdr.ses_rupture (tag);
 
 -- disagg_result
 CREATE INDEX hzrdr_disagg_result_location_idx on hzrdr.disagg_result using gist(location);
@@ -72,6 +72,9 @@ CREATE INDEX hzrdr_gmf_sa_period_idx on hzrdr.gmf_data(sa_period);
 CREATE INDEX hzrdr_gmf_sa_damping_idx on hzrdr.gmf_data(sa_damping);
 CREATE INDEX hzrdr_gmf_task_no_idx on hzrdr.gmf_data(task_no);
 
+-- gmf_matrix
+CREATE INDEX hzrdr_gmf_matrix_gmf_id_idx on hzrdr.gmf_matrix(gmf_id);
+
 -- riskr indexes
 CREATE INDEX riskr_loss_map_output_id_idx on riskr.loss_map(output_id);
 CREATE INDEX riskr_loss_map_data_loss_map_id_idx on riskr.loss_map_data(loss_map_id);
@@ -113,10 +113,25 @@ CREATE TABLE uiapi.performance (
     operation VARCHAR NOT NULL,
     duration FLOAT,
     pymemory BIGINT,
-    pgmemory BIGINT
+    pgmemory BIGINT,
+    uncompressed_size BIGINT,
+    compressed_size BIGINT
 )  TABLESPACE uiapi_ts;
 
 
+-- Computation time of each source, used to calibrate the source weights
+CREATE TABLE uiapi.source_timing (
+    id SERIAL PRIMARY KEY,
+    oq_job_id INTEGER NOT NULL,
+    task VARCHAR NOT NULL,
+    source_class VARCHAR NOT NULL,
+    num_ruptures INTEGER NOT NULL,
+    num_sites INTEGER NOT NULL,
+    num_gsims INTEGER NOT NULL,
+    calc_time FLOAT NOT NULL
+) TABLESPACE uiapi_ts;
+
+
 -- Tracks various job statistics
 CREATE TABLE uiapi.job_stats (
     id SERIAL PRIMARY KEY,
@@ -403,7 +418,8 @@ CREATE TABLE hzrdr.probabilistic_rupture (
     is_from_fault_source BOOLEAN NOT NULL,
     is_multi_surface BOOLEAN NOT NULL,
     surface BYTEA NOT NULL,
-    magnitude float NOT NULL
+    magnitude float NOT NULL,
+    source_id VARCHAR NOT NULL
 ) TABLESPACE hzrdr_ts;
 SELECT AddGeometryColumn('hzrdr', 'probabilistic_rupture', 'hypocenter', 4326, 'POINT', 2);
 
@@ -412,7 +428,7 @@ CREATE TABLE hzrdr.ses_rupture (
     id SERIAL PRIMARY KEY,
     ses_id INTEGER NOT NULL,
     rupture_id INTEGER NOT NULL,  -- FK to probabilistic_rupture.id
-    tag VARCHAR NOT NULL,
+    event_key BIGINT NOT NULL,
     seed INTEGER NOT NULL
 ) TABLESPACE hzrdr_ts;
 
@@ -446,6 +462,29 @@ CREATE TABLE hzrdr.gmf_data (
     site_id INTEGER NOT NULL -- fk -> hazard_site
 ) TABLESPACE hzrdr_ts;
 
+-- the scenario GMFs generated by a task for an IMT, stored as a single
+-- zlib-compressed float32 matrix with shape (sites, realizations)
+CREATE TABLE hzrdr.gmf_matrix (
+    id SERIAL PRIMARY KEY,
+    gmf_id INTEGER NOT NULL, -- fk -> gmf
+    task_no INTEGER NOT NULL,
+    imt VARCHAR NOT NULL,
+        CONSTRAINT gmf_matrix_imt
+        CHECK(imt in ('PGA', 'PGV', 'PGD', 'SA', 'IA', 'RSD', 'MMI')),
+    sa_period float,
+        CONSTRAINT gmf_matrix_sa_period
+        CHECK(
+            ((imt = 'SA') AND (sa_period IS NOT NULL))
+            OR ((imt != 'SA') AND (sa_period IS NULL))),
+    sa_damping float,
+        CONSTRAINT gmf_matrix_sa_damping
+        CHECK(
+            ((imt = 'SA') AND (sa_damping IS NOT NULL))
+            OR ((imt != 'SA') AND (sa_damping IS NULL))),
+    site_ids int[] NOT NULL,
+    gmvs BYTEA NOT NULL
+) TABLESPACE hzrdr_ts;
+
 
 CREATE TABLE hzrdr.disagg_result (
     id SERIAL PRIMARY KEY,
@@ -887,6 +926,9 @@ FOREIGN KEY (oq_job_id) REFERENCES uiapi.oq_job(id) ON DELETE CASCADE;
 ALTER TABLE uiapi.job_stats ADD CONSTRAINT uiapi_job_stats_oq_job_fk
 FOREIGN KEY (oq_job_id) REFERENCES uiapi.oq_job(id) ON DELETE CASCADE;
 
+ALTER TABLE uiapi.source_timing ADD CONSTRAINT uiapi_source_timing_oq_job_fk
+FOREIGN KEY (oq_job_id) REFERENCES uiapi.oq_job(id) ON DELETE CASCADE;
+
 ALTER TABLE uiapi.output ADD CONSTRAINT uiapi_output_oq_job_fk
 FOREIGN KEY (oq_job_id) REFERENCES uiapi.oq_job(id) ON DELETE CASCADE;
 
@@ -1114,6 +1156,12 @@ FOREIGN KEY (gmf_id)
 REFERENCES hzrdr.gmf(id)
 ON DELETE CASCADE;
 
+ALTER TABLE hzrdr.gmf_matrix
+ADD CONSTRAINT hzrdr_gmf_matrix_gmf_fk
+FOREIGN KEY (gmf_id)
+REFERENCES hzrdr.gmf(id)
+ON DELETE CASCADE;
+
 
 -- this function is used in the performance_view, cannot go in functions.sql
 CREATE FUNCTION maxint(a INTEGER, b INTEGER) RETURNS INTEGER AS $$
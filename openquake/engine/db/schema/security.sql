@@ -76,6 +76,7 @@ GRANT SELECT,INSERT        ON hzrdr.hazard_curve      TO oq_job_init;
 GRANT SELECT,INSERT,UPDATE ON hzrdr.hazard_curve_data TO oq_job_init;
 GRANT SELECT,INSERT        ON hzrdr.gmf               TO oq_job_init;
 GRANT SELECT,INSERT        ON hzrdr.gmf_data          TO oq_job_init;
+GRANT SELECT,INSERT        ON hzrdr.gmf_matrix        TO oq_job_init;
 GRANT SELECT,INSERT        ON hzrdr.disagg_result     TO oq_job_init;
 GRANT SELECT,INSERT,UPDATE ON hzrdr.hazard_map        TO oq_job_init;
 GRANT SELECT,INSERT        ON hzrdr.uhs               TO oq_job_init;
@@ -120,3 +121,4 @@ GRANT SELECT,INSERT        ON uiapi.risk_calculation   TO oq_job_init;
 
 GRANT SELECT,INSERT,UPDATE ON uiapi.output             TO oq_job_init;
 GRANT SELECT,INSERT,DELETE ON uiapi.performance        TO oq_job_init;
+GRANT SELECT,INSERT,DELETE ON uiapi.source_timing      TO oq_job_init;
@@ -0,0 +1,5 @@
+ALTER TABLE uiapi.performance ADD COLUMN uncompressed_size BIGINT;
+ALTER TABLE uiapi.performance ADD COLUMN compressed_size BIGINT;
+
+COMMENT ON COLUMN uiapi.performance.uncompressed_size IS 'Bytes transferred before the compression';
+COMMENT ON COLUMN uiapi.performance.compressed_size IS 'Bytes transferred after the compression';
@@ -0,0 +1,29 @@
+-- computation times per source, used to calibrate the source weights
+CREATE TABLE uiapi.source_timing (
+   id SERIAL PRIMARY KEY,
+   oq_job_id INTEGER NOT NULL,
+   task VARCHAR NOT NULL,
+   source_class VARCHAR NOT NULL,
+   num_ruptures INTEGER NOT NULL,
+   num_sites INTEGER NOT NULL,
+   num_gsims INTEGER NOT NULL,
+   calc_time FLOAT NOT NULL
+) TABLESPACE uiapi_ts;
+
+ALTER TABLE uiapi.source_timing OWNER TO oq_admin;
+
+GRANT SELECT, INSERT, DELETE ON uiapi.source_timing TO oq_job_init;
+GRANT USAGE ON uiapi.source_timing_id_seq TO oq_job_init;
+
+-- uiapi.source_timing -> uiapi.oq_job FK
+ALTER TABLE uiapi.source_timing
+ADD CONSTRAINT uiapi_source_timing_oq_job_fk
+FOREIGN KEY (oq_job_id)
+REFERENCES uiapi.oq_job(id)
+ON DELETE CASCADE;
+
+CREATE INDEX uiapi_source_timing_task_idx ON uiapi.source_timing(task);
+
+COMMENT ON TABLE uiapi.source_timing IS 'Computation time of each source, per typology, number of ruptures, sites and GSIMs';
+COMMENT ON COLUMN uiapi.source_timing.task IS 'Name of the task computing the source';
+COMMENT ON COLUMN uiapi.source_timing.calc_time IS 'Computation time in seconds';
@@ -0,0 +1,32 @@
+-- the source ID is stored once per rupture and not in each tag
+ALTER TABLE hzrdr.probabilistic_rupture ADD COLUMN source_id VARCHAR;
+
+UPDATE hzrdr.probabilistic_rupture AS p SET source_id = s.source_id
+FROM (SELECT DISTINCT ON (rupture_id) rupture_id,
+      substring(tag from 'src=(.*)\|rup=') AS source_id
+      FROM hzrdr.ses_rupture) AS s
+WHERE s.rupture_id = p.id;
+
+UPDATE hzrdr.probabilistic_rupture SET source_id = '' WHERE source_id IS NULL;
+
+ALTER TABLE hzrdr.probabilistic_rupture ALTER COLUMN source_id SET NOT NULL;
+
+-- the tag 'smlt=%02d|ses=%04d|src=%s|rup=%03d-%02d' is replaced by an
+-- integer key packing the smlt ordinal, the ses ordinal, the rupture
+-- number and the occurrence number (see models.get_event_key)
+ALTER TABLE hzrdr.ses_rupture ADD COLUMN event_key BIGINT;
+
+UPDATE hzrdr.ses_rupture SET event_key =
+    (substring(tag from 'smlt=([0-9]+)')::bigint << 51) |
+    (substring(tag from 'ses=([0-9]+)')::bigint << 35) |
+    (substring(tag from 'rup=([0-9]+)-')::bigint << 11) |
+    substring(tag from 'rup=[0-9]+-([0-9]+)$')::bigint;
+
+ALTER TABLE hzrdr.ses_rupture ALTER COLUMN event_key SET NOT NULL;
+
+DROP INDEX hzrdr.hzrdr_ses_rupture_tag_uniq_idx;
+DROP INDEX hzrdr.hzrdr_ses_rupture_tag_idx;
+ALTER TABLE hzrdr.ses_rupture DROP COLUMN tag;
+
+CREATE UNIQUE INDEX hzrdr_ses_rupture_event_key_uniq_idx
+ON hzrdr.ses_rupture(rupture_id, event_key);
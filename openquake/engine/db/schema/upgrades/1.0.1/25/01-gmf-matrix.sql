@@ -0,0 +1,39 @@
+-- the scenario GMFs generated by a task for an IMT, stored as a single
+-- zlib-compressed float32 matrix with shape (sites, realizations)
+CREATE TABLE hzrdr.gmf_matrix (
+    id SERIAL PRIMARY KEY,
+    gmf_id INTEGER NOT NULL, -- fk -> gmf
+    task_no INTEGER NOT NULL,
+    imt VARCHAR NOT NULL,
+        CONSTRAINT gmf_matrix_imt
+        CHECK(imt in ('PGA', 'PGV', 'PGD', 'SA', 'IA', 'RSD', 'MMI')),
+    sa_period float,
+        CONSTRAINT gmf_matrix_sa_period
+        CHECK(
+            ((imt = 'SA') AND (sa_period IS NOT NULL))
+            OR ((imt != 'SA') AND (sa_period IS NULL))),
+    sa_damping float,
+        CONSTRAINT gmf_matrix_sa_damping
+        CHECK(
+            ((imt = 'SA') AND (sa_damping IS NOT NULL))
+            OR ((imt != 'SA') AND (sa_damping IS NULL))),
+    site_ids int[] NOT NULL,
+    gmvs BYTEA NOT NULL
+) TABLESPACE hzrdr_ts;
+
+ALTER TABLE hzrdr.gmf_matrix OWNER TO oq_admin;
+
+GRANT SELECT, INSERT ON hzrdr.gmf_matrix TO oq_job_init;
+GRANT USAGE ON hzrdr.gmf_matrix_id_seq TO oq_job_init;
+
+ALTER TABLE hzrdr.gmf_matrix
+ADD CONSTRAINT hzrdr_gmf_matrix_gmf_fk
+FOREIGN KEY (gmf_id)
+REFERENCES hzrdr.gmf(id)
+ON DELETE CASCADE;
+
+CREATE INDEX hzrdr_gmf_matrix_gmf_id_idx on hzrdr.gmf_matrix(gmf_id);
+
+COMMENT ON TABLE hzrdr.gmf_matrix IS 'Scenario ground motion fields generated by a task for an IMT, stored as a single matrix';
+COMMENT ON COLUMN hzrdr.gmf_matrix.site_ids IS 'The IDs of the hazard sites, one per row of the matrix';
+COMMENT ON COLUMN hzrdr.gmf_matrix.gmvs IS 'zlib-compressed float32 matrix of ground motion values with shape (sites, realizations)';
@@ -39,6 +39,7 @@ from openquake.engine import logs
 from openquake.engine.db import models
 from openquake.engine.job.validation import validate
 from openquake.engine.utils import config, get_calculator_class, general
+from openquake.engine.utils import tasks
 from openquake.engine.celery_node_monitor import CeleryNodeMonitor
 from openquake.engine.writer import CacheInserter
 from openquake.engine.settings import DATABASES
@@ -65,13 +66,15 @@ TERMINATE = general.str2bool(
 def cleanup_after_job(job, terminate):
     """
     Release the resources used by an openquake job.
-    In particular revoke the running tasks (if any).
+    In particular revoke the running tasks (if any) and remove
+    the broadcast store of the job (if any).
 
     :param int job_id: the job id
     :param bool terminate: the celery revoke command terminate flag
     """
     # Using the celery API, terminate and revoke and terminate any running
-    # tasks associated with the current job.
+    # tasks associated with the current job; their ids are stored by
+    # map_reduce when the tasks are sent (see tasks.store_task_ids)
     task_ids = Performance.objects.filter(
         oq_job=job, operation='storing task id', task_id__isnull=False)\
         .values_list('task_id', flat=True)
@@ -83,6 +86,9 @@ def cleanup_after_job(job, terminate):
         celery.task.control.revoke(tid, terminate=terminate)
         logs.LOG.debug('Revoked task %s', tid)
 
+    # remove the objects shared by the tasks of the job, if any
+    tasks.remove_broadcast_store(job.id)
+
 
 def _update_log_record(self, record):
     """
@@ -145,8 +151,9 @@ def job_stats(job):
     curs.execute("select pg_database_size(%s)", (dbname,))
     dbsize = curs.fetchall()[0][0]
 
-    # create job stats, which implicitly records the start time for the job
-    js = models.JobStats.objects.create(oq_job=job)
+    # create job stats, which implicitly records the start time for the job;
+    # a resumed job keeps the stats created in the first run
+    js, _ = models.JobStats.objects.get_or_create(oq_job=job)
     job.is_running = True
     job.save()
     try:
@@ -326,7 +333,7 @@ def _collect_source_model_paths(smlt):
 
 
 # used by bin/openquake
-def run_calc(job, log_level, log_file, exports, job_type):
+def run_calc(job, log_level, log_file, exports, job_type, resume=False):
     """
     Run a calculation.
 
@@ -345,10 +352,15 @@ def run_calc(job, log_level, log_file, exports, job_type):
         supported.
     :param str job_type:
         'hazard' or 'risk'
+    :param bool resume:
+        if True, restore the calculator from its checkpoint and restart
+        from the execute phase
     """
     calc_mode = getattr(job, '%s_calculation' % job_type).calculation_mode
     calculator = get_calculator_class(job_type, calc_mode)(job)
     calc = job.calculation
+    if resume and not calculator.load_checkpoint():
+        raise RuntimeError('No checkpoint found for job %d' % job.id)
 
     # initialize log handlers
     handler = (LogFileHandler(job_type, calc, log_file) if log_file
@@ -357,7 +369,7 @@ def run_calc(job, log_level, log_file, exports, job_type):
     try:
         with job_stats(job):  # run the job
             logs.set_level(log_level)
-            _do_run_calc(job, exports, calculator, job_type)
+            _do_run_calc(job, exports, calculator, job_type, resume)
     finally:
         logging.root.removeHandler(handler)
     return job
@@ -380,7 +392,7 @@ def _switch_to_job_phase(job, job_type, status):
     logs.LOG.progress("%s (%s)", status, job_type)
 
 
-def _do_run_calc(job, exports, calc, job_type):
+def _do_run_calc(job, exports, calc, job_type, resume=False):
     """
     Step through all of the phases of a calculation, updating the job
     status at each phase.
@@ -390,11 +402,15 @@ def _do_run_calc(job, exports, calc, job_type):
     :param list exports:
         a (potentially empty) list of export targets, currently only "xml" is
         supported
+    :param bool resume:
+        if True, skip the pre_execute phase, since the calculator has
+        been restored from a checkpoint
     :returns:
         The input job object when the calculation completes.
     """
-    _switch_to_job_phase(job, job_type, "pre_executing")
-    calc.pre_execute()
+    if not resume:
+        _switch_to_job_phase(job, job_type, "pre_executing")
+        calc.pre_execute()
 
     _switch_to_job_phase(job, job_type, "executing")
     calc.execute()
@@ -410,6 +426,7 @@ def _do_run_calc(job, exports, calc, job_type):
 
     _switch_to_job_phase(job, job_type, "clean_up")
     calc.clean_up()
+    calc.remove_checkpoint()
 
     CacheInserter.flushall()  # flush caches into the db
 
@@ -576,6 +593,40 @@ def run_job(cfg_file, log_level, log_file, exports, hazard_output_id=None,
                          completed_job.risk_calculation.id)
 
 
+def resume_job(job_id, log_level, log_file, exports):
+    """
+    Resume a job interrupted during the execute phase, by restoring its
+    calculator from the last checkpoint: the tasks already completed
+    are not run again.
+
+    :param int job_id:
+        The ID of the :class:`openquake.engine.db.models.OqJob` to resume.
+    :param str log_level:
+        'debug', 'info', 'warn', 'error', or 'critical'
+    :param str log_file:
+        Path to log file.
+    :param list exports:
+        A list of export types requested by the user.
+    """
+    job = models.OqJob.objects.get(id=job_id)
+    if job.status != 'executing':
+        sys.exit('Job %d cannot be resumed, its status is %s' %
+                 (job_id, job.status))
+    hazard = job.hazard_calculation is not None
+    with CeleryNodeMonitor(openquake.engine.no_distribute(), interval=30):
+        if log_file is not None:
+            touch_log_file(log_file)
+        t0 = time.time()
+        completed_job = run_calc(job, log_level, log_file, exports,
+                                 'hazard' if hazard else 'risk', resume=True)
+        duration = time.time() - t0
+        calc_id = completed_job.calculation.id
+        if completed_job.status != 'complete':
+            sys.exit('Calculation %s failed' % calc_id)
+        print_results(calc_id, duration, list_hazard_outputs if hazard
+                      else list_risk_outputs)
+
+
 @django_db.transaction.commit_on_success
 def job_from_file(cfg_file_path, username, log_level, exports,
                   hazard_output_id=None, hazard_calculation_id=None):
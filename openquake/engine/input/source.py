@@ -19,6 +19,7 @@ import copy
 import collections
 from itertools import izip
 
+import numpy
 from shapely import wkt
 
 from openquake.hazardlib import geo
@@ -35,6 +36,18 @@ from openquake.engine.utils.general import SequenceSplitter, ceil
 
 MAX_RUPTURES = 500  # if there are more ruptures, split the source
 
+# the weight of a source is coeff * num_ruptures ** exponent; these are the
+# (coeff, exponent) pairs used when there are no measured timings
+DEFAULT_COST_PARAMS = {
+    'PointSource': (1., 1.),
+    'AreaSource': (1., 1.),  # subclass of PointSource
+    'CharacteristicFaultSource': (50., 1.),
+}
+# giving more than linear weight to the other sources
+DEFAULT_EXPONENT = 1.5
+
+MIN_TIMINGS = 10  # minimum number of timings to fit a source typology
+
 
 class SourceCollector(object):
     """
@@ -583,28 +596,110 @@ def split_source(src, area_source_discretization):
         yield src
 
 
-def get_num_ruptures_weight(src):
+class CostModel(object):
+    """
+    A model for the computational cost of a source, depending on its
+    typology and number of ruptures. The weight of a source is
+    `coeff * num_ruptures ** exponent`, where the pair (coeff, exponent)
+    depends on the source class. By default the heuristic parameters in
+    DEFAULT_COST_PARAMS are used, but they can be fitted on the timings
+    measured in previous computations by using :meth:`fit`.
+
+    :param dict params:
+        a dictionary source class name -> (coeff, exponent) overriding
+        the default parameters
+    """
+    def __init__(self, params=None):
+        self.params = dict(DEFAULT_COST_PARAMS)
+        self.params.update(params or {})
+        self.fitted = {}  # source class name -> (num_timings, rms residual)
+
+    @classmethod
+    def fit(cls, timings, min_timings=MIN_TIMINGS):
+        """
+        Fit the parameters of the model with a least squares fit on the
+        logarithms of the times per site and per GSIM. Only the typologies
+        with at least `min_timings` measurements are fitted. The fitted
+        coefficients are rescaled so that the typology with more
+        measurements keeps its default coefficient, to stay comparable
+        with the typologies using the defaults.
+
+        :param timings:
+            a sequence of tuples (source_class, num_ruptures, num_sites,
+            num_gsims, calc_time)
+        :param int min_timings:
+            the minimum number of measurements needed for a fit
+        :returns:
+            a :class:`CostModel` instance
+        """
+        data = collections.defaultdict(list)
+        for src_cls, num_ruptures, num_sites, num_gsims, calc_time in timings:
+            if num_ruptures > 0 and calc_time > 0:
+                data[src_cls].append(
+                    (num_ruptures, calc_time / (num_sites * num_gsims or 1)))
+        params = {}
+        fitted = {}
+        for src_cls, pairs in data.iteritems():
+            x, y = numpy.log(numpy.array(pairs)).T
+            if len(pairs) < min_timings or len(set(x)) < 2:
+                continue
+            (exponent, logcoeff), residuals = numpy.polyfit(
+                x, y, 1, full=True)[:2]
+            params[src_cls] = (math.exp(logcoeff), exponent)
+            rms = math.sqrt(residuals[0] / len(pairs)) if len(residuals) \
+                else 0.
+            fitted[src_cls] = (len(pairs), rms)
+        if fitted:
+            ref = max(fitted, key=lambda src_cls: fitted[src_cls][0])
+            scale = cls().get_params(ref)[0] / params[ref][0]
+            for src_cls, (coeff, exponent) in params.items():
+                params[src_cls] = (coeff * scale, exponent)
+        model = cls(params)
+        model.fitted = fitted
+        return model
+
+    def get_params(self, src_cls):
+        """
+        :param str src_cls: the name of a source class
+        :returns: the pair (coeff, exponent) for the given source class
+        """
+        return self.params.get(src_cls, (1., DEFAULT_EXPONENT))
+
+    def get_weight(self, src_cls, num_ruptures):
+        """
+        :param str src_cls: the name of a source class
+        :param int num_ruptures: the number of ruptures of the source
+        :returns: the weight of the source
+        """
+        coeff, exponent = self.get_params(src_cls)
+        return coeff * num_ruptures ** exponent
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.params)
+
+
+def get_num_ruptures_weight(src, cost_model=None):
     """
     Compute the weight of a source in a heuristic way. Various experiments show
     that it should be a bit more than linear in the number of ruptures, except
-    for point sources.
+    for point sources. The heuristic can be replaced by a cost model fitted
+    on the measured timings.
 
     :param src:
         an instance of :class:`openquake.hazardlib.source.base.SeismicSource`
+    :param cost_model:
+        a :class:`CostModel` instance; if None, the default one is used
     :returns:
         a pair (num_ruptures, weight)
     """
     num_ruptures = src.count_ruptures()
-    if isinstance(src, source.PointSource):
-        weight = num_ruptures
-    elif isinstance(src, source.CharacteristicFaultSource):
-        weight = num_ruptures * 50
-    else:  # giving more than linear weight to other sources
-        weight = num_ruptures ** 1.5
+    weight = (cost_model or CostModel()).get_weight(
+        src.__class__.__name__, num_ruptures)
     return num_ruptures, weight
 
 
-def parse_source_model_smart(fname, is_relevant, apply_uncertainties, hc):
+def parse_source_model_smart(fname, is_relevant, apply_uncertainties, hc,
+                             cost_model=None):
     """
     Parse a NRML source model and return a SourceCollector instance.
     Notice that:
@@ -622,6 +717,9 @@ def parse_source_model_smart(fname, is_relevant, apply_uncertainties, hc):
     :param hc:
         an object with attributes rupture_mesh_spacing,
         width_of_mfd_bin, area_source_discretization, investigation_time
+    :param cost_model:
+        a :class:`CostModel` instance used to weight the sources;
+        if None, the default one is used
     """
     source_collector = SourceCollector()
     nrml_to_hazardlib = NrmlHazardlibConverter(hc)
@@ -631,10 +729,11 @@ def parse_source_model_smart(fname, is_relevant, apply_uncertainties, hc):
         apply_uncertainties(src)
         if not is_relevant(src):
             continue
-        num_ruptures, weight = get_num_ruptures_weight(src)
+        num_ruptures, weight = get_num_ruptures_weight(src, cost_model)
         if num_ruptures > MAX_RUPTURES:
             for s in split_source(src, hc.area_source_discretization):
-                source_collector.update(s, *get_num_ruptures_weight(s))
+                source_collector.update(
+                    s, *get_num_ruptures_weight(s, cost_model))
         else:
             source_collector.update(src, num_ruptures, weight)
     return source_collector
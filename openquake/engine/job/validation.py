@@ -433,11 +433,9 @@ class EventBasedHazardForm(BaseHazardModelForm):
                                         msg)
                         all_valid = False
 
-                if not hc.ground_motion_fields:
-                    msg = ('`hazard_curves_from_gmfs` requires '
-                           '`ground_motion_fields` to be `true`')
-                    self._add_error('hazard_curves_from_gmfs', msg)
-                    all_valid = False
+                # NB: if `ground_motion_fields` is false the GMFs are
+                # computed anyway, but they are not stored: the hazard
+                # curves are accumulated while computing them
 
         return all_valid
 
@@ -1003,6 +1001,12 @@ def ses_per_logic_tree_path_is_valid(mdl):
     if not sps > 0:
         return False, ['`Stochastic Event Sets Per Sample` '
                        '(ses_per_logic_tree_path) must be > 0']
+    # the SES ordinal is packed in the event keys of the ruptures
+    max_sps = 2 ** models.EVENT_KEY_BITS[1] - 1
+    if sps > max_sps:
+        return False, ['`Stochastic Event Sets Per Sample` '
+                       '(ses_per_logic_tree_path) must be <= %d; increase '
+                       'the investigation_time instead' % max_sps]
     return True, []
 
 
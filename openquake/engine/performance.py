@@ -102,11 +102,6 @@ class EnginePerformanceMonitor(PerformanceMonitor):
     pgpid = None
     pypid = None
 
-    @classmethod
-    def store_task_id(cls, job_id, task):
-        with cls('storing task id', job_id, task, flush=True):
-            pass
-
     @classmethod
     def monitor(cls, method):
         """
@@ -17,8 +17,12 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import struct
+import decimal
 import unittest
 
+import mock
+
 from openquake.engine import writer
 
 from openquake.engine.db.models import GmfData
@@ -82,3 +86,45 @@ class CacheInserterTestCase(unittest.TestCase):
             connection.columns,
             ['gmf_id', 'task_no', 'imt', 'sa_period', 'sa_damping',
              'gmvs', 'rupture_ids', 'site_id'])
+
+    def test_insert_keep_ids(self):
+        cache = CacheInserter(GmfData, 10, keep_ids=True)
+        cache.add(GmfData(id=42, gmf_id=1, imt='PGA', gmvs=[],
+                          rupture_ids=[], site_id=1))
+        cache.flush()
+        connection = writer.connections['job_init']
+        self.assertEqual(
+            connection.data, '42\t1\t\\N\tPGA\t\\N\t\\N\t{}\t{}\t1\n')
+        self.assertEqual(
+            connection.columns,
+            ['id', 'gmf_id', 'task_no', 'imt', 'sa_period', 'sa_damping',
+             'gmvs', 'rupture_ids', 'site_id'])
+
+    def test_flushall_in_creation_order(self):
+        caches = [CacheInserter(GmfData, 10) for _ in range(20)]
+        flushed = []
+        with mock.patch.object(CacheInserter, 'flush',
+                               lambda self: flushed.append(self)):
+            CacheInserter.flushall()
+        self.assertEqual(caches, [c for c in flushed if c in caches])
+
+
+class PgNumericTestCase(unittest.TestCase):
+
+    def test_null(self):
+        self.assertEqual(writer.pg_numeric(None), struct.pack('>i', -1))
+
+    def test_fraction(self):
+        # 0.25 is a single base 10000 digit 2500 with weight -1
+        self.assertEqual(
+            writer.pg_numeric(decimal.Decimal('0.25')),
+            struct.pack('>ihhHhh', 10, 1, -1, 0, 2, 2500))
+
+    def test_integer_and_fraction(self):
+        self.assertEqual(
+            writer.pg_numeric(decimal.Decimal('-12345.678')),
+            struct.pack('>ihhHhhhh', 14, 3, 1, 0x4000, 3, 1, 2345, 6780))
+
+    def test_zero(self):
+        self.assertEqual(writer.pg_numeric(0),
+                         struct.pack('>ihhHh', 8, 0, 0, 0, 0))
@@ -14,9 +14,15 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import time
+import struct
+import shutil
 import getpass
+import tempfile
 import unittest
 
+import mock
 import numpy
 
 from nose.plugins.attrib import attr
@@ -27,6 +33,10 @@ from openquake.engine.tests.utils import helpers
 from openquake.engine.utils.general import WeightedSequence
 
 
+class FakeSource(object):
+    pass
+
+
 class ClassicalHazardCalculatorTestCase(unittest.TestCase):
     """
     Tests for the main methods of the classical hazard calculator.
@@ -42,6 +52,90 @@ class ClassicalHazardCalculatorTestCase(unittest.TestCase):
         calc = core.ClassicalHazardCalculator(job)
         return job, calc
 
+    def test_checkpoint(self):
+        tmpdir = tempfile.mkdtemp()
+        accdir = tempfile.mkdtemp()
+        cfg = {('checkpoint', 'dir'): tmpdir,
+               ('checkpoint', 'interval'): '3600',
+               ('hazard', 'accumulator_dir'): accdir}
+        try:
+            with mock.patch('openquake.engine.utils.config.get',
+                            lambda section, key: cfg.get((section, key))):
+                self.calc.imtls = {'PGA': [.1, .2, .3]}
+                self.calc.curves_by_rlz = core.make_curve_accumulator(
+                    [1], self.calc.imtls, 2)
+                self.calc.curves_by_rlz[1][0][:] = .5
+                self.calc.next_task_no = 5
+                # the interval is not elapsed, nothing is saved
+                self.calc.task_done(0)
+                self.assertFalse(core.ClassicalHazardCalculator(
+                    self.job).load_checkpoint())
+                self.calc.task_done(3)
+                self.calc.save_checkpoint(force=True)
+                self.calc.save_checkpoint(force=True)
+                # the accumulator is not pickled, and the data files of
+                # the previous checkpoint are removed
+                self.assertEqual(2, len(os.listdir(tmpdir)))
+
+                calc = core.ClassicalHazardCalculator(self.job)
+                self.assertTrue(calc.load_checkpoint())
+                self.assertEqual(calc.completed_tasks, set([0, 3]))
+                self.assertEqual(calc.next_task_no, 5)
+                self.assertEqual([1], calc.curves_by_rlz.keys())
+                # the accumulator is still memory-mapped
+                self.assertIsInstance(calc.curves_by_rlz[1][0], numpy.memmap)
+                numpy.testing.assert_equal(
+                    calc.curves_by_rlz[1][0], numpy.ones((2, 3)) * .5)
+                args = [(self.job.id, i) for i in range(5)]
+                self.assertEqual([1, 2, 4], [a[-1] for a in
+                                             calc.tasks_todo(args)])
+
+                calc.remove_checkpoint()
+                self.assertEqual(os.listdir(tmpdir), [])
+        finally:
+            shutil.rmtree(tmpdir)
+            shutil.rmtree(accdir)
+
+    def test_checkpoint_tiles(self):
+        # the partial curves of a tile are not saved
+        tmpdir = tempfile.mkdtemp()
+        cfg = {('checkpoint', 'dir'): tmpdir,
+               ('hazard', 'tile_size'): '1'}
+        try:
+            with mock.patch('openquake.engine.utils.config.get',
+                            lambda section, key: cfg.get((section, key))):
+                self.calc.imtls = {'PGA': [.1, .2, .3]}
+                self.calc.curves_by_rlz = core.make_curve_accumulator(
+                    [1], self.calc.imtls, 2)
+                self.calc.completed_tiles = set([0])
+                self.calc.save_checkpoint(force=True)
+                self.assertEqual(['job-%d.pik' % self.job.id],
+                                 os.listdir(tmpdir))
+                calc = core.ClassicalHazardCalculator(self.job)
+                self.assertTrue(calc.load_checkpoint())
+                self.assertEqual(set([0]), calc.completed_tiles)
+                self.assertFalse(hasattr(calc, 'curves_by_rlz'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_task_completed_sparse(self):
+        self.calc.curves_by_rlz = {1: [numpy.zeros((4, 2)),
+                                       numpy.zeros((4, 2))]}
+        self.calc.leftovers = {}
+        self.calc.pending_leftovers = {}
+        curves = numpy.array([[.5, .2], [.4, .1]])
+        result = {1: [curves, 0]}
+        with mock.patch.object(self.calc, 'log_percent'):
+            self.calc.task_completed(
+                (result, numpy.array([1, 3]), [], None, [], 0))
+            self.calc.task_completed(
+                (result, numpy.array([1, 3]), [], None, [], 1))
+        numpy.testing.assert_almost_equal(
+            self.calc.curves_by_rlz[1][0],
+            [[0, 0], [.75, .36], [0, 0], [.64, .19]])
+        numpy.testing.assert_equal(
+            self.calc.curves_by_rlz[1][1], numpy.zeros((4, 2)))
+
     def test_initialize_sources(self):
         self.calc.initialize_site_model()
         self.calc.initialize_sources()
@@ -305,3 +399,173 @@ class HelpersTestCase(unittest.TestCase):
 
         expected = numpy.array([0.44] * 16).reshape((4, 4))
         numpy.testing.assert_allclose(expected, result)
+
+    def test_make_curve_accumulator(self):
+        imtls = {'PGA': [.1, .2, .3], 'SA(0.1)': [.1, .2]}
+        tmpdir = tempfile.mkdtemp()
+        cfg = {('hazard', 'accumulator_dir'): tmpdir,
+               ('hazard', 'accumulator_dtype'): 'float32'}
+        try:
+            with mock.patch('openquake.engine.utils.config.get',
+                            lambda section, key: cfg.get((section, key))):
+                acc = core.make_curve_accumulator(['r1', 'r2'], imtls, 4)
+            self.assertEqual(['r1', 'r2'], acc.keys())
+            self.assertEqual([(4, 3), (4, 2)],
+                             [a.shape for a in acc['r2']])
+            self.assertIsInstance(acc['r1'][0], numpy.memmap)
+            self.assertEqual(numpy.float32, acc['r1'][1].dtype)
+            acc['r2'][0][[1, 3]] = .5
+            self.assertEqual(0, acc['r1'][0].sum())
+            self.assertEqual(3, acc['r2'][0].sum())
+            # the files are removed immediately
+            self.assertEqual([], os.listdir(tmpdir))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_split_in_tiles(self):
+        sitecol = mock.Mock()
+        sitecol.mesh.lons = numpy.array([0.5, 1.5, -0.5, 0.2, 1.9, -179.9])
+        sitecol.mesh.lats = numpy.array([0.5, 0.5, 0.5, 0.1, 1.1, 0.3])
+        tiles = core.split_in_tiles(sitecol, 1.)
+        self.assertEqual([[5], [2], [0, 3], [1], [4]],
+                         [list(tile) for tile in tiles])
+
+    def test_source_cache(self):
+        sitecol = mock.Mock()
+        sitecol.mesh.lons = numpy.array([1., 2.])
+        sitecol.mesh.lats = numpy.array([3., 4.])
+        sitecol.vs30 = sitecol.z1pt0 = sitecol.z2pt5 = numpy.ones(2)
+        sitecol.vs30measured = numpy.zeros(2, bool)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = core.SourceCache(tmpdir, sitecol, {'PGA': [.1]}, 3, 200)
+            digest = cache.digest('src', 'gsim')
+            self.assertNotEqual(digest, cache.digest('src', 'gsim2'))
+            self.assertNotEqual(digest, core.SourceCache(
+                tmpdir, sitecol, {'PGA': [.1]}, 3, 300).digest(
+                'src', 'gsim'))
+            self.assertIsNone(cache.get(digest))
+            cache.set(digest, numpy.array([1]), [numpy.array([[.9]])])
+            indices, [pno] = cache.get(digest)
+            numpy.testing.assert_equal(indices, [1])
+            numpy.testing.assert_equal(pno, [[.9]])
+            self.assertEqual([digest], os.listdir(tmpdir))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_source_cache_digest(self):
+        # the digest depends on the public parameters of the source,
+        # not on their order nor on the lazily computed attributes
+        sitecol = mock.Mock()
+        sitecol.mesh.lons = numpy.array([1., 2.])
+        sitecol.mesh.lats = numpy.array([3., 4.])
+        sitecol.vs30 = sitecol.z1pt0 = sitecol.z2pt5 = numpy.ones(2)
+        sitecol.vs30measured = numpy.zeros(2, bool)
+        cache = core.SourceCache(None, sitecol, {'PGA': [.1]}, 3, 200)
+
+        def make_src(rate, **kw):
+            src = FakeSource()
+            src.__dict__.update(kw)
+            src.source_id = 'src-1'
+            src.mfd = FakeSource()
+            src.mfd.occurrence_rates = numpy.array([rate, .01])
+            return src
+        digest = cache.digest(make_src(.1), 'gsim')
+        self.assertEqual(digest, cache.digest(
+            make_src(.1, _polygon2d='cached'), 'gsim'))
+        self.assertNotEqual(digest, cache.digest(make_src(.2), 'gsim'))
+        with mock.patch('openquake.engine.__version__', '0.0.0'):
+            other = core.SourceCache(None, sitecol, {'PGA': [.1]}, 3, 200)
+        self.assertNotEqual(digest, other.digest(make_src(.1), 'gsim'))
+
+    def test_source_cache_empty_entry(self):
+        # a source without contributions is not recomputed
+        sitecol = mock.Mock()
+        sitecol.mesh.lons = numpy.array([1., 2.])
+        sitecol.mesh.lats = numpy.array([3., 4.])
+        sitecol.vs30 = sitecol.z1pt0 = sitecol.z2pt5 = numpy.ones(2)
+        sitecol.vs30measured = numpy.zeros(2, bool)
+        imts = {'PGA': [.1, .2]}
+        curves = {'gsim': {'PGA': numpy.ones((2, 2))}}
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = core.SourceCache(tmpdir, sitecol, imts, 3, 200)
+            digests = {}
+            self.assertEqual(['src'], list(core._sources_not_cached(
+                ['src'], cache, {'gsim': None}, curves, ['PGA'], digests)))
+            cache.set_empty(digests[('src', 'gsim')], imts)
+            self.assertEqual([], list(core._sources_not_cached(
+                ['src'], cache, {'gsim': None}, curves, ['PGA'], {})))
+            numpy.testing.assert_equal(curves['gsim']['PGA'], 1.)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_hazard_curve_data_to_pgcopy(self):
+        curves = numpy.array([[.5, .25], [.125, 0.]], numpy.float32)
+        data = core.hazard_curve_data_to_pgcopy(
+            7, numpy.array([1., 2.]), numpy.array([3., 4.]), curves, None)
+        row_size = 2 + 8 + 24 + 12 * 2 + 29 + 4
+        self.assertEqual(2 * row_size, len(data))
+        row = data[row_size:]
+        self.assertEqual((4, 4, 7), struct.unpack('>hii', row[:10]))
+        self.assertEqual((44, 1, 0, 701, 2, 1),
+                         struct.unpack('>iiiiii', row[10:34]))
+        self.assertEqual((8, .125, 8, 0.),
+                         struct.unpack('>idid', row[34:58]))
+        self.assertEqual((25,), struct.unpack('>i', row[58:62]))
+        self.assertEqual((1, 0x20000001, 4326, 2., 4.),
+                         struct.unpack('<BIIdd', row[62:87]))
+        self.assertEqual((-1,), struct.unpack('>i', row[87:]))
+
+    def test_bounding_box_array(self):
+        bba = core.BoundingBoxArray(1, [10, 11, 12])
+        mask = numpy.array([True, True, False])
+        bba.update(mask, numpy.array([10., 20., 30.]),
+                   numpy.array([179., 10., 0.]), numpy.array([1., 2., 3.]))
+        other = core.BoundingBoxArray(1, [10, 11, 12])
+        other.update(mask, numpy.array([5., 25., 30.]),
+                     numpy.array([-179., 11., 0.]), numpy.array([0., 3., 3.]))
+        bba.update_bba(other)
+
+        # the bounding boxes are the same as the ones of BoundingBox
+        for i, (dists, lons, lats) in enumerate([
+                ([10., 5.], [179., -179.], [1., 0.]),
+                ([20., 25.], [10., 11.], [2., 3.])]):
+            expected = core.BoundingBox(1, 10 + i)
+            expected.update(dists, lons, lats)
+            bb = bba[i]
+            self.assertEqual(10 + i, bb.site_id)
+            self.assertEqual(
+                (expected.min_dist, expected.max_dist, expected.west,
+                 expected.east, expected.south, expected.north),
+                (bb.min_dist, bb.max_dist, bb.west, bb.east, bb.south,
+                 bb.north))
+        self.assertFalse(bba[2])
+
+    def test_sources_within_budget_no_limit(self):
+        leftovers = []
+        srcs = list(core.sources_within_budget(range(5), 0, leftovers))
+        self.assertEqual(range(5), srcs)
+        self.assertEqual([], leftovers)
+
+    def test_sources_within_budget_exceeded(self):
+        # with a tiny budget only the first source is computed
+        leftovers = []
+        srcs = []
+        for src in core.sources_within_budget(range(5), 1E-9, leftovers):
+            time.sleep(0.001)
+            srcs.append(src)
+        self.assertEqual([0], srcs)
+        self.assertEqual([1, 2, 3, 4], leftovers)
+
+    def test_group_by_gsim(self):
+        class GSIM1(object):
+            pass
+
+        class GSIM2(object):
+            pass
+        gsim_by_rlz = {'r1': GSIM1(), 'r2': GSIM2(), 'r3': GSIM1()}
+        gsim_by_key, key_by_rlz = core.group_by_gsim(gsim_by_rlz)
+        self.assertEqual(2, len(gsim_by_key))
+        self.assertEqual(key_by_rlz['r1'], key_by_rlz['r3'])
+        self.assertNotEqual(key_by_rlz['r1'], key_by_rlz['r2'])
@@ -15,6 +15,7 @@
 
 
 import os
+import random
 import getpass
 import unittest
 import mock
@@ -22,7 +23,7 @@ import numpy
 
 from nose.plugins.attrib import attr
 
-from openquake.hazardlib.imt import PGA
+from openquake.hazardlib.imt import PGA, PGV
 from openquake.hazardlib.source.rupture import Rupture
 from openquake.hazardlib.site import Site, SiteCollection
 from openquake.hazardlib.geo.point import Point
@@ -33,6 +34,7 @@ from openquake.hazardlib.gsim import get_available_gsims
 
 from openquake.engine.db import models
 from openquake.engine.calculators.hazard.event_based import core
+from openquake.engine.calculators.hazard.event_based import post_processing
 
 from openquake.engine.tests.utils import helpers
 
@@ -71,6 +73,31 @@ class FakeRupture(object):
         self.id = id
 
 
+class SampleOccurrencesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rup = mock.Mock()
+        self.rup.occurrence_rate = 0.01
+        self.rup.temporal_occurrence_model.time_span = 50
+        self.all_ses = range(1000)
+
+    def test_vectorized_reproducible(self):
+        occ1 = core.sample_occurrences(
+            self.rup, self.all_ses, None, numpy.random.RandomState(42))
+        occ2 = core.sample_occurrences(
+            self.rup, self.all_ses, None, numpy.random.RandomState(42))
+        self.assertEqual(occ1, occ2)
+        # the rate is 0.5 per SES
+        num_occ = sum(n for ses, n in occ1)
+        self.assertTrue(400 < num_occ < 600, num_occ)
+        self.assertTrue(all(n > 0 for ses, n in occ1))
+
+    def test_per_ses(self):
+        self.rup.sample_number_of_occurrences.side_effect = [0, 2, 1]
+        occ = core.sample_occurrences(
+            self.rup, ['ses1', 'ses2', 'ses3'], random.Random(42))
+        self.assertEqual([('ses2', 2), ('ses3', 1)], occ)
+
+
 class GmfCollectorTestCase(unittest.TestCase):
     """Tests for the routines used by the event-based hazard calculator"""
 
@@ -95,23 +122,83 @@ class GmfCollectorTestCase(unittest.TestCase):
         rlz = mock.Mock()
         coll = core.GmfCollector(params, [pga], {rlz: gsim})
         coll.calc_gmf(site_coll, rup.rupture, rup.id, rup_seed)
-        expected_rups = {
-            (rlz, pga, 0): [rup_id],
-            (rlz, pga, 1): [rup_id],
-            (rlz, pga, 2): [rup_id],
-            (rlz, pga, 3): [rup_id],
-            (rlz, pga, 4): [rup_id],
-        }
-        expected_gmvs = {
-            (rlz, pga, 0): [0.1027847118266612],
-            (rlz, pga, 1): [0.02726361912605336],
-            (rlz, pga, 2): [0.0862595971325641],
-            (rlz, pga, 3): [0.04727148908077005],
-            (rlz, pga, 4): [0.04750575818347277],
-        }
-        numpy.testing.assert_equal(coll.ruptures_per_site, expected_rups)
-        for i, gmvs in expected_gmvs.iteritems():
-            numpy.testing.assert_allclose(gmvs, expected_gmvs[i])
+        expected_gmvs = [0.1027847118266612, 0.02726361912605336,
+                         0.0862595971325641, 0.04727148908077005,
+                         0.04750575818347277]
+        buf = coll.buffers[rlz, pga]
+        self.assertEqual(5, len(buf))
+        triples = list(buf.group_by_site())
+        self.assertEqual(range(5), [sid for sid, _, _ in triples])
+        for sid, gmvs, rupture_ids in triples:
+            self.assertEqual([rup_id], rupture_ids.tolist())
+            numpy.testing.assert_allclose(
+                [expected_gmvs[sid]], gmvs, rtol=1E-6)
+
+
+class GmfBufferTestCase(unittest.TestCase):
+    def test_extend_and_group(self):
+        buf = core.GmfBuffer(size=2)
+        buf.extend([3, 1, 2], numpy.array([[.3], [.1], [0.]]), 10)
+        buf.extend([1, 3], [.5, .6], 11)
+        self.assertEqual(4, len(buf))
+        self.assertEqual(numpy.float32, buf.gmvs.dtype)
+        self.assertEqual(numpy.int64, buf.rupture_ids.dtype)
+        self.assertEqual(numpy.int32, buf.site_ids.dtype)
+        triples = [(sid, gmvs.tolist(), rups.tolist())
+                   for sid, gmvs, rups in buf.group_by_site()]
+        self.assertEqual([1, 3], [t[0] for t in triples])
+        self.assertEqual([10, 11], triples[0][2])
+        self.assertEqual([10, 11], triples[1][2])
+        numpy.testing.assert_allclose([.1, .5], triples[0][1], rtol=1E-6)
+        numpy.testing.assert_allclose([.3, .6], triples[1][1], rtol=1E-6)
+
+
+class CurveCounterTestCase(unittest.TestCase):
+    def test_update(self):
+        rlz = mock.Mock(id=1)
+        pga, pgv = PGA(), PGV()
+        counter = core.CurveCounter(
+            numpy.array([10, 11, 12, 13]), {'PGA': [0.1, 0.2, 0.3]})
+        counter.update(rlz, pga, [11, 13], numpy.array([[0.15], [0.3]]))
+        counter.update(rlz, pga, [10, 11], [0.05, 0.25])
+        counter.update(rlz, pgv, [10, 11], [1., 1.])  # ignored
+        self.assertEqual([(1, pga)], counter.counts.keys())
+        numpy.testing.assert_equal(
+            counter.counts[1, pga],
+            [[0, 0, 0], [2, 1, 0], [0, 0, 0], [1, 1, 1]])
+        # only the rows of the sites with nonzero counts are returned
+        [(key, (indices, counts))] = counter.get_counts().items()
+        self.assertEqual((1, pga), key)
+        numpy.testing.assert_equal(indices, [1, 3])
+        numpy.testing.assert_equal(counts, [[2, 1, 0], [1, 1, 1]])
+
+    def test_single_precision(self):
+        # 0.7 in single precision is smaller than 0.7 in double precision;
+        # the counts must agree with the curves computed from stored GMFs
+        rlz = mock.Mock(id=1)
+        counter = core.CurveCounter(numpy.array([10]), {'PGA': [0.7]})
+        counter.update(rlz, PGA(), [10], [0.7])
+        numpy.testing.assert_equal(counter.counts[1, PGA()], [[0]])
+        gmvs = numpy.array([0.7], numpy.float32)
+        numpy.testing.assert_equal(
+            post_processing.gmvs_to_haz_curve(gmvs, [0.7], 50., 50.), [0.])
+
+    def test_collector_without_storage(self):
+        gsim = get_available_gsims()['AkkarBommer2010']()
+        site_coll = make_site_coll(-78, 15.5, 5)
+        params = dict(truncation_level=3, correl_model=None,
+                      maximum_distance=200)
+        rup = FakeRupture(42, 'Subduction Interface')
+        pga = PGA()
+        rlz = mock.Mock(id=1)
+        counter = core.CurveCounter(site_coll.sids, {'PGA': [0.05, 0.09]})
+        coll = core.GmfCollector(
+            params, [pga], {rlz: gsim}, store=False, counter=counter)
+        coll.calc_gmf(site_coll, rup.rupture, rup.id, 44)
+        self.assertEqual({}, coll.buffers)
+        # see the expected gmvs in GmfCollectorTestCase
+        numpy.testing.assert_equal(
+            counter.counts[1, pga], [[1, 1], [0, 0], [1, 0], [0, 0], [0, 0]])
 
 
 class EventBasedHazardCalculatorTestCase(unittest.TestCase):
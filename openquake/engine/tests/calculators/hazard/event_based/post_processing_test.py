@@ -52,3 +52,30 @@ post_processing.gmvs_to_haz_curve`.
         actual_poes = pp.gmvs_to_haz_curve(gmvs, imls, invest_time, duration)
         numpy.testing.assert_array_almost_equal(
             expected_poes, actual_poes, decimal=6)
+
+
+class CountExceedancesTestCase(unittest.TestCase):
+    """
+    Tests for
+    :func:`openquake.engine.calculators.hazard.event_based.\
+post_processing.count_exceedances`.
+    """
+
+    def test_same_as_gmvs_to_haz_curve(self):
+        imls = [0.01, 0.1, 0.2]
+        invest_time = 1.0  # years
+        duration = 1000.0  # years
+        gmvs_1, gmvs_2 = test_data.SITE_1_GMVS, test_data.SITE_2_GMVS
+        # the site with index 1 has no ground motion values
+        site_idx = numpy.array([0] * len(gmvs_1) + [2] * len(gmvs_2))
+        gmvs = numpy.array(list(gmvs_1) + list(gmvs_2))
+        counts = pp.count_exceedances(site_idx, gmvs, imls, 3)
+        self.assertEqual((3, 3), counts.shape)
+        poes = 1 - numpy.exp(- (invest_time / duration) * counts)
+        numpy.testing.assert_array_almost_equal(
+            pp.gmvs_to_haz_curve(gmvs_1, imls, invest_time, duration),
+            poes[0])
+        numpy.testing.assert_array_equal([0, 0, 0], poes[1])
+        numpy.testing.assert_array_almost_equal(
+            pp.gmvs_to_haz_curve(gmvs_2, imls, invest_time, duration),
+            poes[2])
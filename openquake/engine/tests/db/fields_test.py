@@ -14,12 +14,16 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import copy
 import numpy
 import pickle
 import unittest
 
 from django import forms
 
+from openquake.hazardlib.geo import (
+    Point, Mesh, PlanarSurface, MultiSurface, SimpleFaultSurface)
+
 from openquake.engine.db import fields
 
 
@@ -110,6 +114,88 @@ class PickleFieldTestCase(unittest.TestCase):
         self.assertEqual(pickle.loads(field.get_prep_value(data)), data)
 
 
+class SurfaceFieldTestCase(unittest.TestCase):
+    def setUp(self):
+        self.field = fields.SurfaceField()
+        self.planar = PlanarSurface(
+            10, 20, 30,
+            Point(3.9, 2.2, 10), Point(4.90402718, 3.19634248, 10),
+            Point(5.9, 2.2, 90), Point(4.89746275, 1.20365263, 90))
+
+    def roundtrip(self, surface):
+        value = self.field.get_prep_value(surface)
+        lazy = self.field.to_python(buffer(value))
+        self.assertIsInstance(lazy, fields.LazySurface)
+        return lazy
+
+    def test_planar(self):
+        lazy = self.roundtrip(self.planar)
+        # the geometry is read without decoding the surface
+        lons, lats, depths = lazy.get_geom()
+        self.assertIsNone(lazy._surface)
+        numpy.testing.assert_equal(
+            lons, [3.9, 4.90402718, 4.89746275, 5.9])
+        numpy.testing.assert_equal(depths, [10, 10, 90, 90])
+        self.assertEqual(30, lazy.get_dip())
+        self.assertIsInstance(lazy.surface, PlanarSurface)
+        numpy.testing.assert_equal(
+            self.planar.corner_lats, lazy.surface.corner_lats)
+
+    def test_multi_surface(self):
+        lazy = self.roundtrip(MultiSurface([self.planar, self.planar]))
+        lons, lats, depths = lazy.get_geom()
+        self.assertEqual(8, len(lons))
+        self.assertEqual(2, len(lazy.surface.surfaces))
+
+    def test_fault_mesh(self):
+        lons = numpy.array([0.1 * x for x in range(16)]).reshape((4, 4))
+        lats = lons * 2
+        depths = lons * 3
+        value = self.field.get_prep_value(
+            SimpleFaultSurface(Mesh(lons, lats, depths)))
+        # 1 byte of tag, 2 integers and 3 x 16 float32
+        self.assertEqual(1 + 8 + 3 * 16 * 4, len(value))
+        lazy = self.field.to_python(buffer(value))
+        numpy.testing.assert_allclose(lazy.get_geom()[1], lats, rtol=1E-6)
+        self.assertIsInstance(lazy.surface, SimpleFaultSurface)
+        self.assertEqual((4, 4), lazy.get_mesh().shape)
+
+    def test_pickled(self):
+        lazy = fields.LazySurface(pickle.dumps([1, 2], 2))
+        self.assertIsNone(lazy.get_geom())
+        self.assertEqual([1, 2], lazy.surface)
+
+    def test_pickle_and_copy(self):
+        lazy = self.roundtrip(self.planar)
+        lazy.get_dip()  # decode the surface
+        for other in (pickle.loads(pickle.dumps(lazy, 2)),
+                      pickle.loads(pickle.dumps(lazy, 0)),
+                      copy.copy(lazy), copy.deepcopy(lazy)):
+            # only the encoded surface is kept
+            self.assertEqual(lazy.data, other.data)
+            self.assertIsNone(other._surface)
+            self.assertEqual(30, other.get_dip())
+        self.assertRaises(AttributeError, getattr, lazy, '_missing')
+
+
+class CompressedArrayFieldTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.field = fields.CompressedArrayField()
+
+    def test_roundtrip(self):
+        gmvs = numpy.matrix([[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]])
+        value = self.field.get_prep_value(numpy.array(gmvs))
+        array = self.field.to_python(buffer(value))
+        self.assertEqual(numpy.float32, array.dtype)
+        numpy.testing.assert_allclose(
+            array.reshape(2, -1), gmvs, rtol=1E-6)
+
+    def test_none(self):
+        self.assertIsNone(self.field.to_python(None))
+        self.assertIsNone(self.field.get_prep_value(None))
+
+
 class NumpyListFieldTestCase(unittest.TestCase):
 
     def setUp(self):
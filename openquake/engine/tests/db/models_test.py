@@ -198,11 +198,11 @@ class ProbabilisticRuptureTestCase(unittest.TestCase):
 
         self.fault_rupture = models.ProbabilisticRupture.objects.create(
             ses_collection=ses_coll, magnitude=5, rake=0, surface=sfs,
-            tectonic_region_type='Active Shallow Crust',
+            tectonic_region_type='Active Shallow Crust', source_id='src',
             is_from_fault_source=True, is_multi_surface=False)
         self.source_rupture = models.ProbabilisticRupture.objects.create(
             ses_collection=ses_coll, magnitude=5, rake=0, surface=ps,
-            tectonic_region_type='Active Shallow Crust',
+            tectonic_region_type='Active Shallow Crust', source_id='src',
             is_from_fault_source=False, is_multi_surface=False)
 
     def test_fault_rupture(self):
@@ -216,6 +216,11 @@ class ProbabilisticRuptureTestCase(unittest.TestCase):
         self.assertIs(None, fault_rupture.top_right_corner)
         self.assertIs(None, fault_rupture.bottom_right_corner)
         self.assertIs(None, fault_rupture.bottom_left_corner)
+        # the mesh is stored in single precision
+        numpy.testing.assert_allclose(
+            self.mesh_lons, fault_rupture.lons, rtol=1E-6)
+        self.assertIsInstance(
+            fault_rupture.surface.surface, SimpleFaultSurface)
 
     def test_source_rupture(self):
         source_rupture = models.ProbabilisticRupture.objects.get(
@@ -228,6 +233,33 @@ class ProbabilisticRuptureTestCase(unittest.TestCase):
         self.assertEqual((5.9, 2.2, 90.0), source_rupture.bottom_right_corner)
 
 
+class EventKeyTestCase(unittest.TestCase):
+    def test_roundtrip(self):
+        key = models.get_event_key(2, 10, 123, 4)
+        self.assertEqual((2, 10, 123, 4), models.split_event_key(key))
+        self.assertLess(key, 2 ** 63)
+        self.assertEqual('smlt=02|ses=0010|src=A|rup=123-04',
+                         models.get_tag(key, 'A'))
+
+    def test_ordering(self):
+        keys = [models.get_event_key(*args) for args in
+                [(0, 1, 1, 2), (0, 1, 2, 1), (0, 2, 1, 1), (1, 1, 1, 1)]]
+        self.assertEqual(sorted(keys), keys)
+
+    def test_overflow(self):
+        self.assertRaises(ValueError, models.get_event_key, 0, 1, 2 ** 24, 1)
+
+    def test_tag_sql(self):
+        curs = models.getcursor('job_init')
+        for args in [(2, 10, 123, 4), (4095, 65535, 2 ** 24 - 1, 2047)]:
+            key = models.get_event_key(*args)
+            curs.execute('SELECT %s FROM (SELECT %%s::bigint AS k, '
+                         '%%s::text AS s) AS x' % models.get_tag_sql('k', 's'),
+                         (key, 'src|1'))
+            [[tag]] = curs.fetchall()
+            self.assertEqual(models.get_tag(key, 'src|1'), tag)
+
+
 def get_tags(gmf_data):
     """
     Get the rupture tags associated to a given gmf_data record
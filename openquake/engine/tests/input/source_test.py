@@ -17,6 +17,8 @@
 import decimal
 import unittest
 
+import mock
+
 from numpy.testing import assert_allclose
 
 from openquake.hazardlib import geo
@@ -504,3 +506,62 @@ class AreaToPointsTestCase(unittest.TestCase):
             actual[0].mfd.occurrence_rates,
             [1.10572802083e-05, 9.197044479166666e-06, 7.6497684375e-06,
              6.3627999999999995e-06, 5.292346875e-06])
+
+
+class CostModelTestCase(unittest.TestCase):
+
+    def test_default_weights(self):
+        cm = source_input.CostModel()
+        self.assertEqual(cm.get_weight('PointSource', 100), 100)
+        self.assertEqual(cm.get_weight('CharacteristicFaultSource', 2), 100)
+        self.assertEqual(cm.get_weight('SimpleFaultSource', 100), 1000)
+
+    def test_default_weights_as_old_heuristic(self):
+        # the weights used before the introduction of the cost model
+        def old_weight(src):
+            num_ruptures = src.count_ruptures()
+            if isinstance(src, source.PointSource):  # also AreaSource
+                return num_ruptures
+            elif isinstance(src, source.CharacteristicFaultSource):
+                return num_ruptures * 50
+            return num_ruptures ** 1.5
+
+        hc = mock.Mock(investigation_time=50., rupture_mesh_spacing=1,
+                       width_of_mfd_bin=1., area_source_discretization=10.)
+        convert = source_input.NrmlHazardlibConverter(hc)
+        srcs = map(convert, nrml_parsers.SourceModelParser(
+            MIXED_SRC_MODEL).parse())
+        self.assertEqual(
+            ['AreaSource', 'PointSource', 'SimpleFaultSource',
+             'ComplexFaultSource', 'CharacteristicFaultSource',
+             'CharacteristicFaultSource', 'CharacteristicFaultSource'],
+            [src.__class__.__name__ for src in srcs])
+        for src in srcs:
+            num_ruptures, weight = source_input.get_num_ruptures_weight(src)
+            self.assertEqual(src.count_ruptures(), num_ruptures)
+            self.assertAlmostEqual(old_weight(src), weight)
+
+    def test_fit(self):
+        # point sources cost 0.001 s per rupture per site and gsim,
+        # simple faults 0.002 s * num_ruptures ** 1.2
+        timings = []
+        for n in range(1, 21):
+            timings.append(('PointSource', n, 10, 2, 0.001 * n * 20))
+        for n in range(1, 11):
+            timings.append(
+                ('SimpleFaultSource', n, 5, 1, 0.002 * n ** 1.2 * 5))
+        cm = source_input.CostModel.fit(timings)
+        self.assertEqual(cm.fitted['PointSource'][0], 20)
+        self.assertEqual(cm.fitted['SimpleFaultSource'][0], 10)
+        # the point sources, which have more timings, keep coeff=1
+        assert_allclose(cm.get_params('PointSource'), (1., 1.))
+        assert_allclose(cm.get_params('SimpleFaultSource'), (2., 1.2))
+        # the characteristic sources have not been fitted
+        self.assertEqual(
+            cm.get_params('CharacteristicFaultSource'), (50., 1.))
+
+    def test_fit_not_enough_timings(self):
+        timings = [('PointSource', n, 1, 1, 0.1 * n) for n in range(1, 5)]
+        cm = source_input.CostModel.fit(timings)
+        self.assertEqual(cm.fitted, {})
+        self.assertEqual(cm.get_params('PointSource'), (1., 1.))
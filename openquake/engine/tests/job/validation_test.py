@@ -390,6 +390,22 @@ class EventBasedHazardFormTestCase(unittest.TestCase):
         equal, err = helpers.deep_eq(expected_errors, dict(form.errors))
         self.assertTrue(equal, err)
 
+    def test_too_many_ses_per_logic_tree_path(self):
+        expected_errors = {
+            'ses_per_logic_tree_path': [
+                '`Stochastic Event Sets Per Sample` (ses_per_logic_tree_path) '
+                'must be <= 65535; increase the investigation_time instead'],
+        }
+
+        self.hc.ses_per_logic_tree_path = 100000
+
+        form = validation.EventBasedHazardForm(
+            instance=self.hc, files=None
+        )
+        self.assertFalse(form.is_valid())
+        equal, err = helpers.deep_eq(expected_errors, dict(form.errors))
+        self.assertTrue(equal, err)
+
     def test_invalid_imts(self):
         expected_errors = {
             'intensity_measure_types': [
@@ -487,21 +503,15 @@ class EventBasedHazardFormTestCase(unittest.TestCase):
         self.assertEqual(sorted(expected_warnings), sorted(actual_warnings))
 
     def test_gmfs_false_hazard_curves_true(self):
-        # An error should be raised if `hazard_curves_from_gmfs` is `True`, but
-        # `ground_motion_fields` is `False`.
-        # GMFs are needed to compute hazard curves.
-        expected_errors = {
-            'hazard_curves_from_gmfs': ['`hazard_curves_from_gmfs` requires '
-                                        '`ground_motion_fields` to be `true`'],
-        }
+        # `hazard_curves_from_gmfs` can be `True` even if
+        # `ground_motion_fields` is `False`: in that case the GMFs are
+        # not stored and the hazard curves are computed on the fly
         self.hc.ground_motion_fields = False
         self.hc.hazard_curves_from_gmfs = True
 
         form = validation.EventBasedHazardForm(instance=self.hc, files=None)
 
-        self.assertFalse(form.is_valid())
-        equal, err = helpers.deep_eq(expected_errors, dict(form.errors))
-        self.assertTrue(equal, err)
+        self.assertTrue(form.is_valid(), dict(form.errors))
 
 
 class DisaggHazardFormTestCase(unittest.TestCase):
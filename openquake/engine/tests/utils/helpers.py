@@ -690,8 +690,8 @@ def create_ses_ruptures(job, ses_collection, num):
         source_typology=object())
     ses = models.SES(ses_collection, ordinal=1)
     seed = 42
-    pr = models.ProbabilisticRupture.create(rupture, ses_collection)
-    return [models.SESRupture.create(pr, ses, 'test', 1, i, seed + i)
+    pr = models.ProbabilisticRupture.create(rupture, ses_collection, 'test')
+    return [models.SESRupture.create(pr, ses, 1, i, seed + i)
             for i in range(num)]
 
 
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010-2014, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Test related to code in openquake/engine/utils/spatial.py
+"""
+
+import unittest
+
+import mock
+import numpy
+
+from openquake.hazardlib.geo import Mesh
+from openquake.hazardlib.geo.geodetic import min_geodetic_distance
+
+from openquake.engine.utils import spatial
+
+
+class FakeSiteCollection(object):
+    def __init__(self, lons, lats, sids=None):
+        self.mesh = Mesh(lons, lats, None)
+        self.sids = numpy.arange(len(lons)) if sids is None else sids
+
+    def __len__(self):
+        return len(self.mesh)
+
+    def filter(self, mask):
+        if not mask.any():
+            return None
+        return FakeSiteCollection(self.mesh.lons[mask], self.mesh.lats[mask],
+                                  self.sids[mask])
+
+
+class SiteIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        lons, lats = numpy.meshgrid(numpy.linspace(0, 10, 50),
+                                    numpy.linspace(40, 50, 50))
+        self.sitecol = FakeSiteCollection(lons.flatten(), lats.flatten())
+        self.index = spatial.SiteIndex(self.sitecol)
+
+    def test_tree_built(self):
+        self.assertIsNotNone(self.index.tree)
+        small = spatial.SiteIndex(FakeSiteCollection(
+            numpy.array([1., 2.]), numpy.array([45., 46.])))
+        self.assertIsNone(small.tree)
+
+    def test_within_contains_all_close_sites(self):
+        lons, lats = numpy.array([2., 3., 3.]), numpy.array([44., 44., 45.])
+        distance = 100.
+        dists = min_geodetic_distance(
+            lons, lats, self.sitecol.mesh.lons, self.sitecol.mesh.lats)
+        expected = set((dists <= distance).nonzero()[0])
+        got = set(self.index.within(lons, lats, distance))
+        self.assertTrue(expected <= got)
+        # the index is actually filtering
+        self.assertLess(len(got), len(self.sitecol) / 4)
+
+    def test_within_far_away(self):
+        self.assertEqual(
+            0, len(self.index.within([100.], [-30.], 100.)))
+
+    def test_brute_force_same_as_tree(self):
+        lons, lats = numpy.array([2., 3., 3.]), numpy.array([44., 44., 45.])
+        expected = self.index.within(lons, lats, 50.)
+        self.index.tree = None
+        numpy.testing.assert_equal(
+            expected, self.index.within(lons, lats, 50.))
+
+    def fake_rupture(self, lons, lats):
+        rupture = mock.Mock()
+        rupture.surface.corner_lons = lons
+        rupture.surface.corner_lats = lats
+        # the exact filter returns all the sites it receives
+        rupture.source_typology.filter_sites_by_distance_to_rupture = (
+            lambda rup, dist, sites: sites)
+        return rupture
+
+    def test_rupture_filtering_restricted_to_given_sites(self):
+        lons, lats = numpy.array([2., 3., 3.]), numpy.array([44., 44., 45.])
+        rupture = self.fake_rupture(lons, lats)
+        sites = self.sitecol.filter(self.sitecol.mesh.lons < 2.5)
+        close = set(self.index.within(lons, lats, 100.))
+        r_sites = self.index.filter_sites_by_distance_to_rupture(
+            rupture, 100., sites)
+        self.assertEqual(close & set(sites.sids), set(r_sites.sids))
+        r_sites = self.index.filter_sites_by_distance_to_rupture(
+            rupture, 100.)
+        self.assertEqual(close, set(r_sites.sids))
+
+    def test_rupture_filtering_without_tree(self):
+        # the given sites are filtered directly, not the whole collection
+        self.index.tree = None
+        rupture = self.fake_rupture([2.], [44.])
+        sites = self.sitecol.filter(self.sitecol.mesh.lons < 2.5)
+        self.assertIs(sites, self.index.filter_sites_by_distance_to_rupture(
+            rupture, 100., sites))
@@ -21,8 +21,19 @@
 Unit tests for the utils.tasks module.
 """
 
+import os
+import time
+import shutil
+import tempfile
+import itertools
+import threading
 import unittest
 
+import mock
+
+from openquake.engine import engine
+from openquake.engine.db import models
+from openquake.engine.performance import EnginePerformanceMonitor
 from openquake.engine.utils import tasks
 
 from openquake.engine.tests.utils.tasks import failing_task, just_say_hello
@@ -64,3 +75,205 @@ class MapReduceTestCase(unittest.TestCase):
                                 lst.append)
         self.assertEqual(res, None)
         self.assertEqual(lst, ['hello'] * 5)
+
+    @mock.patch('openquake.engine.utils.tasks.no_distribute', lambda: False)
+    @mock.patch('openquake.engine.utils.tasks.use_process_pool',
+                lambda: False)
+    def test_max_in_flight(self):
+        job = engine.prepare_job()
+        in_flight = set()
+        peak = [0]
+        task_ids = itertools.count()
+
+        def apply_async(piks):
+            # a task which ends as soon as it is sent; its state is
+            # never polled, since there is no .ready method
+            task_id = str(next(task_ids))
+            in_flight.add(task_id)
+            peak[0] = max(peak[0], len(in_flight))
+
+            def get():
+                in_flight.remove(task_id)
+                return tasks.Pickled(('hello', None))
+            return mock.Mock(spec=['task_id', 'get'], task_id=task_id,
+                             get=get)
+
+        # the arguments are consumed lazily from a generator
+        with mock.patch.object(just_say_hello, 'apply_async', apply_async):
+            result = tasks.map_reduce(
+                just_say_hello, ((job.id, i) for i in range(5)),
+                lambda lst, val: lst + [val], [], max_in_flight=2)
+        self.assertEqual(["hello"] * 5, result)
+        self.assertEqual(2, peak[0])
+        self.assertEqual(set(), in_flight)
+
+    @mock.patch('openquake.engine.utils.tasks.no_distribute', lambda: False)
+    @mock.patch('openquake.engine.utils.tasks.use_process_pool',
+                lambda: True)
+    def test_process_pool(self):
+        result = tasks.map_reduce(
+            just_say_hello, [(i, ) for i in range(5)],
+            lambda lst, val: lst + [val], [], max_in_flight=2)
+        self.assertEqual(["hello"] * 5, result)
+
+    @mock.patch('openquake.engine.utils.tasks.no_distribute', lambda: False)
+    @mock.patch('openquake.engine.utils.tasks.use_process_pool',
+                lambda: True)
+    def test_process_pool_failing_subtask(self):
+        with self.assertRaises(RuntimeError) as ctx:
+            tasks.parallelize(failing_task, [(42, )], None)
+        self.assertIn('NotImplementedError: 42', str(ctx.exception))
+
+    @mock.patch('openquake.engine.utils.tasks.no_distribute', lambda: False)
+    @mock.patch('openquake.engine.utils.tasks.use_process_pool',
+                lambda: True)
+    @mock.patch('openquake.engine.utils.tasks.collector_threads', lambda: 2)
+    def test_pipelined_monitored_aggregation(self):
+        # the aggregation writes on the performance cache and on the
+        # database while the tasks are submitted: it must run in the
+        # submitting thread, without losing rows
+        job = engine.prepare_job()
+        threads = set()
+
+        def agg(acc, val):
+            threads.add(threading.current_thread())
+            with EnginePerformanceMonitor('aggregating', job.id, flush=True):
+                return acc + [val]
+        result = tasks.map_reduce(
+            just_say_hello, [(job.id, i) for i in range(10)], agg, [],
+            max_in_flight=2)
+        self.assertEqual(["hello"] * 10, result)
+        self.assertEqual(set([threading.current_thread()]), threads)
+        self.assertEqual(10, models.Performance.objects.filter(
+            oq_job=job, operation='aggregating').count())
+
+
+class ResultCollectorTestCase(unittest.TestCase):
+    """
+    Tests the serial and pipelined modes of utils.tasks.ResultCollector
+    """
+    def collect(self, results, num_threads):
+        collector = tasks.ResultCollector(
+            just_say_hello, 0, lambda lst, val: lst + [val], [], num_threads)
+        for res in results:
+            collector.add(tasks.Pickled(res))
+        return collector.get()
+
+    def test_serial(self):
+        results = [(i, None) for i in range(10)]
+        self.assertEqual(range(10), self.collect(results, 0))
+
+    def test_pipelined(self):
+        # the results are aggregated in order of arrival
+        results = [(i, None) for i in range(10)]
+        self.assertEqual(range(10), self.collect(results, 3))
+
+    def test_pipelined_error(self):
+        results = [(0, None), ('NotImplementedError: 1', NotImplementedError),
+                   (2, None)]
+        with self.assertRaises(RuntimeError) as ctx:
+            self.collect(results, 2)
+        self.assertIn('NotImplementedError: 1', str(ctx.exception))
+
+
+class PickledTestCase(unittest.TestCase):
+    """
+    Tests the compression of utils.tasks.Pickled
+    """
+    def pickled(self, obj, codec):
+        cfg = {('distribution', 'compression'): codec,
+               ('distribution', 'compression_level'): '1',
+               ('distribution', 'compression_min_size'): '1000'}
+        with mock.patch('openquake.engine.utils.config.get',
+                        lambda section, key: cfg.get((section, key))):
+            return tasks.Pickled(obj)
+
+    def test_no_compression(self):
+        pik = self.pickled(range(1000), 'none')
+        self.assertIsNone(pik.codec)
+        self.assertEqual(len(pik), pik.raw_size)
+        self.assertEqual(pik.unpickle(), range(1000))
+
+    def test_compression(self):
+        for codec in ('zlib', 'bz2'):
+            pik = self.pickled([0.5] * 1000, codec)
+            self.assertEqual(pik.codec, codec)
+            self.assertLess(len(pik), pik.raw_size)
+            self.assertEqual(pik.unpickle(), [0.5] * 1000)
+
+    def test_small_payload_is_not_compressed(self):
+        pik = self.pickled([1, 2, 3], 'zlib')
+        self.assertIsNone(pik.codec)
+        self.assertEqual(pik.unpickle(), [1, 2, 3])
+
+
+class BroadcastTestCase(unittest.TestCase):
+    """
+    Tests the behaviour of utils.tasks.broadcast
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        cfg = {('celery', 'broadcast_dir'): self.tmpdir,
+               ('celery', 'broadcast_cache_size'): '2'}
+        self.patcher = mock.patch(
+            'openquake.engine.utils.config.get',
+            lambda section, key: cfg.get((section, key)))
+        self.patcher.start()
+        tasks.Broadcast.cache.clear()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_small_object_is_pickled(self):
+        with mock.patch('openquake.engine.utils.tasks.no_distribute',
+                        lambda: False):
+            pik = tasks.broadcast(1, [1, 2, 3])
+        self.assertIsInstance(pik, tasks.Pickled)
+        self.assertEqual(pik.unpickle(), [1, 2, 3])
+
+    def test_large_object_is_broadcasted(self):
+        obj = range(tasks.BROADCAST_MIN_SIZE)
+        with mock.patch('openquake.engine.utils.tasks.no_distribute',
+                        lambda: False):
+            ref = tasks.broadcast(1, obj)
+            ref2 = tasks.broadcast(1, obj)
+        self.assertIsInstance(ref, tasks.Broadcast)
+        self.assertEqual(ref.path, ref2.path)  # content-addressed
+        self.assertLess(len(ref), 1024)
+        self.assertEqual(ref.unpickle(), obj)
+        self.assertIs(ref.unpickle(), ref2.unpickle())  # cached
+        self.assertEqual(tasks.pickle_sequence([ref]), [ref])
+        tasks.remove_broadcast_store(1)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+class TaskContextTestCase(unittest.TestCase):
+    """
+    Tests the job status check of utils.tasks.TaskContext
+    """
+    def setUp(self):
+        self.ctx = object.__new__(tasks.TaskContext)  # no db access
+        self.ctx.job_id = -1
+        self.ctx.is_running = True
+        self.ctx.checked = time.time()
+
+    def tearDown(self):
+        tasks.TaskContext._job_status.pop(-1, None)
+
+    def patch(self, ttl):
+        return mock.patch('openquake.engine.utils.config.get',
+                          lambda section, key: ttl)
+
+    def test_cached_status(self):
+        with self.patch('60'), mock.patch(
+                'openquake.engine.db.models.OqJob.objects.filter') as filt:
+            self.assertTrue(self.ctx.job_is_running())
+            self.assertFalse(filt.called)
+
+    def test_expired_status(self):
+        with self.patch('0'), mock.patch(
+                'openquake.engine.db.models.OqJob.objects.filter') as filt:
+            filt.return_value.values_list.return_value = [False]
+            self.assertFalse(self.ctx.job_is_running())
+            self.assertEqual(filt.call_count, 1)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010-2014, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A spatial index over a site collection, used to speed up the filtering
+of the sites by distance to sources and ruptures.
+"""
+
+import numpy
+from scipy.spatial import cKDTree
+
+from openquake.hazardlib.geo.utils import spherical_to_cartesian
+
+#: below this number of sites the filtering is done by brute force
+INDEX_THRESHOLD = 1000
+
+
+class SiteIndex(object):
+    """
+    A k-d tree built over the 3-D Cartesian coordinates of the sites.
+    It is used to extract quickly the candidate sites close to a region
+    (i.e. the sites within a sphere enclosing the region, enlarged by the
+    integration distance); the exact filters of hazardlib are then applied
+    to the candidates only, so that the result is the same as filtering
+    the whole site collection, but the cost is sub-linear in the number of
+    sites. For small site collections no tree is built and the filtering
+    is done by brute force.
+
+    :param sitecol:
+        a :class:`openquake.hazardlib.site.SiteCollection` instance
+    """
+    def __init__(self, sitecol):
+        self.sitecol = sitecol
+        mesh = sitecol.mesh
+        self.coords = spherical_to_cartesian(mesh.lons, mesh.lats)
+        if len(sitecol) > INDEX_THRESHOLD:
+            self.tree = cKDTree(self.coords)
+        else:
+            self.tree = None
+
+    def within(self, lons, lats, distance):
+        """
+        Return the indices of the sites within `distance` km from the
+        region delimited by the given points. Since the chord between two
+        points is shorter than the arc, the sphere centered in the
+        barycenter of the points contains all the sites at the given
+        distance from the region, plus possibly a few others.
+
+        :param lons: longitudes of the points delimiting the region
+        :param lats: latitudes of the points delimiting the region
+        :param distance: a distance in km
+        :returns: a sorted array of site indices
+        """
+        points = spherical_to_cartesian(
+            numpy.array(lons, float).flatten(),
+            numpy.array(lats, float).flatten())
+        center = points.mean(axis=0)
+        radius = numpy.sqrt(((points - center) ** 2).sum(axis=1)).max()
+        if self.tree is None:
+            dists = numpy.sqrt(((self.coords - center) ** 2).sum(axis=1))
+            return (dists <= radius + distance).nonzero()[0]
+        indices = self.tree.query_ball_point(center, radius + distance)
+        return numpy.array(sorted(indices), int)
+
+    def _candidates(self, lons, lats, distance, sites):
+        # returns the subset of `sites` close to the region
+        # or None if there are no sites close to it
+        indices = self.within(lons, lats, distance)
+        if not len(indices):
+            return None
+        if sites is self.sitecol:
+            mask = numpy.zeros(len(self.sitecol), bool)
+            mask[indices] = True
+        else:  # a subset of the indexed site collection
+            mask = numpy.in1d(sites.sids, self.sitecol.sids[indices])
+        return sites.filter(mask)
+
+    def filter_sites_by_distance_to_source(self, src, distance):
+        """
+        Equivalent to `src.filter_sites_by_distance_to_source(distance,
+        sitecol)` but faster for large site collections.
+
+        :returns: a (filtered) site collection or None
+        """
+        if self.tree is None:
+            return src.filter_sites_by_distance_to_source(
+                distance, self.sitecol)
+        poly = src.get_rupture_enclosing_polygon()
+        sites = self._candidates(poly.lons, poly.lats, distance, self.sitecol)
+        if sites is None:
+            return None
+        return src.filter_sites_by_distance_to_source(distance, sites)
+
+    def filter_sites_by_distance_to_rupture(self, rupture, distance,
+                                            sites=None):
+        """
+        Equivalent to `rupture.source_typology.
+        filter_sites_by_distance_to_rupture(rupture, distance, sites)`
+        but faster for large site collections.
+
+        :param sites:
+            a subset of the indexed site collection, typically the sites
+            close to the source of the rupture; if None, the indexed
+            site collection is used
+        :returns: a (filtered) site collection or None
+        """
+        if sites is None:
+            sites = self.sitecol
+        typology = rupture.source_typology
+        if self.tree is None:
+            return typology.filter_sites_by_distance_to_rupture(
+                rupture, distance, sites)
+        surface = rupture.surface
+        if hasattr(surface, 'corner_lons'):  # planar surface
+            lons, lats = surface.corner_lons, surface.corner_lats
+        else:
+            mesh = surface.get_mesh()
+            lons, lats = mesh.lons, mesh.lats
+        sites = self._candidates(lons, lats, distance, sites)
+        if sites is None:
+            return None
+        return typology.filter_sites_by_distance_to_rupture(
+            rupture, distance, sites)
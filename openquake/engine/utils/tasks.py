@@ -19,11 +19,25 @@
 
 """Utility functions related to splitting work into tasks."""
 
+import os
 import sys
+import bz2
+import zlib
+import time
+import shutil
 import cPickle
+import hashlib
+import threading
+import itertools
 import traceback
+import collections
+import multiprocessing
 import psutil
+from datetime import datetime
 
+from concurrent import futures
+
+from django.db import connections
 from celery.task.sets import TaskSet
 from celery.app import current_app
 from celery.task import task
@@ -32,12 +46,18 @@ from openquake.engine import logs, no_distribute
 from openquake.engine.db import models
 from openquake.engine.utils import config
 from openquake.engine.writer import CacheInserter
-from openquake.engine.performance import EnginePerformanceMonitor, \
-    LightMonitor
+from openquake.engine.performance import EnginePerformanceMonitor
 
 
 ONE_MB = 1024 * 1024
 
+#: the codecs which can be used to compress the pickled objects
+CODECS = dict(zlib=zlib, bz2=bz2)
+
+#: objects pickled in less bytes than this are not saved in the
+#: broadcast store, since it is cheap to send them to the tasks
+BROADCAST_MIN_SIZE = ONE_MB
+
 
 def check_mem_usage(mem_percent=80):
     """
@@ -56,25 +76,186 @@ class Pickled(object):
     The reason is that celery does not use the HIGHEST_PROTOCOL,
     so relying on celery is slower. Moreover Pickled instances
     have a nice string representation and length giving the size
-    of the pickled bytestring.
+    of the pickled bytestring. If a `compression` codec is set in the
+    section [distribution] of openquake.cfg, the bytestrings longer than
+    `compression_min_size` are transparently compressed; the length is
+    then the size of the compressed bytestring, whereas the attribute
+    `.raw_size` is always the size of the uncompressed one.
 
     :param obj: the object to pickle
     """
     def __init__(self, obj):
         self.clsname = obj.__class__.__name__
         self.pik = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+        self.raw_size = len(self.pik)
+        self.codec = None
+        codec = config.get('distribution', 'compression')
+        if codec and codec != 'none':
+            min_size = int(
+                config.get('distribution', 'compression_min_size') or 0)
+            if self.raw_size >= min_size:
+                level = int(config.get('distribution', 'compression_level')
+                            or 1)
+                self.pik = CODECS[codec].compress(self.pik, level)
+                self.codec = codec
 
     def __repr__(self):
         """String representation of the pickled object"""
         return '<Pickled %s %dK>' % (self.clsname, len(self) / 1024)
 
     def __len__(self):
-        """Length of the pickled bytestring"""
+        """Length of the pickled (and possibly compressed) bytestring"""
         return len(self.pik)
 
     def unpickle(self):
         """Unpickle the underlying object"""
-        return cPickle.loads(self.pik)
+        return loads(self.pik, self.codec)
+
+
+def loads(pik, codec=None):
+    """
+    Unpickle a bytestring, possibly compressed.
+
+    :param pik: a pickled bytestring
+    :param codec: the name of the codec used to compress it, or None
+    """
+    if codec:
+        pik = CODECS[codec].decompress(pik)
+    return cPickle.loads(pik)
+
+
+def save_sizes(job_id, task, operation, raw_size, size):
+    """
+    Save in the performance table the number of bytes transferred for
+    the given task, before and after the compression. Nothing is saved
+    if nothing was compressed.
+
+    :param job_id: the ID of the current job
+    :param task: a `celery` task callable
+    :param str operation: the operation, i.e. sending or receiving
+    :param int raw_size: the number of bytes before the compression
+    :param int size: the number of bytes after the compression
+    """
+    if raw_size == size:
+        return
+    EnginePerformanceMonitor.cache.add(models.Performance(
+        oq_job_id=job_id,
+        task=task.__name__,
+        operation='%s %s' % (operation, task.__name__),
+        start_time=datetime.now(),
+        uncompressed_size=raw_size,
+        compressed_size=size))
+    EnginePerformanceMonitor.cache.flush()
+
+
+class Broadcast(object):
+    """
+    A small reference to a large object shared by many tasks. The object
+    is pickled only once and saved in a content-addressed store, i.e. in
+    a file named after the SHA1 digest of the pickled bytestring, inside
+    the directory `broadcast_dir` of the section [celery] of openquake.cfg,
+    which must be visible from all the worker nodes. The tasks receive only
+    the reference and resolve it through a per-process LRU cache: for this
+    reason the broadcasted objects must not be modified by the tasks.
+
+    :param job_id: the ID of the current job
+    :param pik: a :class:`Pickled` instance
+    """
+    # digest -> object, the most recently used objects are at the end
+    cache = collections.OrderedDict()
+
+    def __init__(self, job_id, pik):
+        self.clsname = pik.clsname
+        self.codec = pik.codec
+        self.size = len(pik)
+        self.digest = hashlib.sha1(pik.pik).hexdigest()
+        self.path = os.path.join(broadcast_store(job_id), self.digest)
+        if not os.path.exists(self.path):
+            # write on a temporary file and rename it, so that a task
+            # cannot see a partially written file
+            tmp = '%s.%d' % (self.path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(pik.pik)
+            os.rename(tmp, self.path)
+
+    def __repr__(self):
+        """String representation of the broadcasted object"""
+        return '<Broadcast %s %s %dK>' % (
+            self.clsname, self.digest, self.size / 1024)
+
+    def __len__(self):
+        """Number of bytes of the reference, not of the object"""
+        return len(self.path)
+
+    @property
+    def raw_size(self):
+        """The reference is never compressed"""
+        return len(self)
+
+    def unpickle(self):
+        """
+        Return the referenced object, by reading it from the store
+        only if it is not already in the cache of the current process
+        """
+        try:
+            obj = self.cache.pop(self.digest)
+        except KeyError:
+            with open(self.path, 'rb') as f:
+                obj = loads(f.read(), self.codec)
+            cache_size = int(config.get('celery', 'broadcast_cache_size')
+                             or 1)
+            while len(self.cache) >= cache_size:
+                self.cache.popitem(last=False)  # remove the oldest object
+        self.cache[self.digest] = obj
+        return obj
+
+
+def broadcast_store(job_id):
+    """
+    Return the directory where the broadcasted objects of the given job are
+    stored, by creating it if needed, or None if broadcasting is disabled.
+
+    :param job_id: the ID of the current job
+    """
+    broadcast_dir = config.get('celery', 'broadcast_dir')
+    if not broadcast_dir:
+        return
+    path = os.path.join(broadcast_dir, 'job-%s' % job_id)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def remove_broadcast_store(job_id):
+    """
+    Remove the broadcasted objects of the given job, if any.
+
+    :param job_id: the ID of the current job
+    """
+    path = broadcast_store(job_id)
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def broadcast(job_id, obj):
+    """
+    Prepare an object shared by many tasks. The object is pickled only
+    once: if it is large and broadcasting is enabled it is also saved in
+    the broadcast store and a small :class:`Broadcast` reference is
+    returned, otherwise the :class:`Pickled` object is returned. In both
+    cases :func:`pickle_sequence` will not pickle it again. If the
+    environment variable OQ_NO_DISTRIBUTE is set the object is returned
+    unchanged.
+
+    :param job_id: the ID of the current job
+    :param obj: the object to share
+    """
+    if no_distribute():
+        return obj
+    pik = Pickled(obj)
+    if len(pik) >= BROADCAST_MIN_SIZE and broadcast_store(job_id):
+        return Broadcast(job_id, pik)
+    return pik
 
 
 def pickle_sequence(objects):
@@ -91,7 +272,7 @@ def pickle_sequence(objects):
     for obj in objects:
         obj_id = id(obj)
         if obj_id not in cache:
-            if isinstance(obj, Pickled):  # already pickled
+            if isinstance(obj, (Pickled, Broadcast)):  # already pickled
                 cache[obj_id] = obj
             else:  # pickle the object
                 cache[obj_id] = Pickled(obj)
@@ -99,6 +280,109 @@ def pickle_sequence(objects):
     return out
 
 
+class TaskContext(object):
+    """
+    Information about a job shipped to the tasks together with their
+    arguments, so that the tasks do not need to read it from the database:
+    the job id, the log level, the calculation object and the status of
+    the job at the time the context was built.
+
+    :param job: a :class:`openquake.engine.db.models.OqJob` instance
+    """
+    # job_id -> (time of the last check, is_running), per process
+    _job_status = {}
+
+    def __init__(self, job):
+        self.job_id = job.id
+        self.log_level = job.log_level
+        calc = job.calculation
+        # read a fresh copy, without the attributes cached by the controller
+        self.calc = calc.__class__.objects.get(pk=calc.pk)
+        self.is_running = job.is_running
+        self.checked = time.time()
+
+    def job_is_running(self):
+        """
+        Return the status of the job, by reading it from the database
+        at most once every `job_status_ttl` seconds per process.
+        """
+        ttl = float(config.get('celery', 'job_status_ttl') or 0)
+        checked, is_running = max(
+            self._job_status.get(self.job_id, (0, None)),
+            (self.checked, self.is_running))
+        if time.time() - checked >= ttl:
+            checked = time.time()
+            [is_running] = models.OqJob.objects.filter(
+                id=self.job_id).values_list('is_running', flat=True)
+        self._job_status[self.job_id] = (checked, is_running)
+        return is_running
+
+
+# job_id -> context of the last task of the job run by the process
+_task_contexts = {}
+
+
+def get_calculation(job_id):
+    """
+    Return the calculation object of the given job, from the context of
+    the current task if available, otherwise from the database.
+
+    :param int job_id: the ID of the current job
+    """
+    try:
+        return _task_contexts[job_id].calc
+    except KeyError:
+        return models.OqJob.objects.get(id=job_id).calculation
+
+
+def pickle_context(task, job_id):
+    """
+    Return a list with the pickled context of the job if the task
+    is an oqtask, an empty list otherwise.
+
+    :param task: a `celery` task callable.
+    :param int job_id: the ID of the current job
+    """
+    if not getattr(task, 'ships_context', False):
+        return []
+    ctx = TaskContext(models.OqJob.objects.get(id=job_id))
+    return [broadcast(job_id, ctx)]
+
+
+def store_task_ids(job_id, task, task_ids):
+    """
+    Store the ids of the tasks sent to celery in the performance table
+    with a single COPY FROM, so that they can be revoked if the job
+    fails (see :func:`openquake.engine.engine.cleanup_after_job`).
+
+    :param int job_id: the ID of the current job
+    :param task: a `celery` task callable.
+    :param task_ids: a sequence of celery task ids
+    """
+    if not task_ids:
+        return
+    cache = EnginePerformanceMonitor.cache
+    for task_id in task_ids:
+        cache.add(models.Performance(
+            oq_job_id=job_id, task_id=task_id, task=task.__name__,
+            operation='storing task id', start_time=datetime.utcnow(),
+            duration=0))
+    cache.flush()
+
+
+def forget_task_ids(job_id, task):
+    """
+    Remove the task ids stored by :func:`store_task_ids`, with a single
+    query, once all the tasks have completed.
+
+    :param int job_id: the ID of the current job
+    :param task: a `celery` task callable.
+    """
+    models.Performance.objects.filter(
+        oq_job=job_id, operation='storing task id',
+        task=task.__name__).delete()
+
+
 def safely_call(func, args):
     """
     Call the given function with the given arguments safely, i.e.
@@ -118,7 +402,133 @@ def safely_call(func, args):
         return '\n%s%s: %s' % (tb_str, etype.__name__, exc), etype
 
 
-def map_reduce(task, task_args, agg, acc):
+class ResultCollector(object):
+    """
+    Unpickle the results of the tasks and aggregate them. If `num_threads`
+    is positive the collection is pipelined: the results are unpickled by
+    a pool of threads while the receiving loop goes on, and at most
+    2 * `num_threads` results can wait to be aggregated. The aggregation
+    is always performed by the calling thread, in order of arrival, since
+    the aggregation functions write on the database and on the
+    performance cache, which are not thread-safe. At the end the time
+    spent by the receiving loop in collecting the results (busy) and in
+    waiting for them is logged, together with the time spent in the
+    aggregation and in waiting for the unpickling threads.
+
+    :param task: a `celery` task callable
+    :param int job_id: the ID of the current job
+    :param agg: the aggregation function, (acc, val) -> new acc
+    :param acc: the initial value of the accumulator
+    :param int num_threads: the number of unpickling threads (0 = no threads)
+    """
+    def __init__(self, task, job_id, agg, acc, num_threads=0):
+        self.task = task
+        self.job_id = job_id
+        self.agg = agg
+        self.acc = acc
+        self.num_results = 0
+        self.unpik = self.raw_unpik = 0
+        self.unpik_time = 0
+        self.busy = self.wait = 0  # times of the receiving loop
+        self.agg_busy = self.agg_wait = 0  # times of the aggregation
+        self.lock = threading.Lock()
+        self.t0 = time.time()  # end time of the last call to .add
+        self.pending = collections.deque()  # futures of the unpickling
+        self.max_pending = 2 * num_threads
+        if num_threads:
+            self.executor = futures.ThreadPoolExecutor(num_threads)
+        else:
+            self.executor = None
+
+    def _unpickle(self, result_pik):
+        # called by the unpickling threads, if any
+        t0 = time.time()
+        result = result_pik.unpickle()
+        with self.lock:
+            self.unpik_time += time.time() - t0
+            self.unpik += len(result_pik)
+            self.raw_unpik += result_pik.raw_size
+        return result
+
+    def _aggregate(self, (result, exctype)):
+        if exctype:
+            raise RuntimeError(result)
+        t0 = time.time()
+        self.acc = self.agg(self.acc, result)
+        self.agg_busy += time.time() - t0
+
+    def _aggregate_pending(self, maxlen):
+        # aggregate the unpickled results in order of arrival, waiting
+        # for the unpickling threads only if more than `maxlen` are pending;
+        # in case of error the unpickling threads are stopped
+        try:
+            while self.pending and (len(self.pending) > maxlen or
+                                    self.pending[0].done()):
+                t0 = time.time()
+                result = self.pending.popleft().result()
+                self.agg_wait += time.time() - t0
+                self._aggregate(result)
+        except:
+            etype, exc, tb = sys.exc_info()
+            self._stop()
+            raise etype, exc, tb
+
+    def _stop(self):
+        # stop the unpickling threads, if any
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.pending.clear()
+
+    def add(self, result_pik):
+        """
+        Collect the pickled result of a task.
+        """
+        t0 = time.time()
+        self.wait += t0 - self.t0
+        check_mem_usage()  # log a warning if too much memory is used
+        self.num_results += 1
+        if self.executor is None:
+            self._aggregate(self._unpickle(result_pik))
+        else:  # blocks if there are too many results to aggregate
+            self.pending.append(
+                self.executor.submit(self._unpickle, result_pik))
+            self._aggregate_pending(self.max_pending)
+        self.t0 = time.time()
+        self.busy += self.t0 - t0
+
+    def get(self):
+        """
+        Wait for the pending aggregations and return the accumulator.
+        """
+        t0 = time.time()
+        self._aggregate_pending(0)
+        self._stop()
+        self.busy += time.time() - t0
+        taskname = self.task.__name__
+        logs.LOG.info('Unpickled %dM of received data in %s seconds',
+                      self.unpik / ONE_MB, self.unpik_time)
+        logs.LOG.info('Collected %d results of %s: busy %.2fs, waiting %.2fs;'
+                      ' aggregation busy %.2fs', self.num_results, taskname,
+                      self.busy, self.wait, self.agg_busy)
+        if self.agg_wait:
+            logs.LOG.info('The aggregation waited %.2fs for the unpickling',
+                          self.agg_wait)
+        save_sizes(self.job_id, self.task, 'receiving', self.raw_unpik,
+                   self.unpik)
+        return self.acc
+
+
+def collector_threads():
+    """
+    The number of threads unpickling the results of the tasks, as set
+    in the section [distribution] of openquake.cfg; 0 means that the
+    results are unpickled and aggregated by the receiving loop.
+    """
+    return int(config.get('distribution', 'collector_threads') or 0)
+
+
+def map_reduce(task, task_args, agg, acc, max_in_flight=None):
     """
     Given a task and an iterable of positional arguments, apply the
     task function to the arguments in parallel and return an aggregate
@@ -131,16 +541,23 @@ def map_reduce(task, task_args, agg, acc):
     tasks are run sequentially in the current process and then
     map_reduce(task, task_args, agg, acc) is the same as
     reduce(agg, itertools.starmap(task, task_args), acc).
+    If the `mode` in the section [distribution] of openquake.cfg
+    is `processpool` the tasks are run in a pool of processes on the
+    local machine, see :func:`pool_map_reduce`.
     Users of map_reduce should be aware of the fact that when
     thousands of tasks are spawned and large arguments are passed
     or large results are returned they may incur in memory issue:
     this is way the calculators limit the queue with the
-    `concurrent_task` concept.
+    `concurrent_task` concept. If `max_in_flight` is given, the
+    arguments are consumed lazily and at most `max_in_flight` tasks
+    are sent at the same time: in that case the memory occupation of
+    the controller node does not depend on the total number of tasks.
 
     :param task: a `celery` task callable.
     :param task_args: an iterable over positional arguments
     :param agg: the aggregation function, (acc, val) -> new acc
     :param acc: the initial value of the accumulator
+    :param max_in_flight: the maximum number of tasks in flight, or None
     :returns: the final value of the accumulator
     """
     if no_distribute():
@@ -149,38 +566,195 @@ def map_reduce(task, task_args, agg, acc):
             if exctype:
                 raise RuntimeError(result)
             acc = agg(acc, result)
+    elif use_process_pool():
+        acc = pool_map_reduce(task, task_args, agg, acc, max_in_flight)
+    elif max_in_flight:
+        acc = stream_map_reduce(task, task_args, agg, acc, max_in_flight)
     else:
         backend = current_app().backend
-        unpik = 0
         job_id = task_args[0][0]
-        taskname = task.__name__
-        mon = LightMonitor('unpickling %s' % taskname, job_id, task)
-        to_send = 0
+        ctx = pickle_context(task, job_id)
+        to_send = raw_to_send = 0
         pickled_args = []
         for args in task_args:
-            piks = pickle_sequence(args)
+            piks = ctx + pickle_sequence(args)
             pickled_args.append(piks)
             to_send += sum(len(p) for p in piks)
+            raw_to_send += sum(p.raw_size for p in piks)
         logs.LOG.info('Sending %dM', to_send / ONE_MB)
+        save_sizes(job_id, task, 'sending', raw_to_send, to_send)
         taskset = TaskSet(tasks=map(task.subtask, pickled_args))
-        for task_id, result_dict in taskset.apply_async().iter_native():
-            check_mem_usage()  # log a warning if too much memory is used
-            result_pik = result_dict['result']
-            with mon:
-                result, exctype = result_pik.unpickle()
-            if exctype:
-                raise RuntimeError(result)
-            unpik += len(result_pik)
-            acc = agg(acc, result)
+        taskset_result = taskset.apply_async()
+        store_task_ids(job_id, task, [res.task_id
+                                      for res in taskset_result.results])
+        collector = ResultCollector(
+            task, job_id, agg, acc, collector_threads())
+        for task_id, result_dict in taskset_result.iter_native():
+            collector.add(result_dict['result'])
             del backend._cache[task_id]  # work around a celery bug
-        logs.LOG.info('Unpickled %dM of received data in %s seconds',
-                      unpik / ONE_MB, mon.duration)
+        acc = collector.get()
+        forget_task_ids(job_id, task)
+    return acc
+
+
+def stream_map_reduce(task, task_args, agg, acc, max_in_flight):
+    """
+    Version of :func:`map_reduce` pulling the arguments lazily from
+    `task_args` and keeping at most `max_in_flight` tasks in the queue:
+    a new task is sent only when a result comes back. The results are
+    collected in order of sending, by waiting for the oldest task in
+    flight, so that the result backend is not polled. At the end the
+    peak number of bytes in flight is logged.
+
+    :param task: a `celery` task callable.
+    :param task_args: an iterable over positional arguments
+    :param agg: the aggregation function, (acc, val) -> new acc
+    :param acc: the initial value of the accumulator
+    :param int max_in_flight: the maximum number of tasks in flight
+    :returns: the final value of the accumulator
+    """
+    assert max_in_flight > 0, max_in_flight
+    backend = current_app().backend
+    arg_iter = iter(task_args)
+    # task_id -> (async result, number of bytes sent), in order of sending
+    pending = collections.OrderedDict()
+    collector = None
+    exhausted = False
+    sent = raw_sent = in_flight = peak = num_tasks = 0
+    while True:
+        # fill the window with new tasks, if there are arguments left
+        sent_ids = []
+        while not exhausted and len(pending) < max_in_flight:
+            try:
+                args = next(arg_iter)
+            except StopIteration:
+                exhausted = True
+                break
+            if collector is None:  # job_id is always the first argument
+                job_id = args[0]
+                collector = ResultCollector(
+                    task, job_id, agg, acc, collector_threads())
+                ctx = pickle_context(task, job_id)
+            piks = ctx + pickle_sequence(args)
+            nbytes = sum(len(p) for p in piks)
+            async_result = task.apply_async(piks)
+            pending[async_result.task_id] = (async_result, nbytes)
+            sent_ids.append(async_result.task_id)
+            num_tasks += 1
+            sent += nbytes
+            raw_sent += sum(p.raw_size for p in piks)
+            in_flight += nbytes
+            peak = max(peak, in_flight)
+        if sent_ids:
+            store_task_ids(job_id, task, sent_ids)
+        if not pending:
+            break
+        # wait for the oldest task, without polling the backend; the
+        # tasks are sent in order, so it is typically the first to end
+        task_id, (async_result, nbytes) = pending.popitem(last=False)
+        collector.add(async_result.get())
+        in_flight -= nbytes
+        backend._cache.pop(task_id, None)  # work around a celery bug
+    logs.LOG.info('Sent %dM in %d tasks, with a peak of %dM in flight',
+                  sent / ONE_MB, num_tasks, peak / ONE_MB)
+    if collector is None:  # no arguments
+        return acc
+    acc = collector.get()
+    forget_task_ids(job_id, task)
+    save_sizes(job_id, task, 'sending', raw_sent, sent)
+    return acc
+
+
+def use_process_pool():
+    """
+    True if the `mode` in the section [distribution] of openquake.cfg
+    is `processpool`, False if it is `celery` (the default)
+    """
+    return config.get('distribution', 'mode') == 'processpool'
+
+
+# the database connections inherited from the parent process; they are
+# kept alive so that they are not closed by the garbage collector, since
+# closing them would also close the connections of the parent
+_inherited_connections = []
+
+
+def _run_in_pool(task_name, piks):
+    """
+    Run a task in a process of the local pool. The task is called
+    directly, therefore it has the same semantics of a task run by a
+    celery worker: the exceptions are trapped and the result is pickled.
+
+    :param str task_name: the name of a `celery` task
+    :param piks: the pickled positional arguments
+    """
+    if not _inherited_connections:  # first task run by the process
+        for conn in connections.all():
+            _inherited_connections.append(conn.connection)
+            conn.connection = None  # force a new connection
+    return current_app().tasks[task_name](*piks)
+
+
+def pool_map_reduce(task, task_args, agg, acc, max_in_flight=None):
+    """
+    Version of :func:`map_reduce` running the tasks in a pool of processes
+    on the local machine, without a broker. The number of processes is set
+    by the parameter `num_workers` in the section [distribution] of
+    openquake.cfg (0 means one per CPU core). If `max_in_flight` is given,
+    the arguments are consumed lazily and at most `max_in_flight` tasks
+    are sent to the pool at the same time.
+
+    :param task: a `celery` task callable.
+    :param task_args: an iterable over positional arguments
+    :param agg: the aggregation function, (acc, val) -> new acc
+    :param acc: the initial value of the accumulator
+    :param max_in_flight: the maximum number of tasks in flight, or None
+    :returns: the final value of the accumulator
+    """
+    num_workers = int(config.get('distribution', 'num_workers') or 0) \
+        or multiprocessing.cpu_count()
+    # the processes must not inherit rows to be saved by the parent
+    CacheInserter.flushall()
+    arg_iter = iter(task_args)
+    pending = set()
+    collector = None
+    sent = raw_sent = 0
+    with futures.ProcessPoolExecutor(num_workers) as executor:
+        try:
+            while True:
+                n = max_in_flight - len(pending) if max_in_flight else None
+                for args in itertools.islice(arg_iter, n):
+                    if collector is None:  # job_id is the first argument
+                        job_id = args[0]
+                        collector = ResultCollector(
+                            task, job_id, agg, acc, collector_threads())
+                        ctx = pickle_context(task, job_id)
+                    piks = ctx + pickle_sequence(args)
+                    sent += sum(len(p) for p in piks)
+                    raw_sent += sum(p.raw_size for p in piks)
+                    pending.add(executor.submit(
+                        _run_in_pool, task.name, piks))
+                if not pending:
+                    break
+                done, pending = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED)
+                for fut in done:
+                    collector.add(fut.result())
+        except:
+            for fut in pending:  # do not wait for the pending tasks
+                fut.cancel()
+            raise
+    if collector is None:  # no arguments
+        return acc
+    acc = collector.get()
+    save_sizes(job_id, task, 'sending', raw_sent, sent)
     return acc
 
 
 # used to implement BaseCalculator.parallelize, which takes in account
 # the `concurrent_task` concept to avoid filling the Celery queue
-def parallelize(task, task_args, side_effect=lambda val: None):
+def parallelize(task, task_args, side_effect=lambda val: None,
+                max_in_flight=None):
     """
     Given a celery task and an iterable of positional arguments, apply the
     callable to the arguments in parallel. It is possible to pass a
@@ -189,13 +763,16 @@ def parallelize(task, task_args, side_effect=lambda val: None):
     it). Notice that the order is not preserved. parallelize returns None.
 
     NB: if the environment variable OQ_NO_DISTRIBUTE is set the
-    tasks are run sequentially in the current process.
+    tasks are run sequentially in the current process; if the process
+    pool is enabled in openquake.cfg they are run by the local processes.
 
     :param task: a celery task
     :param task_args: an iterable over positional arguments
     :param side_effect: a function val -> None
+    :param max_in_flight: the maximum number of tasks in flight, or None
     """
-    map_reduce(task, task_args, lambda acc, val: side_effect(val), None)
+    map_reduce(task, task_args, lambda acc, val: side_effect(val), None,
+               max_in_flight)
 
 
 def oqtask(task_func):
@@ -203,7 +780,9 @@ def oqtask(task_func):
     Task function decorator which sets up logging and catches (and logs) any
     errors which occur inside the task. Also checks to make sure the job is
     actually still running. If it is not running, the task doesn't get
-    executed, so we don't do useless computation.
+    executed, so we don't do useless computation. The information about
+    the job is taken from the :class:`TaskContext` sent by map_reduce, so
+    that the only query is the periodic check of the job status.
 
     :param task_func: the function to decorate
     """
@@ -213,21 +792,20 @@ def oqtask(task_func):
         code surrounded by a try-except. If any error occurs, log it as a
         critical failure.
         """
-        # job_id is always assumed to be the first argument
-        job_id = args[0]
-        job = models.OqJob.objects.get(id=job_id)
-        if job.is_running is False:
+        if isinstance(args[0], TaskContext):  # shipped by map_reduce
+            ctx, args = args[0], args[1:]
+        else:  # job_id is always assumed to be the first argument
+            ctx = TaskContext(models.OqJob.objects.get(id=args[0]))
+        if not ctx.job_is_running():
             # the job was killed, it is useless to run the task
             return
-
-        # it is important to save the task id soon, so that
-        # the revoke functionality can work
-        EnginePerformanceMonitor.store_task_id(job_id, tsk)
+        job_id = ctx.job_id
+        _task_contexts[job_id] = ctx
 
         with EnginePerformanceMonitor(
                 'total ' + task_func.__name__, job_id, tsk, flush=True):
             # tasks write on the celery log file
-            logs.set_level(job.log_level)
+            logs.set_level(ctx.log_level)
             check_mem_usage()  # log a warning if too much memory is used
             try:
                 # run the task
@@ -235,16 +813,11 @@ def oqtask(task_func):
             finally:
                 # save on the db
                 CacheInserter.flushall()
-                # the task finished, we can remove from the performance
-                # table the associated row 'storing task id'
-                models.Performance.objects.filter(
-                    oq_job=job,
-                    operation='storing task id',
-                    task_id=tsk.request.id).delete()
     celery_queue = config.get('amqp', 'celery_queue')
     f = lambda *args: Pickled(
         safely_call(wrapped, [a.unpickle() for a in args]))
     f.__name__ = task_func.__name__
     tsk = task(f, queue=celery_queue)
     tsk.task_func = task_func
+    tsk.ships_context = True  # map_reduce sends a TaskContext
     return tsk
@@ -19,8 +19,11 @@
 Base classes for the output methods of the various codecs.
 """
 
+import struct
+import decimal
 import logging
 import weakref
+import itertools
 import atexit
 from cStringIO import StringIO
 
@@ -32,20 +35,34 @@ from django.contrib.gis.geos.point import Point
 
 LOGGER = logging.getLogger('serializer')
 
+#: header of the PostgreSQL binary COPY format (signature, flags,
+#: header extension length)
+PGCOPY_HEADER = 'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+
+#: trailer of the PostgreSQL binary COPY format
+PGCOPY_TRAILER = struct.pack('>h', -1)
+
+#: length of a NULL field in the PostgreSQL binary COPY format
+PGCOPY_NULL = struct.pack('>i', -1)
+
 
 class CacheInserter(object):
     """
     Bulk insert bunches of Django objects by converting them in strings
     and by using COPY FROM.
     """
-    instances = weakref.WeakSet()
+    instances = weakref.WeakValueDictionary()  # creation number -> instance
+    _counter = itertools.count()
 
     @classmethod
     def flushall(cls):
         """
-        Flush the caches of all the instances of CacheInserter.
+        Flush the caches of all the instances of CacheInserter, in order
+        of creation, so that the rows referred by the rows of an instance
+        created later (for instance the parent ruptures of the SES ruptures)
+        are saved first.
         """
-        for instance in cls.instances:
+        for _, instance in sorted(cls.instances.items()):
             instance.flush()
 
     @classmethod
@@ -57,12 +74,8 @@ class CacheInserter(object):
         """
         self = cls(objects[0].__class__, block_size)
         curs = connections[self.alias].cursor()
-        seq = self.tname.replace('"', '') + '_id_seq'
         with transaction.commit_on_success(using=self.alias):
-            reserve_ids = "select nextval('%s') "\
-                "from generate_series(1, %d)" % (seq, len(objects))
-            curs.execute(reserve_ids)
-            ids = [i for (i,) in curs.fetchall()]
+            ids = cls.reserve_ids(self.table, len(objects))
             stringio = StringIO()
             for i, obj in zip(ids, objects):
                 stringio.write('%d\t%s\n' % (i, self.to_line(obj)))
@@ -71,15 +84,39 @@ class CacheInserter(object):
             stringio.close()
         return ids
 
-    def __init__(self, dj_model, max_cache_size):
+    @classmethod
+    def reserve_ids(cls, dj_model, n):
+        """
+        Reserve `n` ids from the sequence of the table of the given model.
+        The ids can be set on the objects before saving them with an
+        instance with `keep_ids=True`, so that they can be referred
+        before the objects are saved.
+
+        :returns: a list of ids
+        """
+        alias = router.db_for_write(dj_model)
+        seq = dj_model._meta.db_table.replace('"', '') + '_id_seq'
+        curs = connections[alias].cursor()
+        curs.execute("select nextval('%s') from generate_series(1, %d)"
+                     % (seq, n))
+        return [i for (i,) in curs.fetchall()]
+
+    def __init__(self, dj_model, max_cache_size, keep_ids=False):
         self.table = dj_model
         self.max_cache_size = max_cache_size
+        self.keep_ids = keep_ids
         self.alias = router.db_for_write(dj_model)
         self.tname = '"%s"' % dj_model._meta.db_table
+        # the fields stored as bytea, which require a special encoding
+        self.bytea_fields = dict(
+            (f.column, f) for f in dj_model._meta.fields
+            if f.get_internal_type() in (
+                'PickleField', 'GzippedField', 'SurfaceField',
+                'CompressedArrayField'))
         self._fields = {}
         self.nlines = 0
         self.stringio = StringIO()
-        self.instances.add(self)
+        self.instances[next(self._counter)] = self
 
     @property
     def fields(self):
@@ -110,6 +147,8 @@ class CacheInserter(object):
         assert isinstance(obj, self.table), 'Expected instance of %s, got %r' \
             % (self.table.__name__, obj)
         line = self.to_line(obj)
+        if self.keep_ids:
+            line = '%d\t%s' % (obj.id, line)
         self.stringio.write(line + '\n')
         self.nlines += 1
         if self.nlines >= self.max_cache_size:
@@ -126,7 +165,8 @@ class CacheInserter(object):
         with transaction.commit_on_success(using=self.alias):
             curs = connections[self.alias].cursor()
             self.stringio.reset()
-            curs.copy_from(self.stringio, self.tname, columns=self.fields)
+            columns = ['id'] + self.fields if self.keep_ids else self.fields
+            curs.copy_from(self.stringio, self.tname, columns=columns)
             self.stringio.close()
             self.stringio = StringIO()
 
@@ -147,6 +187,10 @@ class CacheInserter(object):
             col = getattr(obj, f)
             if col is None:
                 col = r'\N'
+            elif f in self.bytea_fields:
+                # hex format, with the backslash escaped for COPY
+                col = '\\\\x' + str(
+                    self.bytea_fields[f].get_prep_value(col)).encode('hex')
             elif isinstance(col, bool):
                 col = 't' if col else 'f'
             elif isinstance(col, Point):
@@ -176,5 +220,75 @@ class CacheInserter(object):
         return '{%s}' % ','.join(ls)
 
 
+def gen_ids(dj_model, block_size=1000):
+    """
+    Yield ids for the given model, reserved from the sequence of its
+    table in blocks of `block_size` ids (the ids not used are lost).
+    """
+    while True:
+        for id_ in CacheInserter.reserve_ids(dj_model, block_size):
+            yield id_
+
+
+def pg_numeric(value):
+    """
+    Convert a number into a field of type NUMERIC in the PostgreSQL binary
+    COPY format (length included), i.e. a sequence of base 10000 digits
+    with weight, sign and display scale.
+
+    :param value: a Decimal, a number or None
+    """
+    if value is None:
+        return PGCOPY_NULL
+    if not isinstance(value, decimal.Decimal):
+        value = decimal.Decimal(repr(value))
+    text = '{0:f}'.format(value)
+    sign = 0x4000 if text.startswith('-') else 0
+    intpart, _, fracpart = text.lstrip('-').partition('.')
+    dscale = len(fracpart)
+    intpart = intpart.zfill((len(intpart) + 3) // 4 * 4)
+    fracpart = fracpart.ljust((len(fracpart) + 3) // 4 * 4, '0')
+    digits = [int(intpart[i:i + 4]) for i in range(0, len(intpart), 4)]
+    weight = len(digits) - 1
+    digits.extend(int(fracpart[i:i + 4])
+                  for i in range(0, len(fracpart), 4))
+    while digits and digits[0] == 0:
+        del digits[0]
+        weight -= 1
+    while digits and digits[-1] == 0:
+        del digits[-1]
+    if not digits:
+        weight = sign = 0
+    data = struct.pack('>hhHh%dh' % len(digits), len(digits), weight,
+                       sign, dscale, *digits)
+    return struct.pack('>i', len(data)) + data
+
+
+def copy_binary(dj_model, columns, chunks):
+    """
+    Save data in the table of the given model with a COPY FROM in binary
+    format, in a single transaction. This is much faster than the textual
+    format used by :class:`CacheInserter` when the data come from numpy
+    arrays, since there is no conversion to strings.
+
+    :param dj_model: a Django model class
+    :param columns: the names of the columns to populate
+    :param chunks: an iterable over strings with the binary tuples
+    """
+    alias = router.db_for_write(dj_model)
+    tname = '"%s"' % dj_model._meta.db_table
+    data = StringIO()
+    data.write(PGCOPY_HEADER)
+    for chunk in chunks:
+        data.write(chunk)
+    data.write(PGCOPY_TRAILER)
+    data.reset()
+    with transaction.commit_on_success(using=alias):
+        curs = connections[alias].cursor()
+        curs.copy_expert('COPY %s (%s) FROM STDIN WITH BINARY' % (
+            tname, ', '.join(columns)), data)
+    data.close()
+
+
 # just to make sure that flushall is always called
 atexit.register(CacheInserter.flushall)
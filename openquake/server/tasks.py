@@ -188,6 +188,9 @@ DbInterface = collections.namedtuple(
     'DbInterface',
     'export_query target_table fields import_query')
 
+#: the SES tags are not stored, they are built from the event keys
+_TAG_SQL = oqe_models.get_tag_sql('r.event_key', 'pr.source_id')
+
 
 DBINTERFACE = {
     'hazard_curve': DbInterface(
@@ -215,12 +218,12 @@ DBINTERFACE = {
            SELECT %s, iml, ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)
            FROM temp_icebox_hazardmap"""),
     'ses': DbInterface(
-        """SELECT tag, magnitude, St_AsText(hypocenter)
+        """SELECT %s AS tag, magnitude, St_AsText(hypocenter)
            FROM hzrdr.ses_rupture r
-           JOIN hzrdr.probabilistic_rupture pr ON r.id = r.rupture_id
+           JOIN hzrdr.probabilistic_rupture pr ON pr.id = r.rupture_id
            JOIN hzrdr.ses_collection sc ON pr.ses_collection_id = sc.id
            JOIN uiapi.output o ON o.id = sc.output_id
-           WHERE o.id = %(output_id)d""",
+           WHERE o.id = %%(output_id)d""" % _TAG_SQL,
         "icebox_ses",
         "tag varchar, magnitude float, hypocenter varchar",
         """INSERT INTO